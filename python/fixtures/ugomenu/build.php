@@ -0,0 +1,57 @@
+<?php
+
+/*
+Builds expected.ugo with class.ugomenu.php, for ugoBenchmark.py to check ugomenu.py against
+
+php build.php > expected.ugo
+
+expected.ugo was made by running this script with PHP 8.4.5. The menu covers the quirks ugomenu.py has to copy: the menu
+section length is counted in characters by mb_strlen but padded in bytes by str_pad, which leaves it one byte longer than its
+section table entry, embeds are counted as 1696 bytes for .ppm and 2048 bytes for anything else, a short file embeds only the
+bytes it has, and only .ppm and .ntft files are actually written.
+*/
+
+require __DIR__ . "/../../../php/class.ugomenu.php";
+
+$menu = new ugomenu;
+$menu->setType("grid");
+$menu->setMeta("UpperTitle", "Café — ☆");
+$menu->setMeta("uppersubbottom", "page 1");
+$menu->addDropdown([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/recent.uls",
+  "label" => "Recent",
+  "selected" => "1",
+]);
+$menu->addDropdown([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/popular.uls",
+  "label" => "Most popular",
+]);
+$menu->addButton([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/post.reply",
+  "label" => "Post",
+]);
+$menu->addItem([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/café.htm",
+  "label" => "Café",
+  "counter" => 12,
+  "lock" => "1",
+]);
+$menu->addItem([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/icon.htm",
+  "file" => __DIR__ . "/icon.ntft",
+]);
+$menu->addItem([
+  "label" => "日本語",
+]);
+$menu->addItem([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/thumb.htm",
+  "file" => __DIR__ . "/thumb.ppm",
+  "counter" => 3,
+]);
+$menu->addItem([
+  "url" => "http://flipnote.hatena.com/ds/v2-xx/odd.htm",
+  "file" => __DIR__ . "/odd.nbf",
+  "unknown" => 1,
+]);
+
+echo $menu->getUGO();
@@ -0,0 +1,828 @@
+#!/usr/bin/python3
+
+# ==========================
+# ppmParser.py version 1.0.0
+# ==========================
+#
+# Parse metadata, thumbnails and sound tracks from Flipnote and Comment .ppm files, and index whole archives of them into SQLite
+# Reads the same fields as php/class.ppmParser.php, from one memory-mapped view of each file
+# Originally written for Sudomemo (github.com/Sudomemo | www.sudomemo.net)
+#
+# Usage:
+# ======
+#
+# Print the metadata of a PPM as JSON:
+# python3 ppmParser.py input_path
+#
+# Index every PPM in a directory tree into an SQLite database, using several processes:
+# python3 ppmParser.py -x input_dir database_path (-j processes)
+#
+# Running the indexer again only parses files that are new, or whose size or modification time have changed since they were last indexed,
+# and removes files that no longer exist from the database
+#
+# Convert the thumbnail of a PPM to a PNG:
+# python3 ppmParser.py -t input_path output_path
+#
+# Convert the thumbnails of every PPM in a directory tree to PNGs, using several processes:
+# python3 ppmParser.py -T input_dir output_dir (-j processes)
+#
+# Convert a sound track of a PPM to a WAV file, track can be BGM (the default), SE1, SE2 or SE3:
+# python3 ppmParser.py -a input_path output_path (track)
+#
+# Convert every sound track of every PPM in a directory tree to WAV files, using several processes:
+# python3 ppmParser.py -A input_dir output_dir (-j processes)
+#
+# Issues:
+# =======
+#
+# If you find any bugs in this script, please report them here:
+# https://github.com/Sudomemo/sudomemo-utils/issues
+#
+# Format documentation can be found on PBSDS' hatena-server wiki:
+#   - ppm: https://github.com/pbsds/hatena-server/wiki/PPM-format
+#
+# Requirements:
+#   - Python 3
+#       Installation: https://www.python.org/downloads/
+#   - The Pillow Image Library (https://python-pillow.org/)
+#       Installation: http://pillow.readthedocs.io/en/3.0.x/installation.html
+#   - NumPy (http://www.numpy.org/)
+#       Installation: https://www.scipy.org/install.html
+
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+import os, sys, re, json, mmap, wave, struct, sqlite3, hashlib, itertools
+
+VERSION = "1.0.0"
+
+# Each section is unpacked with one precompiled struct, rather than one read per field
+# https://github.com/pbsds/hatena-server/wiki/PPM-format#file-header
+HEADER = struct.Struct("<4sIIH")
+HEADER_FIELDS = ["magic", "frameDataLength", "soundDataLength", "frameCount"]
+# https://github.com/pbsds/hatena-server/wiki/PPM-format#metadata
+META = struct.Struct("<HH22s22s22sQQ18s18sQ8xI")
+META_FIELDS = ["lock", "thumbIndex", "rootAuthorName", "parentAuthorName", "currentAuthorName", "parentAuthorID", "currentAuthorID",
+               "parentFilename", "currentFilename", "rootAuthorID", "timestamp"]
+META_OFFSET = 16
+# https://github.com/pbsds/hatena-server/wiki/PPM-format#sound-header
+SOUND_HEADER = struct.Struct("<IIIIbb")
+SOUND_HEADER_FIELDS = ["BGMLength", "SE1Length", "SE2Length", "SE3Length", "frameSpeed", "BGMSpeed"]
+FLAGS = struct.Struct("<H")
+FLAGS_OFFSET = 1702
+FRAME_TABLE_OFFSET = 0x06A0
+TMB_LENGTH = 1696
+
+# https://github.com/pbsds/hatena-server/wiki/PPM-format#thumbnail
+# The thumbnail is 64 * 48 pixels, stored as 8 * 6 tiles of 8 * 8 pixels, 4 bits per pixel with the low nibble first
+THUMBNAIL_OFFSET = 0xA0
+THUMBNAIL_LENGTH = 1536
+THUMBNAIL_WIDTH = 64
+THUMBNAIL_HEIGHT = 48
+THUMBNAIL_TILE = 8
+THUMBNAIL_PALETTE = np.array([
+    [0xFF, 0xFF, 0xFF], [0x52, 0x52, 0x52], [0xFF, 0xFF, 0xFF], [0x9C, 0x9C, 0x9C],
+    [0xFF, 0x48, 0x44], [0xC8, 0x51, 0x4F], [0xFF, 0xAD, 0xAC], [0x00, 0xFF, 0x00],
+    [0x48, 0x40, 0xFF], [0x51, 0x4F, 0xB8], [0xAD, 0xAB, 0xFF], [0x00, 0xFF, 0x00],
+    [0xB6, 0x57, 0xB7], [0x00, 0xFF, 0x00], [0x00, 0xFF, 0x00], [0x00, 0xFF, 0x00],
+], dtype=np.uint8)
+# Both pixels of every possible byte, as 6 RGB values, so each byte only needs one lookup
+THUMBNAIL_BYTE_LOOKUP = np.concatenate([THUMBNAIL_PALETTE[np.arange(256) & 0x0F], THUMBNAIL_PALETTE[np.arange(256) >> 4]], axis=1)
+
+# https://github.com/pbsds/hatena-server/wiki/PPM-format#sound-data
+# Sound tracks are 4 bit IMA ADPCM, mono, 8192 samples per second, with the low nibble of each byte first
+TRACKS = ["BGM", "SE1", "SE2", "SE3"]
+ADPCM_SAMPLE_RATE = 8192
+ADPCM_STEP_TABLE = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143,
+    157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552,
+    1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+    12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767
+], dtype=np.int32)
+ADPCM_INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int16)
+# Sample difference for every step index and nibble
+_steps = ADPCM_STEP_TABLE[:, None]
+_nibbles = np.arange(16)[None, :]
+ADPCM_DIFF = (_steps >> 3) + np.where(_nibbles & 1, _steps >> 2, 0) + np.where(_nibbles & 2, _steps >> 1, 0) + np.where(_nibbles & 4, _steps, 0)
+ADPCM_DIFF = np.where(_nibbles & 8, -ADPCM_DIFF, ADPCM_DIFF).astype(np.int32)
+del _steps, _nibbles
+
+FSID_PATTERN = re.compile("^[0159][0-9A-F]{6}0[0-9A-F]{8}$")
+FILENAME_PATTERN = re.compile("^[A-F0-9]{6}_[A-F0-9]{13}_[0-9]{3}$")
+
+class ppmParser:
+
+    def __init__(self, source=None):
+        self.data = None
+        self.header = None
+        self.meta = None
+        self.soundMeta = None
+        # Reason the last open failed, or None
+        self.error = None
+        if source is not None:
+            self.open(source)
+
+    # Open a PPM
+    # source = file path, or bytes-like object containing the whole file
+    # Returns True if the file is a PPM, else False, with the reason in self.error
+    def open(self, source):
+        self.close()
+        if isinstance(source, (str, os.PathLike)):
+            try:
+                with open(source, "rb") as file:
+                    try:
+                        # Only the pages that are actually read get loaded, so the sound header at the end doesn't mean reading the whole file
+                        self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (ValueError, OSError):
+                        # Empty files and things like pipes can't be mapped
+                        self.data = file.read()
+            except OSError as error:
+                self.error = "could not open {}: {}".format(source, error)
+                return False
+        else:
+            self.data = source
+        if len(self.data) < HEADER.size:
+            self.error = "file is too short to be a PPM"
+            return False
+        self.header = self.parseHeader()
+        if self.header["magic"] != b"PARA":
+            self.error = "not a valid PPM"
+            return False
+        return True
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+        self.header = None
+        self.meta = None
+        self.soundMeta = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    # PARSING FUNCTIONS
+
+    def parseHeader(self):
+        header = dict(zip(HEADER_FIELDS, HEADER.unpack_from(self.data, 0)))
+        # Off by one fix
+        header["frameCount"] += 1
+        # Calculate the sound data offset, zipaligned to the next 4 bytes
+        soundDataOffset = 0x06A0 + header["frameDataLength"] + header["frameCount"]
+        if soundDataOffset % 4 != 0:
+            soundDataOffset += 4 - (soundDataOffset % 4)
+        header["soundDataOffset"] = soundDataOffset
+        return header
+
+    def parseMeta(self):
+        meta = dict(zip(META_FIELDS, META.unpack_from(self.data, META_OFFSET)))
+        # Unpack the loop flag
+        meta["loop"] = FLAGS.unpack_from(self.data, FLAGS_OFFSET)[0] >> 1 & 0x01
+        return meta
+
+    def parseSoundHeader(self):
+        soundMeta = dict(zip(SOUND_HEADER_FIELDS, SOUND_HEADER.unpack_from(self.data, self.header["soundDataOffset"])))
+        offset = 32
+        soundMeta["BGMOffset"] = offset
+        for previous, track in [("BGM", "SE1"), ("SE1", "SE2"), ("SE2", "SE3")]:
+            offset += soundMeta[previous + "Length"]
+            soundMeta[track + "Offset"] = offset
+        return soundMeta
+
+    # PRETTY-PRINTING UTILS
+
+    def _prettyFilename(self, filename):
+        # Only ASCII letters are uppercased, like PHP's strtoupper
+        return "{}_{}_{:03d}".format(filename[0:3].hex().upper(), filename[3:16].upper().decode("latin-1"), int.from_bytes(filename[16:18], "little"))
+
+    def _prettyUsername(self, username):
+        return username.decode("utf-16-le", errors="replace").strip("\0")
+
+    def _prettyFSID(self, ID):
+        return "{:016X}".format(ID)
+
+    # GETTERS
+
+    # Nicely format all PPM metadata, without checking it
+    # Returns a dict, in the same layout as getMeta
+    def formatMeta(self):
+        if not self.meta:
+            self.meta = self.parseMeta()
+        if not self.soundMeta:
+            self.soundMeta = self.parseSoundHeader()
+        return {
+            "lock": self.meta["lock"],
+            "loop": self.meta["loop"],
+            "frame_count": self.header["frameCount"],
+            "frame_speed": 8 - self.soundMeta["frameSpeed"],
+            "thumb_index": self.meta["thumbIndex"],
+            "timestamp": self.meta["timestamp"],
+            "unix_timestamp": self.meta["timestamp"] + 946684800,
+            "root": {
+                "username": self._prettyUsername(self.meta["rootAuthorName"]),
+                "fsid": self._prettyFSID(self.meta["rootAuthorID"])
+            },
+            "parent": {
+                "username": self._prettyUsername(self.meta["parentAuthorName"]),
+                "fsid": self._prettyFSID(self.meta["parentAuthorID"]),
+                "filename": self._prettyFilename(self.meta["parentFilename"])
+            },
+            "current": {
+                "username": self._prettyUsername(self.meta["currentAuthorName"]),
+                "fsid": self._prettyFSID(self.meta["currentAuthorID"]),
+                "filename": self._prettyFilename(self.meta["currentFilename"])
+            },
+            "track_usage": {
+                "BGM": self.soundMeta["BGMLength"] > 0,
+                "SE1": self.soundMeta["SE1Length"] > 0,
+                "SE2": self.soundMeta["SE2Length"] > 0,
+                "SE3": self.soundMeta["SE3Length"] > 0
+            },
+            "track_frame_speed": 8 - self.soundMeta["BGMSpeed"]
+        }
+
+    # Check that the FSIDs and filenames of some formatted metadata look right
+    def isMetaValid(self, meta):
+        fsids = [meta["root"]["fsid"], meta["parent"]["fsid"], meta["current"]["fsid"]]
+        filenames = [meta["parent"]["filename"], meta["current"]["filename"]]
+        return all(FSID_PATTERN.match(ID) for ID in fsids) and all(FILENAME_PATTERN.match(filename) for filename in filenames)
+
+    # Nicely format all PPM metadata
+    # Returns a dict, or None if the FSIDs or filenames aren't valid
+    def getMeta(self):
+        meta = self.formatMeta()
+        return meta if self.isMetaValid(meta) else None
+
+    # Test to see if a comment PPM is blank
+    def isBlankComment(self):
+        return self.header["frameDataLength"] == 112
+
+    # Test to check that the frame offset table is valid
+    def isFrameTableValid(self):
+        offsetTableLength = FLAGS.unpack_from(self.data, FRAME_TABLE_OFFSET)[0]
+        # Do some sanity checks on the offset table length itself
+        if offsetTableLength % 4 != 0 or offsetTableLength // 4 > 999:
+            return False
+        if offsetTableLength // 4 != self.header["frameCount"]:
+            return False
+        # View the offset table, which starts after the table length and 6 more bytes, without copying it
+        tableOffset = FRAME_TABLE_OFFSET + 8
+        available = max(0, min(offsetTableLength, len(self.data) - tableOffset))
+        offsetTable = np.frombuffer(self.data, dtype="<u4", count=available // 4, offset=tableOffset)
+        # Ensure that all frame offsets land within the frame data
+        frameOffsetLimit = self.header["frameDataLength"] - offsetTableLength - 8
+        return not np.any(offsetTable > frameOffsetLimit)
+
+    # Get the TMB
+    def getTMB(self):
+        return bytes(self.data[0:TMB_LENGTH])
+
+    # Decode the thumbnail
+    # Returns a 48 * 64 * 3 RGB array
+    def getThumbnail(self):
+        return decodeThumbnails(np.frombuffer(self.data, dtype=np.uint8, count=THUMBNAIL_LENGTH, offset=THUMBNAIL_OFFSET), count=1)[0]
+
+    # Get raw sound track data
+    # track = "BGM", "SE1", "SE2" or "SE3"
+    # Returns bytes, or None if the track isn't used
+    def getTrack(self, track):
+        if not self.soundMeta:
+            self.soundMeta = self.parseSoundHeader()
+        if self.soundMeta[track + "Length"] == 0:
+            return None
+        offset = self.header["soundDataOffset"] + self.soundMeta[track + "Offset"]
+        return bytes(self.data[offset:offset + self.soundMeta[track + "Length"]])
+
+    # Get a md5sum of the BGM track data
+    def getBGMDigest(self):
+        track = self.getTrack("BGM")
+        return hashlib.md5(track).hexdigest() if track is not None else None
+
+    # Decode a sound track a chunk at a time, without copying the whole track out of the file
+    # track = "BGM", "SE1", "SE2" or "SE3"
+    # chunkSize = number of track bytes to decode at a time, each byte is two samples
+    # Yields int16 arrays of samples at ADPCM_SAMPLE_RATE, nothing if the track isn't used
+    def iterTrackSamples(self, track, chunkSize=16384):
+        start, end = self._trackRange(track)
+        decoder = adpcmDecoder()
+        for offset in range(start, end, chunkSize):
+            yield decoder.decode(self.data[offset:min(offset + chunkSize, end)])
+
+    # Find the track data that's actually in the file, which is shorter than the sound header says if the file is truncated
+    # Returns (start offset, end offset)
+    def _trackRange(self, track):
+        if not self.soundMeta:
+            self.soundMeta = self.parseSoundHeader()
+        start = self.header["soundDataOffset"] + self.soundMeta[track + "Offset"]
+        return (start, max(start, min(start + self.soundMeta[track + "Length"], len(self.data))))
+
+    # Decode a whole sound track
+    # Returns an int16 array of samples, or None if the track isn't used
+    def getTrackSamples(self, track):
+        chunks = list(self.iterTrackSamples(track))
+        return np.concatenate(chunks) if chunks else None
+
+    # Decode a sound track to a WAV file, a chunk at a time
+    # output = file path or writable binary file object
+    # Returns True if the track was written, or False if it isn't used
+    def saveTrackWav(self, track, output, chunkSize=16384):
+        if not self.soundMeta:
+            self.soundMeta = self.parseSoundHeader()
+        if self.soundMeta[track + "Length"] == 0:
+            return False
+        with wave.open(output, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(ADPCM_SAMPLE_RATE)
+            # Setting the length up front means the header doesn't need rewriting at the end, so unseekable outputs work too
+            # It comes from the data that will really be decoded, rather than the sound header, in case the file is truncated
+            start, end = self._trackRange(track)
+            wav.setnframes((end - start) * 2)
+            for samples in self.iterTrackSamples(track, chunkSize=chunkSize):
+                wav.writeframesraw(samples.astype("<i2", copy=False).tobytes())
+        return True
+
+# Decode a stack of PPM thumbnails in one pass
+# data = array, bytes, or list of bytes objects, holding one or more thumbnails of 1536 bytes each, or whole TMBs of 1696 bytes each
+# count = number of thumbnails in data, only optional when data is a list or an N * 1536 or N * 1696 array
+# Returns an N * 48 * 64 * 3 RGB array
+# Raises ValueError if data isn't exactly count thumbnails or TMBs long
+def decodeThumbnails(data, count=None):
+    if isinstance(data, (list, tuple)):
+        if count is None:
+            count = len(data)
+        data = np.concatenate([np.frombuffer(item, dtype=np.uint8) for item in data]) if data else np.zeros(0, dtype=np.uint8)
+    data = np.asarray(np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray, memoryview)) else data, dtype=np.uint8)
+    if count is None:
+        if data.ndim != 2:
+            raise ValueError("thumbnail count is required for flat data")
+        count = data.shape[0]
+    # Both lengths are checked against the count, since a run of thumbnails can be the same length as a different number of TMBs
+    if data.size == count * TMB_LENGTH:
+        data = data.reshape(count, TMB_LENGTH)[:, THUMBNAIL_OFFSET:THUMBNAIL_OFFSET + THUMBNAIL_LENGTH]
+    elif data.size == count * THUMBNAIL_LENGTH:
+        data = data.reshape(count, THUMBNAIL_LENGTH)
+    else:
+        raise ValueError("expected {} thumbnails of {} bytes or TMBs of {} bytes, got {} bytes".format(count, THUMBNAIL_LENGTH, TMB_LENGTH, data.size))
+    tilesX = THUMBNAIL_WIDTH // THUMBNAIL_TILE
+    tilesY = THUMBNAIL_HEIGHT // THUMBNAIL_TILE
+    pixels = np.take(THUMBNAIL_BYTE_LOOKUP, data, axis=0)
+    # Tiles are stored left to right, top to bottom, so moving the tile column axis in between the row axes puts every pixel in place
+    pixels = pixels.reshape(-1, tilesY, tilesX, THUMBNAIL_TILE, THUMBNAIL_TILE, 3)
+    image = np.empty((data.shape[0], tilesY, THUMBNAIL_TILE, tilesX, THUMBNAIL_TILE, 3), dtype=np.uint8)
+    image[...] = pixels.transpose(0, 1, 3, 2, 4, 5)
+    return image.reshape(-1, THUMBNAIL_HEIGHT, THUMBNAIL_WIDTH, 3)
+
+# Read the TMBs of several PPMs into one array, without reading the rest of each file
+# paths = list of file paths
+# Returns an N * 1696 array, and a list of the paths that couldn't be read
+def readTMBs(paths):
+    data = np.zeros((len(paths), TMB_LENGTH), dtype=np.uint8)
+    failed = []
+    for index, path in enumerate(paths):
+        try:
+            with open(path, "rb") as file:
+                if file.readinto(data[index]) != TMB_LENGTH or data[index, 0:4].tobytes() != b"PARA":
+                    failed.append(path)
+        except OSError:
+            failed.append(path)
+    return data, failed
+
+# Convert the thumbnails of a chunk of PPMs to PNGs inside a worker process
+# jobs = list of (PPM path, PNG path)
+# Returns a list of (PPM path, error) for the thumbnails that failed
+def _thumbnailJob(jobs):
+    data, failed = readTMBs([inputPath for inputPath, outputPath in jobs])
+    failed = set(failed)
+    errors = [(path, "not a valid PPM") for path in failed]
+    # Every thumbnail in the chunk is decoded at once, the failed ones just get skipped when saving
+    images = decodeThumbnails(data, count=len(jobs))
+    for (inputPath, outputPath), pixels in zip(jobs, images):
+        if inputPath in failed:
+            continue
+        try:
+            Image.fromarray(pixels).save(outputPath, "PNG")
+        except Exception as error:
+            errors.append((inputPath, "{}: {}".format(type(error).__name__, error)))
+    return errors
+
+# Convert the thumbnails of every PPM in a directory tree to PNGs, using several processes
+# Output files keep the directory layout of the input, with a .png extension
+# directory = directory to search for .ppm files
+# outputDir = directory to save the PNGs to
+# processes = number of worker processes to use, defaults to the number of CPU cores
+# chunkSize = number of thumbnails each worker decodes at once
+# Returns a dict of converted and failed file counts, along with a list of (path, error) for the failures
+def batchThumbnails(directory, outputDir, processes=None, chunkSize=256):
+    processes = processes or os.cpu_count() or 1
+    jobs = []
+    for path, mtime, size in findPpmFiles(directory):
+        outputPath = os.path.join(outputDir, os.path.splitext(os.path.relpath(path, directory))[0] + ".png")
+        os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+        jobs.append((path, outputPath))
+    chunks = [jobs[start:start + chunkSize] for start in range(0, len(jobs), chunkSize)]
+    errors = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for chunkErrors in executor.map(_thumbnailJob, chunks):
+            errors.extend(chunkErrors)
+    return {"converted": len(jobs) - len(errors), "failed": len(errors), "errors": errors}
+
+# Running sum where every step is clipped to a range, x = clip(x + delta, low, high)
+# Two of those steps in a row are a step of the same form, since
+#   clip(clip(x + a1, lo1, hi1) + a2, lo2, hi2) == clip(x + a1 + a2, clip(lo1 + a2, lo2, hi2), clip(hi1 + a2, lo2, hi2))
+# so the steps are combined with a prefix scan in log2(n) vectorized passes, rather than followed one at a time
+# Combined deltas are kept within the width of the range, which gives the same results for every x inside it, so they can't overflow dtype
+# Returns the value after every step
+def _clippedRunningSum(deltas, initial, low, high, dtype):
+    limit = high - low
+    add = np.clip(deltas, -limit, limit).astype(dtype)
+    lo = np.full(len(add), low, dtype=dtype)
+    hi = np.full(len(add), high, dtype=dtype)
+    shift = 1
+    while shift < len(add):
+        laterAdd = add[shift:]
+        laterLo = lo[shift:]
+        laterHi = hi[shift:]
+        newLo = np.clip(lo[:-shift] + laterAdd, laterLo, laterHi)
+        newHi = np.clip(hi[:-shift] + laterAdd, laterLo, laterHi)
+        laterAdd[...] = np.clip(add[:-shift] + laterAdd, -limit, limit)
+        laterLo[...] = newLo
+        laterHi[...] = newHi
+        shift *= 2
+    return np.clip(add + dtype(initial), lo, hi)
+
+# Stateful decoder for PPM sound tracks, so a track can be decoded a chunk at a time
+class adpcmDecoder:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.predictor = 0
+        self.stepIndex = 0
+
+    # Decode the next chunk of a track
+    # data = bytes-like object or uint8 array
+    # Returns an int16 array, with two samples per input byte
+    def decode(self, data):
+        data = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+        if not len(data):
+            return np.zeros(0, dtype=np.int16)
+        nibbles = np.empty((len(data), 2), dtype=np.uint8)
+        np.bitwise_and(data, 0x0F, out=nibbles[:, 0])
+        np.right_shift(data, 4, out=nibbles[:, 1])
+        nibbles = nibbles.ravel()
+        # The step index only depends on the nibbles, so it can be worked out before any of the samples
+        stepIndices = _clippedRunningSum(ADPCM_INDEX_TABLE[nibbles], self.stepIndex, 0, len(ADPCM_STEP_TABLE) - 1, np.int16)
+        # Each sample is decoded with the step index from before its own nibble
+        sampleStepIndices = np.empty_like(stepIndices)
+        sampleStepIndices[0] = self.stepIndex
+        sampleStepIndices[1:] = stepIndices[:-1]
+        samples = _clippedRunningSum(ADPCM_DIFF[sampleStepIndices, nibbles], self.predictor, -32768, 32767, np.int32)
+        self.stepIndex = int(stepIndices[-1])
+        self.predictor = int(samples[-1])
+        return samples.astype(np.int16)
+
+# Convert the sound tracks of a PPM to WAV files inside a worker process
+# job = (PPM path, output path without extension)
+# Returns (number of tracks written, error or None)
+def _trackJob(job):
+    inputPath, outputBase = job
+    written = 0
+    parser = ppmParser()
+    try:
+        if not parser.open(inputPath):
+            return (0, parser.error)
+        for track in TRACKS:
+            if parser.saveTrackWav(track, "{}_{}.wav".format(outputBase, track)):
+                written += 1
+    except Exception as error:
+        return (written, "{}: {}".format(type(error).__name__, error))
+    finally:
+        parser.close()
+    return (written, None)
+
+# Convert every sound track of every PPM in a directory tree to WAV files, using several processes
+# Output files keep the directory layout of the input, with the track name and a .wav extension added, e.g. name_BGM.wav
+# directory = directory to search for .ppm files
+# outputDir = directory to save the WAV files to
+# processes = number of worker processes to use, defaults to the number of CPU cores
+# Returns a dict of file, track and failed file counts, along with a list of (path, error) for the failures
+def batchTracks(directory, outputDir, processes=None):
+    processes = processes or os.cpu_count() or 1
+    jobs = []
+    for path, mtime, size in findPpmFiles(directory):
+        outputBase = os.path.join(outputDir, os.path.splitext(os.path.relpath(path, directory))[0])
+        os.makedirs(os.path.dirname(outputBase), exist_ok=True)
+        jobs.append((path, outputBase))
+    result = {"files": len(jobs), "tracks": 0, "failed": 0, "errors": []}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for (path, outputBase), (written, error) in zip(jobs, executor.map(_trackJob, jobs, chunksize=max(1, min(64, len(jobs) // (processes * 4))))):
+            result["tracks"] += written
+            if error is not None:
+                result["failed"] += 1
+                result["errors"].append((path, error))
+    return result
+
+# Columns of the index table, in the order that _indexFile returns them
+INDEX_COLUMNS = [
+    ("path", "TEXT PRIMARY KEY"),
+    ("mtime_ns", "INTEGER"),
+    ("size", "INTEGER"),
+    ("error", "TEXT"),
+    ("meta_valid", "INTEGER"),
+    ("frame_table_valid", "INTEGER"),
+    ("blank_comment", "INTEGER"),
+    ("lock", "INTEGER"),
+    ("loop", "INTEGER"),
+    ("frame_count", "INTEGER"),
+    ("frame_speed", "INTEGER"),
+    ("thumb_index", "INTEGER"),
+    ("timestamp", "INTEGER"),
+    ("unix_timestamp", "INTEGER"),
+    ("root_username", "TEXT"),
+    ("root_fsid", "TEXT"),
+    ("parent_username", "TEXT"),
+    ("parent_fsid", "TEXT"),
+    ("parent_filename", "TEXT"),
+    ("current_username", "TEXT"),
+    ("current_fsid", "TEXT"),
+    ("current_filename", "TEXT"),
+    ("bgm_used", "INTEGER"),
+    ("se1_used", "INTEGER"),
+    ("se2_used", "INTEGER"),
+    ("se3_used", "INTEGER"),
+    ("track_frame_speed", "INTEGER"),
+]
+
+# Find every .ppm file in a directory tree
+# Yields (path, mtime in nanoseconds, size) for each file
+def findPpmFiles(directory):
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from findPpmFiles(entry.path)
+        elif entry.name.lower().endswith(".ppm") and entry.is_file():
+            # scandir gets the stat results along with the directory listing on most platforms
+            stat = entry.stat()
+            yield (entry.path, stat.st_mtime_ns, stat.st_size)
+
+# Parse a single PPM inside a worker process, catching any errors so they don't end the indexing run
+# entry = (path, mtime in nanoseconds, size)
+# Returns a row of values for INDEX_COLUMNS
+def _indexFile(entry):
+    path, mtime, size = entry
+    row = [path, mtime, size] + [None] * (len(INDEX_COLUMNS) - 3)
+    parser = ppmParser()
+    try:
+        if not parser.open(path):
+            row[3] = parser.error
+            return row
+        meta = parser.formatMeta()
+        row[3:] = [
+            None, parser.isMetaValid(meta), parser.isFrameTableValid(), parser.isBlankComment(),
+            meta["lock"], meta["loop"], meta["frame_count"], meta["frame_speed"], meta["thumb_index"], meta["timestamp"], meta["unix_timestamp"],
+            meta["root"]["username"], meta["root"]["fsid"],
+            meta["parent"]["username"], meta["parent"]["fsid"], meta["parent"]["filename"],
+            meta["current"]["username"], meta["current"]["fsid"], meta["current"]["filename"],
+            meta["track_usage"]["BGM"], meta["track_usage"]["SE1"], meta["track_usage"]["SE2"], meta["track_usage"]["SE3"],
+            meta["track_frame_speed"]
+        ]
+    except Exception as error:
+        row[3] = "{}: {}".format(type(error).__name__, error)
+    finally:
+        parser.close()
+    return row
+
+# Index every PPM in a directory tree into an SQLite database
+# Files that are already in the database with the same size and modification time are skipped, so an interrupted or
+# repeated run only parses what's new or changed, and rows for files under directory that no longer exist are removed
+# directory = directory to search for .ppm files, rows are stored under its real absolute path
+# databasePath = path of the SQLite database, it's created if it doesn't exist
+# processes = number of worker processes to use, defaults to the number of CPU cores
+# batchSize = number of files handed to the workers, and written to the database, at a time
+# Returns a dict of found, skipped, indexed, failed and removed file counts
+# Raises NotADirectoryError if directory isn't a directory, rather than removing every row for it
+def indexPpmFiles(directory, databasePath, processes=None, batchSize=10000):
+    if not os.path.isdir(directory):
+        raise NotADirectoryError("not a directory: {}".format(directory))
+    # Rows are keyed by path, so ./dir, dir and /abs/dir all have to give the same paths to be found again on a rescan
+    directory = os.path.realpath(directory)
+    processes = processes or os.cpu_count() or 1
+    database = sqlite3.connect(databasePath)
+    counts = {"found": 0, "skipped": 0, "indexed": 0, "failed": 0, "removed": 0}
+    try:
+        database.execute("PRAGMA journal_mode=WAL")
+        database.execute("PRAGMA synchronous=NORMAL")
+        database.execute("CREATE TABLE IF NOT EXISTS flipnotes ({})".format(", ".join(name + " " + kind for name, kind in INDEX_COLUMNS)))
+        known = {path: (mtime, size) for path, mtime, size in database.execute("SELECT path, mtime_ns, size FROM flipnotes")}
+        insert = "INSERT OR REPLACE INTO flipnotes VALUES ({})".format(", ".join("?" * len(INDEX_COLUMNS)))
+
+        # Only rows for files under directory can be gone, the database may also hold other directories
+        prefix = os.path.join(directory, "")
+        missing = set(path for path in known if path.startswith(prefix))
+
+        def changedFiles():
+            for path, mtime, size in findPpmFiles(directory):
+                counts["found"] += 1
+                missing.discard(path)
+                if known.get(path) == (mtime, size):
+                    counts["skipped"] += 1
+                else:
+                    yield (path, mtime, size)
+
+        jobs = changedFiles()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # Work through the files a batch at a time, so millions of files never have to be queued up at once
+            while True:
+                batch = list(itertools.islice(jobs, batchSize))
+                if not batch:
+                    break
+                chunkSize = max(1, min(256, len(batch) // (processes * 4)))
+                rows = list(executor.map(_indexFile, batch, chunksize=chunkSize))
+                # Each batch is committed on its own, so an interrupted run keeps everything up to the last batch
+                with database:
+                    database.executemany(insert, rows)
+                counts["indexed"] += len(rows)
+                counts["failed"] += sum(1 for row in rows if row[3] is not None)
+        # Every file has been seen by now, so whatever is left was deleted or moved since the last run
+        with database:
+            database.executemany("DELETE FROM flipnotes WHERE path = ?", ((path,) for path in missing))
+        counts["removed"] = len(missing)
+    finally:
+        database.close()
+    return counts
+
+if __name__ == "__main__":
+
+    def representsInt(s):
+        try:
+            int(s)
+            return True
+        except ValueError:
+            return False
+
+    args = sys.argv[1::]
+
+    if "-v" in args:
+        print(VERSION)
+        sys.exit()
+
+    if "-h" in args or not args:
+        print("\n".join([
+            "",
+            "==========================",
+            "ppmParser.py version " + str(VERSION),
+            "==========================",
+            "",
+            "Parse metadata, thumbnails and sound tracks from Flipnote and Comment .ppm files, and index whole archives of them into SQLite",
+            "Originally written for Sudomemo (github.com/Sudomemo | www.sudomemo.net)",
+            "",
+            "Usage:",
+            "======",
+            "",
+            "Print the metadata of a PPM as JSON:",
+            "python3 ppmParser.py input_path",
+            "",
+            "Index every PPM in a directory tree into an SQLite database, using several processes:",
+            "python3 ppmParser.py -x input_dir database_path (-j processes)",
+            "",
+            "Running the indexer again only parses files that are new, or whose size or modification time have changed since they were last indexed,",
+            "and removes files that no longer exist from the database",
+            "",
+            "Convert the thumbnail of a PPM to a PNG:",
+            "python3 ppmParser.py -t input_path output_path",
+            "",
+            "Convert the thumbnails of every PPM in a directory tree to PNGs, using several processes:",
+            "python3 ppmParser.py -T input_dir output_dir (-j processes)",
+            "",
+            "Convert a sound track of a PPM to a WAV file, track can be BGM (the default), SE1, SE2 or SE3:",
+            "python3 ppmParser.py -a input_path output_path (track)",
+            "",
+            "Convert every sound track of every PPM in a directory tree to WAV files, using several processes:",
+            "python3 ppmParser.py -A input_dir output_dir (-j processes)",
+            "",
+            "Issues:",
+            "=======",
+            "",
+            "If you find any bugs in this script, please report them here:",
+            "https://github.com/Sudomemo/sudomemo-utils/issues",
+            ""
+        ]))
+        sys.exit()
+
+    processes = None
+
+    if "-j" in args:
+        jIndex = args.index("-j")
+        if jIndex + 1 >= len(args) or not representsInt(args[jIndex + 1]):
+            print("Error: -j must be followed by the number of processes to use")
+            sys.exit(1)
+        processes = int(args[jIndex + 1])
+        args = args[0:jIndex] + args[jIndex + 2::]
+
+    if "-x" in args:
+        xIndex = args.index("-x")
+        if xIndex + 2 >= len(args):
+            print("Error: index mode needs an input directory and a database path")
+            sys.exit(1)
+        startTime = perf_counter()
+        try:
+            counts = indexPpmFiles(args[xIndex + 1], args[xIndex + 2], processes=processes)
+        except NotADirectoryError as error:
+            print("Error: " + str(error))
+            sys.exit(1)
+        elapsed = max(perf_counter() - startTime, 1e-9)
+        print("Found {} files, indexed {} ({} failed), skipped {} unchanged and removed {} missing in {:.2f}s: {:.1f} files/s".format(
+            counts["found"], counts["indexed"], counts["failed"], counts["skipped"], counts["removed"], elapsed, counts["indexed"] / elapsed))
+        sys.exit(0)
+
+    if "-T" in args:
+        tIndex = args.index("-T")
+        if tIndex + 2 >= len(args):
+            print("Error: batch thumbnail mode needs an input directory and an output directory")
+            sys.exit(1)
+        startTime = perf_counter()
+        result = batchThumbnails(args[tIndex + 1], args[tIndex + 2], processes=processes)
+        elapsed = max(perf_counter() - startTime, 1e-9)
+        for path, error in result["errors"]:
+            print("Error converting {}: {}".format(path, error))
+        print("Converted {} thumbnails ({} failed) in {:.2f}s: {:.1f} thumbnails/s".format(
+            result["converted"], result["failed"], elapsed, result["converted"] / elapsed))
+        sys.exit(1 if result["failed"] else 0)
+
+    if "-A" in args:
+        aIndex = args.index("-A")
+        if aIndex + 2 >= len(args):
+            print("Error: batch audio mode needs an input directory and an output directory")
+            sys.exit(1)
+        startTime = perf_counter()
+        result = batchTracks(args[aIndex + 1], args[aIndex + 2], processes=processes)
+        elapsed = max(perf_counter() - startTime, 1e-9)
+        for path, error in result["errors"]:
+            print("Error converting {}: {}".format(path, error))
+        print("Converted {} tracks from {} files ({} failed) in {:.2f}s: {:.1f} files/s".format(
+            result["tracks"], result["files"], result["failed"], elapsed, result["files"] / elapsed))
+        sys.exit(1 if result["failed"] else 0)
+
+    if "-a" in args:
+        aIndex = args.index("-a")
+        if aIndex + 2 >= len(args):
+            print("Error: audio mode needs an input path and an output path")
+            sys.exit(1)
+        track = args[aIndex + 3].upper() if aIndex + 3 < len(args) else "BGM"
+        if track not in TRACKS:
+            print("Error: track must be one of " + ", ".join(TRACKS))
+            sys.exit(1)
+        with ppmParser() as parser:
+            if not parser.open(args[aIndex + 1]):
+                print("Error parsing PPM: " + parser.error)
+                sys.exit(1)
+            try:
+                if not parser.saveTrackWav(track, args[aIndex + 2]):
+                    print("Error: the {} track isn't used".format(track))
+                    sys.exit(1)
+            except (struct.error, ValueError):
+                print("Error parsing PPM: not a valid PPM, the file is truncated")
+                sys.exit(1)
+        sys.exit(0)
+
+    if "-t" in args:
+        tIndex = args.index("-t")
+        if tIndex + 2 >= len(args):
+            print("Error: thumbnail mode needs an input path and an output path")
+            sys.exit(1)
+        with ppmParser() as parser:
+            if not parser.open(args[tIndex + 1]):
+                print("Error parsing PPM: " + parser.error)
+                sys.exit(1)
+            try:
+                thumbnail = parser.getThumbnail()
+            except (struct.error, ValueError):
+                print("Error parsing PPM: not a valid PPM, the file is truncated")
+                sys.exit(1)
+            Image.fromarray(thumbnail).save(args[tIndex + 2], "PNG")
+        sys.exit(0)
+
+    with ppmParser() as parser:
+        if not parser.open(args[0]):
+            print("Error parsing PPM: " + parser.error)
+            sys.exit(1)
+        # Truncated files get past open, which only reads the header, and fail once the fields past the end are unpacked
+        try:
+            meta = parser.formatMeta()
+            meta["valid"] = parser.isMetaValid(meta)
+            meta["frame_table_valid"] = parser.isFrameTableValid()
+            meta["blank_comment"] = parser.isBlankComment()
+        except (struct.error, ValueError):
+            print("Error parsing PPM: not a valid PPM, the file is truncated")
+            sys.exit(1)
+        print(json.dumps(meta, indent=2, ensure_ascii=False))
@@ -0,0 +1,964 @@
+#!/usr/bin/python3
+
+# ============================
+# ugoBenchmark.py version 1.0.0
+# ============================
+#
+# Benchmarks for the codec paths in ugoImage.py, the sound track decoder in ppmParser.py, and the menu builder in ugomenu.py
+#
+# The fast paths are first checked against reference implementations (same output, and no worse quality for the quantizer),
+# and the caches, async and worker front ends, batch converter, streaming decoders and PPM indexer against the plain code paths,
+# then every decode and encode path is timed on synthetic images of a few realistic sizes, along with its peak memory use.
+# Results can be written to a JSON file, and compared against a baseline file from an earlier run to catch regressions.
+#
+# Usage:
+# ======
+#
+# Run the checks and benchmarks:
+# python3 ugoBenchmark.py
+#
+# Only run the checks, skipping the codec, audio and menu benchmarks:
+# python3 ugoBenchmark.py -k
+#
+# Save the results as a baseline:
+# python3 ugoBenchmark.py -o baseline.json
+#
+# Compare against a baseline, exiting with an error if anything got more than 25% slower or bigger:
+# python3 ugoBenchmark.py -c baseline.json (-t 0.25) (-o results.json)
+#
+# A baseline is kept in fixtures/benchmark/baseline.json, along with the machine, Python and library versions it was recorded with.
+# Timings only compare well on the same machine, so refresh it there before comparing, and again whenever the code gets faster on purpose:
+# python3 ugoBenchmark.py -o fixtures/benchmark/baseline.json
+# On shared or otherwise noisy machines, raise -t until repeated runs of unchanged code pass
+#
+# Issues:
+# =======
+#
+# If you find any bugs in this script, please report them here:
+# https://github.com/Sudomemo/sudomemo-utils/issues
+#
+# Requirements:
+#   - Python 3
+#       Installation: https://www.python.org/downloads/
+#   - The Pillow Image Library (https://python-pillow.org/)
+#       Installation: http://pillow.readthedocs.io/en/3.0.x/installation.html
+#   - NumPy (http://www.numpy.org/)
+#       Installation: https://www.scipy.org/install.html
+
+from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+import os, sys, json, wave, base64, struct, sqlite3, asyncio, tempfile, platform, tracemalloc, PIL
+
+from ugoImage import ugoImage, ugoImageCache, ugoConversionCache, ugoImageAsync, ugoImageBusyError, ugoImageWorker, probe, probeFiles, findFlipnoteImages, convertFile, convertBytes, findBatchJobs, batchConvert, unpackColor, packColor, unpackColors, packColors, quantizeColors, VERSION as UGOIMAGE_VERSION
+from ppmParser import ppmParser, adpcmDecoder, decodeThumbnails, indexPpmFiles, META, META_OFFSET, FLAGS_OFFSET, ADPCM_STEP_TABLE, ADPCM_INDEX_TABLE, ADPCM_SAMPLE_RATE, TMB_LENGTH, THUMBNAIL_OFFSET, THUMBNAIL_LENGTH, THUMBNAIL_PALETTE, VERSION as PPMPARSER_VERSION
+from ugomenu import ugomenu, ugomenuCache, TYPES as UGOMENU_TYPES, VERSION as UGOMENU_VERSION
+
+VERSION = "1.0.0"
+
+# Fail a correctness check, the same way with or without python -O
+# Raises RuntimeError with the message if condition is false
+def expect(condition, message):
+    if not condition:
+        raise RuntimeError(message)
+
+# Reference implementations of the array color conversions, one Python call per pixel
+referenceUnpackColors = np.vectorize(unpackColor, otypes=[">u4"])
+
+def referencePackColors(colors, useAlpha=True):
+    return np.apply_along_axis(packColor, 1, colors, useAlpha=useAlpha).astype(np.uint16)
+
+# Reference implementation of ugoImage.writeNpf, packing one pair of pixels per Python loop iteration
+def referenceWriteNpf(ugo, outputBuffer):
+    alphamap = ugo.image.split()[-1]
+    image = ugo._limitImageColors(ugo.image, paletteSlots=15)
+    palette = np.reshape(image.getpalette(), (-1, 3))[0:15]
+    paletteData = packColors(palette, useAlpha=False)
+    paletteData = np.insert(paletteData, 0, 0)
+    imageData = np.array(image.getdata(), dtype=np.uint8)
+    imageData = ugo._padImageData(imageData, image.size)
+    alphamap = ugo._padImageData(np.asarray(alphamap).flatten(), image.size)
+    imageData = np.reshape(imageData, (-1, 2))
+    alphamap = np.reshape(alphamap, (-1, 2))
+    imageData = np.array([(pix[0]+1 if a[0] > 128 else 0) | ((pix[1]+1 if a[1] > 128 else 0) << 4) for a, pix in zip(alphamap, imageData)], dtype=np.uint8)
+    ugo._writeUgarHeader(outputBuffer, paletteData.nbytes, imageData.nbytes)
+    outputBuffer.write(paletteData.tobytes())
+    outputBuffer.write(imageData.tobytes())
+
+# Generate a set of sample images covering the cases the encoders need to handle
+# Returns a list of (name, PIL Image) tuples
+def sampleImages():
+    rng = np.random.default_rng(0)
+    samples = []
+    for width, height in [(32, 32), (64, 48), (100, 60), (256, 192), (200, 120)]:
+        # Random noise, with a mix of opaque, transparent and half-transparent pixels
+        noise = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+        samples.append(("noise {}x{}".format(width, height), Image.fromarray(noise, "RGBA")))
+        # Smooth gradients, with a transparent hole in the middle
+        y, x = np.mgrid[0:height, 0:width]
+        gradient = np.stack((x * 255 // max(width - 1, 1), y * 255 // max(height - 1, 1), (x + y) * 255 // (width + height), np.full_like(x, 255)), axis=-1).astype(np.uint8)
+        gradient[height // 4:height // 2, width // 4:width // 2, 3] = 0
+        samples.append(("gradient {}x{}".format(width, height), Image.fromarray(gradient, "RGBA")))
+        # Flat blocks of a few colors, like most theme art
+        blocks = rng.integers(0, 256, ((height + 7) // 8, (width + 7) // 8, 4), dtype=np.uint8)
+        blocks[..., 3] = np.where(blocks[..., 3] > 64, 255, 0)
+        blocks = np.repeat(np.repeat(blocks, 8, axis=0), 8, axis=1)[0:height, 0:width]
+        samples.append(("blocks {}x{}".format(width, height), Image.fromarray(np.ascontiguousarray(blocks), "RGBA")))
+    return samples
+
+# Time a function call
+# func = function to call with no arguments
+# repeat = number of times to call it
+# Returns the fastest call time in seconds
+def timeCall(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# Print a line comparing the reference and fast timings
+def printResult(name, referenceTime, fastTime):
+    print("{:<32} reference {:>10.2f} ms   fast {:>8.3f} ms   {:>8.1f}x".format(name, referenceTime * 1000, fastTime * 1000, referenceTime / fastTime))
+
+# Compare unpackColors and packColors against the per-pixel reference implementations
+def benchColors(width=256, height=192):
+    rng = np.random.default_rng(0)
+    # Every possible abgr1555 value must unpack the same way
+    allColors = np.arange(0x10000, dtype=np.uint16)
+    for useAlpha in (True, False):
+        expect(np.array_equal(unpackColors(allColors, useAlpha=useAlpha), referenceUnpackColors(allColors, useAlpha=useAlpha)), "unpackColors mismatch")
+    # Every channel level must pack the same way, and both sides of the alpha threshold
+    levels = np.arange(256)
+    rgba = np.stack((levels, levels[::-1], np.roll(levels, 85), levels), axis=-1)
+    for useAlpha in (True, False):
+        expect(np.array_equal(packColors(rgba, useAlpha=useAlpha), referencePackColors(rgba, useAlpha=useAlpha)), "packColors mismatch")
+    # Time the conversion of a full image
+    pixels = rng.integers(0, 0x10000, width * height, dtype=np.uint16)
+    colors = rng.integers(0, 256, (width * height, 4))
+    expect(np.array_equal(packColors(colors), referencePackColors(colors)), "packColors mismatch")
+    size = "{}x{}".format(width, height)
+    printResult("unpackColors " + size, timeCall(lambda: referenceUnpackColors(pixels, useAlpha=True), repeat=1), timeCall(lambda: unpackColors(pixels, useAlpha=True)))
+    printResult("packColors " + size, timeCall(lambda: referencePackColors(colors, useAlpha=True), repeat=1), timeCall(lambda: packColors(colors, useAlpha=True)))
+
+# Reference implementation of adpcmDecoder, decoding one sample per Python loop iteration
+def referenceDecodeAdpcm(data):
+    predictor = 0
+    stepIndex = 0
+    samples = []
+    for byte in bytes(data):
+        for nibble in [byte & 0x0F, byte >> 4]:
+            step = int(ADPCM_STEP_TABLE[stepIndex])
+            diff = step >> 3
+            if nibble & 1:
+                diff += step >> 2
+            if nibble & 2:
+                diff += step >> 1
+            if nibble & 4:
+                diff += step
+            if nibble & 8:
+                diff = -diff
+            predictor = min(max(predictor + diff, -32768), 32767)
+            stepIndex = min(max(stepIndex + int(ADPCM_INDEX_TABLE[nibble]), 0), len(ADPCM_STEP_TABLE) - 1)
+            samples.append(predictor)
+    return np.array(samples, dtype=np.int16)
+
+# Generate synthetic ADPCM track data
+# Quiet tracks keep to small nibbles, loud ones use every nibble and clip often
+# Returns bytes
+def syntheticTrack(byteCount, loud=True, seed=0):
+    rng = np.random.default_rng(seed)
+    if loud:
+        return rng.integers(0, 256, byteCount, dtype=np.uint8).tobytes()
+    return (rng.integers(0, 4, byteCount) | rng.integers(8, 12, byteCount) << 4).astype(np.uint8).tobytes()
+
+# Compare adpcmDecoder against the reference decoder, for tracks decoded whole and a chunk at a time
+def benchAdpcm():
+    tracks = [("quiet", syntheticTrack(20000, loud=False)), ("loud", syntheticTrack(20000)), ("clipping", bytes([0x77] * 5000 + [0xFF] * 5000))]
+    for name, track in tracks:
+        reference = referenceDecodeAdpcm(track)
+        for chunkSize in [1, 333, len(track)]:
+            decoder = adpcmDecoder()
+            decoded = np.concatenate([decoder.decode(track[start:start + chunkSize]) for start in range(0, len(track), chunkSize)])
+            expect(np.array_equal(decoded, reference), "adpcmDecoder output differs for {} track in chunks of {}".format(name, chunkSize))
+    name, track = tracks[1]
+    printResult("adpcm decode {}s".format(len(track) * 2 // ADPCM_SAMPLE_RATE), timeCall(lambda: referenceDecodeAdpcm(track), repeat=1), timeCall(lambda: adpcmDecoder().decode(track)))
+
+# Reference implementation of decodeThumbnails, decoding one byte of one 8 * 8 tile per Python loop iteration
+# Returns a 48 * 64 * 3 RGB array
+def referenceDecodeThumbnail(data):
+    image = np.zeros((48, 64, 3), dtype=np.uint8)
+    offset = 0
+    for tileY in range(0, 48, 8):
+        for tileX in range(0, 64, 8):
+            for y in range(8):
+                for x in range(0, 8, 2):
+                    byte = data[offset]
+                    image[tileY + y, tileX + x] = THUMBNAIL_PALETTE[byte & 0x0F]
+                    image[tileY + y, tileX + x + 1] = THUMBNAIL_PALETTE[byte >> 4]
+                    offset += 1
+    return image
+
+# Compare decodeThumbnails against the reference decoder, for every way it can be given thumbnails
+def benchThumbnails(count=64):
+    rng = np.random.default_rng(0)
+    tmbs = rng.integers(0, 256, (count, TMB_LENGTH), dtype=np.uint8)
+    thumbnails = tmbs[:, THUMBNAIL_OFFSET:THUMBNAIL_OFFSET + THUMBNAIL_LENGTH]
+    reference = np.stack([referenceDecodeThumbnail(thumbnail.tobytes()) for thumbnail in thumbnails])
+    inputs = [
+        ("TMB array", lambda: decodeThumbnails(tmbs)),
+        ("thumbnail array", lambda: decodeThumbnails(np.ascontiguousarray(thumbnails))),
+        ("TMB bytes", lambda: decodeThumbnails(tmbs.tobytes(), count=count)),
+        ("thumbnail bytes", lambda: decodeThumbnails(thumbnails.tobytes(), count=count)),
+        ("TMB list", lambda: decodeThumbnails([tmb.tobytes() for tmb in tmbs])),
+        ("thumbnail list", lambda: decodeThumbnails([thumbnail.tobytes() for thumbnail in thumbnails])),
+    ]
+    for name, decode in inputs:
+        expect(np.array_equal(decode(), reference), "decodeThumbnails output differs for " + name)
+    # A length that doesn't match the count has to be rejected, rather than decoded as some other number of thumbnails
+    try:
+        decodeThumbnails(tmbs.tobytes()[:-1], count=count)
+    except ValueError:
+        pass
+    else:
+        raise RuntimeError("decodeThumbnails accepted data of the wrong length")
+    printResult("thumbnail decode x{}".format(count), timeCall(lambda: [referenceDecodeThumbnail(thumbnail.tobytes()) for thumbnail in thumbnails], repeat=1), timeCall(lambda: decodeThumbnails(tmbs)))
+
+# Build a PPM with only the parts needed to decode its sound, with the given BGM track data
+# Returns bytes
+def syntheticPpm(bgm):
+    frameData = bytes(112)
+    header = b"PARA" + len(frameData).to_bytes(4, "little") + len(bgm).to_bytes(4, "little") + bytes(2)
+    data = bytearray(header.ljust(0x06A0, b"\0") + frameData + bytes(1))
+    data.extend(bytes(-len(data) % 4))
+    data.extend(len(bgm).to_bytes(4, "little") + bytes(12))
+    data.extend(bytes(16))
+    return bytes(data) + bgm
+
+# isset($args[name]) ? $args[name] : default
+def orDefault(value, default):
+    return value if value is not None else default
+
+# Reference implementation of ugomenu, a line for line copy of php/class.ugomenu.php that builds everything on every getUGO call
+class referenceUgomenu:
+
+    def __init__(self):
+        self.meta = {}
+        self.menu = {}
+        self.embeds = []
+
+    def writeLabel(self, text):
+        return base64.b64encode(str(text).encode("utf-16-le")).decode("ascii")
+
+    def setType(self, value):
+        self.meta["type"] = UGOMENU_TYPES.get(str(value))
+
+    def setMeta(self, value, text):
+        self.meta[value.lower()] = text
+
+    def addDropdown(self, url=None, label=None, selected=None):
+        self.menu.setdefault("dropdown", []).append({"url": orDefault(url, ""), "label": orDefault(label, ""), "selected": orDefault(selected, "0")})
+
+    def addButton(self, url=None, label=None):
+        self.menu.setdefault("button", []).append({"url": orDefault(url, ""), "label": orDefault(label, "")})
+
+    def addItem(self, url=None, label=None, icon=None, counter=None, lock=None, unknown=None, file=None):
+        if file is not None:
+            self.addFile(file)
+            icon = len(self.embeds) - 1
+        self.menu.setdefault("item", []).append({"url": orDefault(url, ""), "label": orDefault(label, ""), "icon": orDefault(icon, "104"),
+                                                 "counter": orDefault(counter, ""), "lock": orDefault(lock, ""), "unknown": orDefault(unknown, "0")})
+
+    def addFile(self, path):
+        name = os.path.basename(path)
+        self.embeds.append({"ext": name.rsplit(".", 1)[1] if "." in name else "", "path": path})
+
+    def getUGO(self):
+        menuData = ["\t".join(["0", str(self.meta["type"]) if self.meta.get("type") is not None else "4"])]
+        if self.meta.get("upperlink") is not None:
+            menuData.append("\t".join(["1", "1", str(self.meta["upperlink"])]))
+        else:
+            menuData.append("\t".join(["1", "0"] + [self.writeLabel(self.meta[key]) if self.meta.get(key) is not None else ""
+                                                      for key in ["uppertitle", "uppersubleft", "uppersubright", "uppersubtop", "uppersubbottom"]]))
+        for item in self.menu.get("dropdown", []):
+            menuData.append("\t".join(map(str, ["2", item["url"], self.writeLabel(item["label"]), item["selected"]])))
+        for item in self.menu.get("button", []):
+            menuData.append("\t".join(map(str, ["3", item["url"], self.writeLabel(item["label"])])))
+        for item in self.menu.get("item", []):
+            menuData.append("\t".join(map(str, ["4", item["url"], item["icon"], self.writeLabel(item["label"]), item["counter"], item["lock"], item["unknown"]])))
+        menuData = "\n".join(menuData)
+        # mb_strlen counts characters, but str_pad pads bytes
+        sectionTable = [len(menuData)]
+        menuData = menuData.encode("utf-8")
+        menuData = menuData.ljust(-(-sectionTable[0] // 4) * 4, b"\0")
+        if self.embeds:
+            sectionTable.append(sum(1696 if item["ext"] == "ppm" else 2048 for item in self.embeds))
+        ret = struct.pack("<4sI", b"UGAR", len(sectionTable))
+        for length in sectionTable:
+            ret += struct.pack("<I", length)
+        ret += menuData
+        for item in self.embeds:
+            with open(item["path"], "rb") as file:
+                if item["ext"] == "ppm":
+                    ret += file.read(1696)
+                elif item["ext"] == "ntft":
+                    ret += file.read(2048)
+        return ret
+
+# Build the same menu with a menu builder class
+# directory = directory containing the files named in fileNames, to embed
+# itemCount = number of items, every one of them with an embedded file if fileNames is given
+# Returns the menu object
+def buildMenu(menuClass, directory, itemCount=50, fileNames=(), layout="grid", **options):
+    menu = menuClass(**options)
+    menu.setType(layout)
+    menu.setMeta("UpperTitle", "Flipnotes \u3075\u308a\u3063\u3077\u306e\u30fc\u3068")
+    menu.setMeta("uppersubbottom", "Page 1 of 20")
+    for index, label in enumerate(["Most Popular", "Recent", "Featured \u2605"]):
+        menu.addDropdown(url="http://flipnote.hatena.com/ds/v2-xx/feed/{}.uls".format(index), label=label, selected="1" if index == 1 else None)
+    menu.addButton(url="http://flipnote.hatena.com/ds/v2-xx/post.reply", label="Post Here")
+    for index in range(itemCount):
+        item = {"url": "http://flipnote.hatena.com/ds/v2-xx/movie/{}.ppm".format(index), "label": "Item {} \u00e9".format(index % 10), "counter": str(index * 3), "lock": "1" if index % 7 == 0 else None}
+        if fileNames:
+            item["file"] = os.path.join(directory, fileNames[index % len(fileNames)])
+        menu.addItem(**item)
+    return menu
+
+# Write the files the menu checks and benchmarks embed: PPMs, NTFTs, a short NTFT and a file with an extension that isn't embedded
+# Returns a list of the file names
+def writeMenuFiles(directory):
+    rng = np.random.default_rng(0)
+    fileNames = ["thumb{}.ppm".format(index) for index in range(8)] + ["icon.ntft", "short.ntft", "odd.nbf"]
+    for name, length in zip(fileNames, [4000] * 8 + [2048, 100, 10]):
+        with open(os.path.join(directory, name), "wb") as outfile:
+            outfile.write(rng.integers(0, 256, length, dtype=np.uint8).tobytes())
+    return fileNames
+
+# Compare ugomenu against the reference class, for fresh menus and for a menu that was changed after being built
+def checkUgomenu():
+    with tempfile.TemporaryDirectory() as directory:
+        fileNames = writeMenuFiles(directory)
+        # Menus covering every section, non-ASCII text that makes the character and byte lengths differ, and odd embeds
+        checks = [
+            lambda menuClass: buildMenu(menuClass, directory),
+            lambda menuClass: buildMenu(menuClass, directory, fileNames=fileNames),
+            lambda menuClass: buildMenu(menuClass, directory, itemCount=0, layout="bogus"),
+        ]
+        for index, check in enumerate(checks):
+            expect(check(ugomenu).getUGO() == check(referenceUgomenu).getUGO(), "ugomenu output differs for check {}".format(index))
+        menu = buildMenu(ugomenu, directory, fileNames=fileNames)
+        menu.getUGO()
+        menu.setMeta("upperlink", "http://flipnote.hatena.com/ds/v2-xx/top.nbf")
+        menu.addItem(label="Next page", url="http://flipnote.hatena.com/ds/v2-xx/page2.uls", icon="105")
+        reference = buildMenu(referenceUgomenu, directory, fileNames=fileNames)
+        reference.setMeta("upperlink", "http://flipnote.hatena.com/ds/v2-xx/top.nbf")
+        reference.addItem(label="Next page", url="http://flipnote.hatena.com/ds/v2-xx/page2.uls", icon="105")
+        expect(menu.getUGO() == reference.getUGO(), "ugomenu output differs after changing a built menu")
+    # The menu built by fixtures/ugomenu/build.php, checked against the output of running it with PHP
+    fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "ugomenu")
+    menu = ugomenu(cache=ugomenuCache())
+    menu.setType("grid")
+    menu.setMeta("UpperTitle", "Café — ☆")
+    menu.setMeta("uppersubbottom", "page 1")
+    menu.addDropdown(url="http://flipnote.hatena.com/ds/v2-xx/recent.uls", label="Recent", selected="1")
+    menu.addDropdown(url="http://flipnote.hatena.com/ds/v2-xx/popular.uls", label="Most popular")
+    menu.addButton(url="http://flipnote.hatena.com/ds/v2-xx/post.reply", label="Post")
+    menu.addItem(url="http://flipnote.hatena.com/ds/v2-xx/café.htm", label="Café", counter=12, lock="1")
+    menu.addItem(url="http://flipnote.hatena.com/ds/v2-xx/icon.htm", file=os.path.join(fixtureDir, "icon.ntft"))
+    menu.addItem(label="日本語")
+    menu.addItem(url="http://flipnote.hatena.com/ds/v2-xx/thumb.htm", file=os.path.join(fixtureDir, "thumb.ppm"), counter=3)
+    menu.addItem(url="http://flipnote.hatena.com/ds/v2-xx/odd.htm", file=os.path.join(fixtureDir, "odd.nbf"), unknown=1)
+    with open(os.path.join(fixtureDir, "expected.ugo"), "rb") as infile:
+        expect(menu.getUGO() == infile.read(), "ugomenu output differs from fixtures/ugomenu/expected.ugo")
+
+# Time building a menu for each request, with the reference builder and with ugomenu
+def benchUgomenu():
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        fileNames = writeMenuFiles(directory)
+
+        def record(name, func):
+            seconds, peakBytes = measure(func)
+            results[name] = {"seconds": seconds, "requestsPerSecond": 1 / seconds, "peakBytes": peakBytes}
+            print("{:<32} {:>10.3f} ms {:>10.0f} req/s {:>10.1f} KB peak".format(name, seconds * 1000, 1 / seconds, peakBytes / 1024))
+
+        for menuName, names in [("list", ()), ("grid", fileNames[0:8])]:
+            cache = ugomenuCache()
+            # A menu built from scratch for every request, as it is now
+            record("ugomenu reference " + menuName, lambda: buildMenu(referenceUgomenu, directory, fileNames=names).getUGO())
+            # A new menu for every request, sharing the cache of labels and embedded files
+            record("ugomenu rebuild " + menuName, lambda: buildMenu(ugomenu, directory, fileNames=names, cache=cache).getUGO())
+            # One menu kept around and served again, which only checks its embedded files for changes
+            served = buildMenu(ugomenu, directory, fileNames=names, cache=cache)
+            record("ugomenu reuse " + menuName, lambda: served.getUGO())
+    return results
+
+# Compare ugoImage.writeNpf against the reference encoder
+def benchNpfEncode():
+    samples = sampleImages()
+    ugo = ugoImage()
+    # The reference encoder uses Pillow's quantizer
+    ugo.quantizer = "pillow"
+    for name, sample in samples:
+        ugo.image = sample
+        referenceBuffer = BytesIO()
+        fastBuffer = BytesIO()
+        referenceWriteNpf(ugo, referenceBuffer)
+        ugo.writeNpf(fastBuffer)
+        expect(referenceBuffer.getvalue() == fastBuffer.getvalue(), "writeNpf output differs for " + name)
+    # Time the encoder on the largest sample
+    name, ugo.image = max(samples, key=lambda sample: sample[1].width * sample[1].height)
+    printResult("writeNpf " + name, timeCall(lambda: referenceWriteNpf(ugo, BytesIO()), repeat=1), timeCall(lambda: ugo.writeNpf(BytesIO())))
+
+# Mean squared error of the opaque pixels of an encoded image, compared to the source
+def encodeError(ugo, imageFormat):
+    buffer = BytesIO()
+    ugo.save(buffer, imageFormat)
+    decoded = ugoImage(buffer.getvalue(), imageFormat, ugo.image.width, ugo.image.height)
+    source = np.asarray(ugo.image, dtype=np.float64)
+    result = np.asarray(decoded.image, dtype=np.float64)
+    opaque = source[..., 3] > 128 if imageFormat == "npf" else np.ones(source.shape[0:2], dtype=bool)
+    return np.mean((source[..., 0:3] - result[..., 0:3])[opaque] ** 2)
+
+# Compare quantizeColors against Pillow's quantizer, for both speed and quality
+def benchQuantizer():
+    samples = sampleImages()
+    ugo = ugoImage()
+    for imageFormat in ["nbf", "npf"]:
+        for name, sample in samples:
+            ugo.image = sample
+            ugo.quantizer = "pillow"
+            referenceError = encodeError(ugo, imageFormat)
+            ugo.quantizer = "fast"
+            fastError = encodeError(ugo, imageFormat)
+            # The fast quantizer must never be noticeably worse than Pillow's
+            expect(fastError <= referenceError * 1.05, "quantizeColors is worse than Pillow for {} {} ({:.1f} vs {:.1f})".format(imageFormat, name, fastError, referenceError))
+    # Time the quantizers on the largest sample
+    name, image = max(samples, key=lambda sample: sample[1].width * sample[1].height)
+    for paletteSlots in [15, 256]:
+        printResult("quantize {} colors {}".format(paletteSlots, name.split(" ")[-1]), timeCall(lambda: ugo._limitImageColors(image, paletteSlots)), timeCall(lambda: quantizeColors(np.asarray(image.convert("RGB")), paletteSlots)))
+
+# Image sizes for the codec benchmarks
+# The sheet size isn't a power of two wide, so it also covers padding and clipping
+BENCHMARK_SIZES = [
+    ("icon", 32, 32),
+    ("thumbnail", 64, 48),
+    ("screen", 256, 192),
+    ("sheet", 1000, 600),
+]
+
+# Generate a synthetic image that looks roughly like theme art: gradients, flat shapes and transparent areas
+# Returns PIL Image with RGBA mode
+def syntheticImage(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack((x * 255 // max(width - 1, 1), y * 255 // max(height - 1, 1), (x + y) * 127 // (width + height) + 64, np.full_like(x, 255)), axis=-1)
+    # Scatter some flat colored rectangles over the gradient
+    for i in range(24):
+        top, left = rng.integers(0, height), rng.integers(0, width)
+        image[top:top + rng.integers(4, max(height // 4, 5)), left:left + rng.integers(4, max(width // 4, 5))] = rng.integers(0, 256, 4) | 0x80
+    # Cut a transparent band across the middle
+    image[height // 3:height // 3 + max(height // 8, 1), :, 3] = 0
+    return Image.fromarray(image.astype(np.uint8), "RGBA")
+
+# Measure a function call
+# func = function to call with no arguments
+# minTime = keep calling func until this many seconds have passed
+# Returns (fastest call time in seconds, peak memory traced during a call in bytes)
+def measure(func, minTime=0.2, maxRepeat=50):
+    func()
+    best = None
+    total = 0
+    repeat = 0
+    while (total < minTime and repeat < maxRepeat) or repeat < 3:
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        total += elapsed
+        repeat += 1
+    # Measure memory separately, since tracing slows everything down
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (best, peak)
+
+# Time decode and encode for every format, plus the color conversions and quantizers, at each benchmark size
+# Returns a dict mapping benchmark names to {"seconds", "megapixelsPerSecond", "peakBytes"}
+def benchCodecs():
+    results = {}
+
+    def record(name, pixelCount, func):
+        seconds, peakBytes = measure(func)
+        results[name] = {"seconds": seconds, "megapixelsPerSecond": pixelCount / seconds / 1e6, "peakBytes": peakBytes}
+        print("{:<32} {:>10.3f} ms {:>10.2f} MP/s {:>10.1f} KB peak".format(name, seconds * 1000, pixelCount / seconds / 1e6, peakBytes / 1024))
+
+    for sizeName, width, height in BENCHMARK_SIZES:
+        size = "{} {}x{}".format(sizeName, width, height)
+        pixelCount = width * height
+        source = ugoImage()
+        source.image = syntheticImage(width, height)
+        pixels = np.asarray(source.image)
+        packed = packColors(pixels.reshape(-1, 4))
+        record("unpackColors " + size, pixelCount, lambda: unpackColors(packed))
+        record("packColors " + size, pixelCount, lambda: packColors(pixels.reshape(-1, 4)))
+        record("quantize fast " + size, pixelCount, lambda: quantizeColors(pixels[..., 0:3], 256))
+        record("quantize pillow " + size, pixelCount, lambda: source._limitImageColors(source.image, 256))
+        for imageFormat in ["ntft", "nbf", "npf"]:
+            encoded = BytesIO()
+            source.save(encoded, imageFormat)
+            data = encoded.getvalue()
+            record("encode {} {}".format(imageFormat, size), pixelCount, lambda: source.save(BytesIO(), imageFormat))
+            # Decoding includes expanding to RGBA, since that's what most callers end up needing
+            record("decode {} {}".format(imageFormat, size), pixelCount, lambda: ugoImage(data, imageFormat, width, height).image)
+            # Pipelines that already work with NumPy arrays can skip Pillow entirely
+            record("encode array {} {}".format(imageFormat, size), pixelCount, lambda: ugoImage.fromArray(pixels).save(BytesIO(), imageFormat))
+            record("decode array {} {}".format(imageFormat, size), pixelCount, lambda: ugoImage(data, imageFormat, width, height).toArray())
+            record("thumbnail {} {}".format(imageFormat, size), pixelCount, lambda: ugoImage().loadThumbnail(data, imageFormat, width, height, maxSize=(64, 48), samples=2))
+            region = (width // 4, height // 4, max(1, width // 8), max(1, height // 8))
+            record("region {} {}".format(imageFormat, size), region[2] * region[3], lambda: ugoImage().loadRegion(data, imageFormat, width, height, region))
+        record("encode many " + size, pixelCount, lambda: source.saveMany([(BytesIO(), imageFormat) for imageFormat in ["ntft", "nbf", "npf"]]))
+    return results
+
+# Write to a file that throws the data away, so only the writer's own memory use gets measured
+def saveDiscarded(save):
+    with open(os.devnull, "wb") as outfile:
+        save(outfile)
+
+# Time sound track decoding, both to an array and streamed to a WAV file
+# Returns a dict mapping benchmark names to {"seconds", "megasamplesPerSecond", "peakBytes"}
+def benchAudio():
+    results = {}
+
+    def record(name, sampleCount, func):
+        seconds, peakBytes = measure(func)
+        results[name] = {"seconds": seconds, "megasamplesPerSecond": sampleCount / seconds / 1e6, "peakBytes": peakBytes}
+        print("{:<32} {:>10.3f} ms {:>10.2f} MS/s {:>10.1f} KB peak".format(name, seconds * 1000, sampleCount / seconds / 1e6, peakBytes / 1024))
+
+    # A few seconds is a typical sound effect, a minute is a long BGM track
+    for seconds in [4, 60]:
+        for loudness, loud in [("quiet", False), ("loud", True)]:
+            track = syntheticTrack(seconds * ADPCM_SAMPLE_RATE // 2, loud=loud)
+            parser = ppmParser(syntheticPpm(track))
+            size = "{} {}s".format(loudness, seconds)
+            record("adpcm decode " + size, len(track) * 2, lambda: parser.getTrackSamples("BGM"))
+            # Streaming keeps the peak down to one chunk, however long the track is
+            record("adpcm wav " + size, len(track) * 2, lambda: saveDiscarded(lambda outfile: parser.saveTrackWav("BGM", outfile)))
+    return results
+
+# Write a few small sample images in every Flipnote image format, at a size that needs padding
+# directory = directory to write them to
+# Returns a list of (path, format) tuples
+def writeSampleFiles(directory, width=100, height=60):
+    paths = []
+    for index, (name, image) in enumerate(sampleImages()[0:3]):
+        ugo = ugoImage()
+        ugo.image = image.resize((width, height))
+        for imageFormat in ["ntft", "nbf", "npf"]:
+            path = os.path.join(directory, "sample{}.{}".format(index, imageFormat))
+            with open(path, "wb") as outfile:
+                ugo.save(outfile, imageFormat)
+            paths.append((path, imageFormat))
+    return paths
+
+# Check that probe accepts good files and catches truncated ones, and that probeFiles gives the same answers in order
+def checkProbe():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = writeSampleFiles(directory)
+        for path, imageFormat in paths:
+            result = probe(path, imageWidth=100, imageHeight=60)
+            expect(result["valid"] and result["format"] == imageFormat, "probe rejected a good {} file: {}".format(imageFormat, result["errors"]))
+            with open(path, "rb") as infile:
+                truncated = infile.read()[:-1]
+            expect(not probe(truncated, imageFormat=imageFormat, imageWidth=100, imageHeight=60)["valid"], "probe accepted a truncated " + imageFormat)
+        found = list(findFlipnoteImages(directory))
+        expect(found == sorted(path for path, imageFormat in paths), "findFlipnoteImages missed or reordered files")
+        results = list(probeFiles(found + [os.path.join(directory, "missing.nbf")], imageWidth=100, imageHeight=60, threads=2))
+        expect([path for path, result in results[:-1]] == found, "probeFiles results are out of order")
+        expect(all(result["valid"] for path, result in results[:-1]), "probeFiles rejected a good file")
+        expect(not results[-1][1]["valid"] and results[-1][1]["errors"], "probeFiles didn't report a missing file")
+
+# Check that ugoImageCache hands out independent copies of the same image, and that ugoConversionCache skips repeat conversions
+def checkCaches():
+    with tempfile.TemporaryDirectory() as directory:
+        path, imageFormat = writeSampleFiles(directory)[1]
+        expected = ugoImage(path, imageFormat=imageFormat, imageWidth=100, imageHeight=60).toArray()
+        cache = ugoImageCache()
+        first = cache.load(path, imageWidth=100, imageHeight=60)
+        first.image = Image.new("RGBA", (100, 60))
+        second = cache.load(path, imageWidth=100, imageHeight=60)
+        expect(np.array_equal(second.toArray(), expected), "ugoImageCache returned an image changed by an earlier caller")
+        expect(cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1, "ugoImageCache didn't reuse its entry")
+        smallCache = ugoImageCache(maxBytes=cache.stats()["bytes"])
+        for samplePath, sampleFormat in writeSampleFiles(directory)[0:3]:
+            smallCache.load(samplePath, imageWidth=100, imageHeight=60)
+        expect(smallCache.stats()["bytes"] <= smallCache.maxBytes and smallCache.stats()["evictions"] > 0, "ugoImageCache went over its size limit")
+
+        conversionCache = ugoConversionCache(os.path.join(directory, "cache"))
+        key = conversionCache.key(path, imageFormat, "png", 100, 60)
+        expect(key != conversionCache.key(path, imageFormat, "gif", 100, 60), "ugoConversionCache key ignores the output format")
+        expect(conversionCache.get(key) is None, "ugoConversionCache returned a result that was never stored")
+        outputPath = os.path.join(directory, "out", "sample.png")
+        expect(not convertFile(path, outputPath, 100, 60, conversionCache=conversionCache), "convertFile used a cached result on the first run")
+        with open(outputPath, "rb") as infile:
+            converted = infile.read()
+        expect(convertFile(path, outputPath, 100, 60, conversionCache=conversionCache), "convertFile didn't use the cached result")
+        with open(outputPath, "rb") as infile:
+            expect(infile.read() == converted == conversionCache.get(key), "cached conversion output differs")
+        expect(conversionCache.key(conversionCache.inputDigest(path), imageFormat, "png", 100, 60) == key, "ugoConversionCache key differs for a hashed input")
+        # Pruning keeps the most recently used results that fit, and a result that was read counts as used
+        oldKeys = [conversionCache.key(bytes([index]), "png", "png") for index in range(8)]
+        for index, oldKey in enumerate(oldKeys):
+            conversionCache.put(oldKey, bytes(1000))
+            os.utime(conversionCache._path(oldKey), ns=(index * 10 ** 9, index * 10 ** 9))
+        os.utime(conversionCache._path(key), ns=(0, 0))
+        conversionCache.get(key)
+        conversionCache.maxBytes = 3000 + len(converted)
+        expect(conversionCache.prune() == 5, "ugoConversionCache pruned the wrong number of results")
+        kept = [oldKey for oldKey in oldKeys + [key] if conversionCache.get(oldKey) is not None]
+        expect(kept == oldKeys[5:] + [key], "ugoConversionCache pruned the wrong results")
+
+# Check that ugoImageAsync converts the same as convertBytes, and turns away requests past maxPending
+def checkAsync():
+    with tempfile.TemporaryDirectory() as directory:
+        path, imageFormat = writeSampleFiles(directory)[2]
+        with open(path, "rb") as infile:
+            inputData = infile.read()
+    expected = convertBytes(inputData, imageFormat, "png", 100, 60)
+
+    async def run():
+        async with ugoImageAsync(maxConcurrent=1, maxPending=2) as converter:
+            expect(await converter.convertAsync(inputData, imageFormat, "png", 100, 60) == expected, "convertAsync output differs")
+            image = await converter.loadAsync(BytesIO(inputData), imageFormat, 100, 60)
+            expect(await converter.saveAsync(image, None, "png") == expected, "loadAsync and saveAsync output differs")
+            results = await asyncio.gather(*[converter.convertAsync(inputData, imageFormat, "png", 100, 60) for i in range(4)], return_exceptions=True)
+            expect(sum(1 for result in results if isinstance(result, ugoImageBusyError)) == 2, "ugoImageAsync didn't turn away requests past maxPending")
+            expect(converter.stats()["pending"] == 0 and converter.stats()["running"] == 0, "ugoImageAsync didn't give back its slots")
+        # Requests that fail to be submitted have to give their slots back too
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.shutdown()
+        async with ugoImageAsync(executor=executor, maxConcurrent=1, maxPending=2) as converter:
+            for i in range(4):
+                try:
+                    await asyncio.wait_for(converter.convertAsync(inputData, imageFormat, "png", 100, 60), 10)
+                except (ugoImageBusyError, asyncio.TimeoutError):
+                    raise RuntimeError("ugoImageAsync kept the slots of requests that failed to submit")
+                except RuntimeError:
+                    pass
+            expect(converter.stats()["pending"] == 0 and converter.stats()["running"] == 0, "ugoImageAsync didn't give back the slots of failed requests")
+
+    asyncio.run(run())
+
+# Check that ugoImageWorker answers good and bad requests alike
+def checkWorker():
+    with tempfile.TemporaryDirectory() as directory:
+        path, imageFormat = writeSampleFiles(directory)[1]
+        with open(path, "rb") as infile:
+            inputData = infile.read()
+        requests = [
+            {"id": 1, "input": base64.b64encode(inputData).decode("ascii"), "inputFormat": imageFormat, "outputFormat": "png", "width": 100, "height": 60},
+            {"id": 2, "inputPath": path, "outputPath": os.path.join(directory, "out.png"), "outputFormat": "png", "width": 100, "height": 60},
+            {"id": 3, "input": "", "inputFormat": imageFormat, "outputFormat": "png"},
+        ]
+        inputStream = BytesIO(b"".join(json.dumps(request).encode("utf-8") + b"\n" for request in requests) + b"not json\n")
+        outputStream = BytesIO()
+        worker = ugoImageWorker(processes=1)
+        try:
+            worker.serveStream(inputStream, outputStream)
+        finally:
+            worker.close()
+        responses = {response["id"]: response for response in map(json.loads, outputStream.getvalue().splitlines())}
+        expected = convertBytes(inputData, imageFormat, "png", 100, 60)
+        expect(responses[1]["ok"] and base64.b64decode(responses[1]["output"]) == expected, "ugoImageWorker output differs")
+        with open(os.path.join(directory, "out.png"), "rb") as infile:
+            expect(responses[2]["ok"] and infile.read() == expected, "ugoImageWorker didn't write outputPath")
+        expect(not responses[3]["ok"] and not responses[None]["ok"], "ugoImageWorker accepted a bad request")
+
+# Check that batchConvert writes the same output as converting each file on its own, reports bad files, and uses its cache
+def checkBatchConvert():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = writeSampleFiles(directory)
+        with open(os.path.join(directory, "broken.nbf"), "wb") as outfile:
+            outfile.write(b"UGAR")
+        # Neither a Flipnote animation nor a format Pillow can only save should be picked up
+        for fileName in ["movie.ppm", "document.pdf"]:
+            with open(os.path.join(directory, fileName), "wb") as outfile:
+                outfile.write(b"PARA")
+        outputDir = os.path.join(directory, "out")
+        cacheDir = os.path.join(directory, "cache")
+        jobs = findBatchJobs(directory, outputDir, outputFormat="png", imageWidth=100, imageHeight=60)
+        results = list(batchConvert(jobs, processes=2, cacheDir=cacheDir))
+        expect([result[0] for result in results] == [job[0] for job in jobs], "batchConvert results are out of order")
+        errors = [inputPath for inputPath, error, byteCount, cached, stats in results if error]
+        expect(errors == [os.path.join(directory, "broken.nbf")], "batchConvert errors were {}".format(errors))
+        for inputPath, outputPath, width, height in jobs:
+            if inputPath not in errors:
+                with open(inputPath, "rb") as infile, open(outputPath, "rb") as outfile:
+                    expect(outfile.read() == convertBytes(infile.read(), os.path.splitext(inputPath)[1][1:], "png", width, height), "batchConvert output differs for " + inputPath)
+        # Earlier outputs inside the source directory are not inputs
+        expect(findBatchJobs(directory, outputDir, outputFormat="png", imageWidth=100, imageHeight=60) == jobs, "findBatchJobs picked up its own outputs")
+        results = list(batchConvert(jobs, processes=2, cacheDir=cacheDir))
+        expect(all(cached for inputPath, error, byteCount, cached, stats in results if not error), "batchConvert didn't use its cache")
+
+# Check that iterRows and loadRegion decode the same pixels as a full load
+def checkRegions():
+    with tempfile.TemporaryDirectory() as directory:
+        for path, imageFormat in writeSampleFiles(directory):
+            expected = ugoImage(path, imageFormat=imageFormat, imageWidth=100, imageHeight=60).toArray()
+            rows = np.concatenate([pixels for y, pixels in ugoImage().iterRows(path, imageFormat, 100, 60, rowsPerChunk=7)])
+            expect(np.array_equal(rows, expected), "iterRows output differs for " + imageFormat)
+            for region in [(0, 0, 100, 60), (13, 5, 40, 31), (99, 59, 1, 1)]:
+                x, y, width, height = region
+                rows = np.concatenate([pixels for row, pixels in ugoImage().iterRows(path, imageFormat, 100, 60, rowsPerChunk=8, region=region)])
+                expect(np.array_equal(rows, expected[y:y + height, x:x + width]), "iterRows region output differs for {} {}".format(imageFormat, region))
+                ugo = ugoImage()
+                ugo.loadRegion(path, imageFormat, 100, 60, region)
+                expect(np.array_equal(ugo.toArray(), expected[y:y + height, x:x + width]), "loadRegion output differs for {} {}".format(imageFormat, region))
+        # Formats decoded by Pillow give the same rows, and leave the image iterRows was called on empty like the Flipnote formats do
+        path = os.path.join(directory, "sample.png")
+        sampleImages()[0][1].resize((37, 21)).save(path)
+        expected = ugoImage(path, imageFormat="png").toArray()
+        ugo = ugoImage()
+        rows = np.concatenate([pixels for y, pixels in ugo.iterRows(path, "png", rowsPerChunk=7)])
+        expect(np.array_equal(rows, expected), "iterRows output differs for png")
+        expect(ugo.pixelData is None and ugo.indexData is None and ugo._image is None, "iterRows loaded the png into the image it was called on")
+
+# Check that the writers give the same bytes whatever size of band they work through the image in
+# Covers odd and non-power-of-two widths with transparent areas, images loaded indexed, and a 1 pixel wide image whose NPF data
+# has an odd number of pixels
+def checkBandSizes():
+    rng = np.random.default_rng(0)
+    thin = rng.integers(0, 256, (7, 1, 4), dtype=np.uint8)
+    thin[..., 3] = np.where(thin[..., 3] > 128, 255, 0)
+    sources = [("1x7", ugoImage.fromArray(thin))]
+    for width, height in [(3, 5), (33, 17), (100, 60), (200, 120)]:
+        ugo = ugoImage()
+        ugo.image = syntheticImage(width, height)
+        sources.append(("{}x{}".format(width, height), ugo))
+        for imageFormat in ["nbf", "npf"]:
+            outputBuffer = BytesIO()
+            ugo.save(outputBuffer, imageFormat)
+            sources.append(("{}x{} indexed {}".format(width, height, imageFormat), ugoImage(outputBuffer.getvalue(), imageFormat=imageFormat, imageWidth=width, imageHeight=height)))
+    for name, ugo in sources:
+        for imageFormat in ["ntft", "nbf", "npf"]:
+            outputs = []
+            for bandPixels in [ugoImage.bandPixels, 16, 3]:
+                ugo.bandPixels = bandPixels
+                outputBuffer = BytesIO()
+                ugo.save(outputBuffer, imageFormat)
+                outputs.append(outputBuffer.getvalue())
+            del ugo.bandPixels
+            expect(all(output == outputs[0] for output in outputs), "{} output depends on the band size for {}".format(imageFormat, name))
+
+# Check that saveMany writes the same files as saving each format on its own
+def checkSaveMany():
+    for name, image in sampleImages()[0:6]:
+        imageFormats = ["ntft", "nbf", "npf", "png"]
+        ugo = ugoImage()
+        ugo.image = image
+        buffers = [BytesIO() for imageFormat in imageFormats]
+        ugo.saveMany(list(zip(buffers, imageFormats)))
+        for outputBuffer, imageFormat in zip(buffers, imageFormats):
+            single = BytesIO()
+            ugo.save(single, imageFormat)
+            expect(outputBuffer.getvalue() == single.getvalue(), "saveMany output differs for {} {}".format(imageFormat, name))
+
+# Build a PPM with metadata, on top of syntheticPpm
+# Returns bytes
+def syntheticMetaPpm(fsid=0x14E4C0A00B9A6F36, timestamp=400000000, bgm=bytes(64)):
+    data = bytearray(syntheticPpm(bgm))
+    name = "Test".encode("utf-16-le")
+    filename = bytes.fromhex("F78DA8") + b"14fd1ad9a1f2b" + struct.pack("<H", 5)
+    META.pack_into(data, META_OFFSET, 1, 2, name, name, name, fsid, fsid, filename, filename, fsid, timestamp)
+    struct.pack_into("<H", data, FLAGS_OFFSET, 2)
+    return bytes(data)
+
+# Check the PPM metadata reader against values written into a synthetic PPM
+def checkPpmMeta():
+    meta = ppmParser(syntheticMetaPpm()).getMeta()
+    expect(meta is not None, "getMeta rejected valid metadata")
+    expected = {"lock": 1, "loop": 1, "frame_count": 1, "thumb_index": 2, "timestamp": 400000000, "unix_timestamp": 1346684800}
+    expect(all(meta[key] == value for key, value in expected.items()), "getMeta returned {}".format(meta))
+    expect(meta["current"] == {"username": "Test", "fsid": "14E4C0A00B9A6F36", "filename": "F78DA8_14FD1AD9A1F2B_005"}, "getMeta returned {}".format(meta["current"]))
+    expect(meta["track_usage"] == {"BGM": True, "SE1": False, "SE2": False, "SE3": False}, "getMeta returned {}".format(meta["track_usage"]))
+    expect(ppmParser(syntheticMetaPpm(fsid=0xFFFFFFFFFFFFFFFF)).getMeta() is None, "getMeta accepted an invalid FSID")
+    parser = ppmParser(b"PARB" + bytes(32))
+    expect(parser.error == "not a valid PPM", "ppmParser opened a file with the wrong magic")
+
+# Check that indexPpmFiles only parses new and changed files when run again, and forgets files that are gone
+def checkIndexResume():
+    with tempfile.TemporaryDirectory() as directory:
+        # Rows are stored under real paths, which the temporary directory's path might not be
+        directory = os.path.realpath(directory)
+        os.makedirs(os.path.join(directory, "ppm", "sub"))
+        paths = [os.path.join(directory, "ppm", name) for name in ["a.ppm", "b.ppm", os.path.join("sub", "c.ppm")]]
+        for index, path in enumerate(paths):
+            with open(path, "wb") as outfile:
+                outfile.write(syntheticMetaPpm(timestamp=index))
+        with open(os.path.join(directory, "ppm", "broken.ppm"), "wb") as outfile:
+            outfile.write(b"PARA")
+        databasePath = os.path.join(directory, "index.sqlite")
+        counts = indexPpmFiles(os.path.join(directory, "ppm"), databasePath, processes=2, batchSize=2)
+        expect(counts == {"found": 4, "skipped": 0, "indexed": 4, "failed": 1, "removed": 0}, "first index run counted {}".format(counts))
+        counts = indexPpmFiles(os.path.join(directory, "ppm"), databasePath, processes=2, batchSize=2)
+        expect(counts == {"found": 4, "skipped": 4, "indexed": 0, "failed": 0, "removed": 0}, "second index run counted {}".format(counts))
+        # Other spellings of the same directory find the same rows
+        relativeDirectory = os.path.relpath(os.path.join(directory, "ppm"))
+        for spelling in [relativeDirectory, os.path.join(".", relativeDirectory), os.path.join(directory, "ppm", "sub", "..", "")]:
+            counts = indexPpmFiles(spelling, databasePath, processes=2, batchSize=2)
+            expect(counts == {"found": 4, "skipped": 4, "indexed": 0, "failed": 0, "removed": 0}, "index run of {} counted {}".format(spelling, counts))
+        with open(paths[1], "wb") as outfile:
+            outfile.write(syntheticMetaPpm(timestamp=99, bgm=bytes(128)))
+        counts = indexPpmFiles(os.path.join(directory, "ppm"), databasePath, processes=2, batchSize=2)
+        expect(counts == {"found": 4, "skipped": 3, "indexed": 1, "failed": 0, "removed": 0}, "index run after a change counted {}".format(counts))
+        # Files that are gone are removed, but rows from other directories in the same database are left alone
+        os.remove(paths[2])
+        os.remove(os.path.join(directory, "ppm", "broken.ppm"))
+        os.makedirs(os.path.join(directory, "other"))
+        otherPath = os.path.join(directory, "other", "d.ppm")
+        with open(otherPath, "wb") as outfile:
+            outfile.write(syntheticMetaPpm(timestamp=3))
+        indexPpmFiles(os.path.join(directory, "other"), databasePath, processes=2)
+        counts = indexPpmFiles(os.path.join(directory, "ppm"), databasePath, processes=2, batchSize=2)
+        expect(counts == {"found": 2, "skipped": 2, "indexed": 0, "failed": 0, "removed": 2}, "index run after removing files counted {}".format(counts))
+        database = sqlite3.connect(databasePath)
+        try:
+            rows = dict(database.execute("SELECT path, timestamp FROM flipnotes"))
+        finally:
+            database.close()
+        expect(rows == {paths[0]: 0, paths[1]: 99, otherPath: 3}, "index holds {}".format(rows))
+
+# Write-only output that can't seek, like a pipe or a socket
+class unseekableOutput:
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+# Check that saveTrackWav writes a header matching the samples it writes, even when the file ends partway through the track
+def checkTrackWav():
+    for name, data in [("whole", syntheticPpm(syntheticTrack(5000))), ("truncated", syntheticPpm(syntheticTrack(5000))[:-1234])]:
+        parser = ppmParser(data)
+        output = unseekableOutput()
+        expect(parser.saveTrackWav("BGM", output, chunkSize=333), "saveTrackWav skipped a used track")
+        with wave.open(BytesIO(bytes(output.data))) as wav:
+            samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2")
+        expect(np.array_equal(samples, parser.getTrackSamples("BGM")), "saveTrackWav output differs for {} track".format(name))
+
+# Behavior checks run along with the reference checks, they don't time anything
+BEHAVIOR_CHECKS = [checkProbe, checkCaches, checkAsync, checkWorker, checkBatchConvert, checkRegions, checkBandSizes, checkSaveMany, checkPpmMeta, checkTrackWav, checkIndexResume, checkUgomenu]
+
+# Compare benchmark results against a baseline
+# tolerance = fraction a time or peak memory value can grow by before it counts as a regression
+# Returns a list of regression messages, empty if there were none
+def compareResults(results, baseline, tolerance=0.25):
+    # Changes smaller than these are timer and allocator noise, even if they're a large fraction of a tiny benchmark
+    noiseFloor = {"seconds": 0.0002, "peakBytes": 16 * 1024}
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key in ["seconds", "peakBytes"]:
+            before = baseline[name][key]
+            after = result[key]
+            if before > 0 and after > before * (1 + tolerance) and after - before > noiseFloor[key]:
+                regressions.append("{} {}: {:.4g} -> {:.4g} ({:+.0f}%)".format(name, key, before, after, (after / before - 1) * 100))
+    return regressions
+
+if __name__ == "__main__":
+    args = sys.argv[1::]
+    outputPath = args[args.index("-o") + 1] if "-o" in args else None
+    baselinePath = args[args.index("-c") + 1] if "-c" in args else None
+    tolerance = float(args[args.index("-t") + 1]) if "-t" in args else 0.25
+    checksOnly = "-k" in args
+
+    if "-h" in args:
+        print("\n".join([
+            "",
+            "=============================",
+            "ugoBenchmark.py version " + str(VERSION),
+            "=============================",
+            "",
+            "Run the checks and benchmarks:",
+            "python3 ugoBenchmark.py",
+            "",
+            "Only run the checks, skipping the codec, audio and menu benchmarks:",
+            "python3 ugoBenchmark.py -k",
+            "",
+            "Save the results as a baseline:",
+            "python3 ugoBenchmark.py -o baseline.json",
+            "",
+            "Compare against a baseline, exiting with an error if anything got more than 25% slower or bigger:",
+            "python3 ugoBenchmark.py -c baseline.json (-t 0.25) (-o results.json)",
+            "",
+            "A baseline is kept in fixtures/benchmark/baseline.json, along with the machine, Python and library versions it was recorded with.",
+            "Timings only compare well on the same machine, so refresh it there before comparing, and again whenever the code gets faster on purpose:",
+            "python3 ugoBenchmark.py -o fixtures/benchmark/baseline.json",
+            "On shared or otherwise noisy machines, raise -t until repeated runs of unchanged code pass",
+            ""
+        ]))
+        sys.exit()
+
+    try:
+        # Correctness checks against the reference implementations
+        benchColors()
+        benchNpfEncode()
+        benchQuantizer()
+        benchAdpcm()
+        benchThumbnails()
+        # Behavior checks against the plain code paths
+        for behaviorCheck in BEHAVIOR_CHECKS:
+            behaviorCheck()
+    except RuntimeError as error:
+        print("Error: check failed: {}".format(error))
+        sys.exit(1)
+    print("")
+    if checksOnly:
+        print("All checks passed")
+        sys.exit()
+
+    results = benchCodecs()
+    results.update(benchAudio())
+    results.update(benchUgomenu())
+
+    if outputPath:
+        with open(outputPath, "w") as outfile:
+            json.dump({
+                "ugoImage": UGOIMAGE_VERSION,
+                "ppmParser": PPMPARSER_VERSION,
+                "ugomenu": UGOMENU_VERSION,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pillow": PIL.__version__,
+                "machine": platform.machine(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "results": results,
+            }, outfile, indent=2, sort_keys=True)
+
+    if baselinePath:
+        with open(baselinePath) as infile:
+            baselineData = json.load(infile)
+        baseline = baselineData["results"]
+        regressions = compareResults(results, baseline, tolerance=tolerance)
+        print("")
+        # Timings from another machine or Python version are only a rough guide
+        recordedOn = (baselineData.get("machine"), baselineData.get("python"), baselineData.get("cpus"))
+        if recordedOn != (platform.machine(), platform.python_version(), os.cpu_count()):
+            print("Note: the baseline was recorded on {} with Python {} and {} CPUs, refresh it with -o to compare against this machine".format(*recordedOn))
+        if regressions:
+            print("{} regressions against {}:".format(len(regressions), baselinePath))
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against " + baselinePath)
@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 # =========================
-# ugoImage.py version 1.0.5
+# ugoImage.py version 1.1.0
 # =========================
 #
 # Convert images to and from Flipnote Studio's proprietary image formats (NFTF, NPF and NBF)
@@ -18,6 +18,39 @@
 # Convert a standard image format like PNG to NTFT, NBF, or NPF:
 # Python3 ugoImage.py -i input_path -o output_path
 #
+# Give more than one -o to write several formats at once, sharing the work they have in common:
+# Python3 ugoImage.py -i input_path -o output.ntft -o output.nbf -o output.npf -o preview.png
+#
+# Convert a directory, glob pattern or manifest file of images in parallel, mirroring the input tree under output_dir:
+# Python3 ugoImage.py -b input_source output_dir output_format (image_width image_height) (-j processes)
+#
+# Each line of a manifest file is input_path,output_format,image_width,image_height, where the width and height
+# are only needed for NTFT, NBF and NPF inputs. Relative paths are relative to the manifest file.
+#
+# Check NTFT, NBF and NPF files without decoding them, optionally against an expected image size:
+# Python3 ugoImage.py -p input_source (image_width image_height) (-j threads)
+#
+# Add -c cache_dir to either of the conversion modes above to keep converted images in cache_dir, and skip any conversions whose input
+# and settings haven't changed since they were last cached. Once the conversions are done, the least recently used images are
+# removed until the cache fits in 1 GB
+#
+# Add -t max_width max_height (samples) to either of the conversion modes above to write thumbnails that fit in max_width x max_height instead,
+# NTFT, NBF and NPF thumbnails are sampled straight from the stored data, averaging samples x samples pixels for each thumbnail pixel
+#
+# Add --profile to the single file or batch conversion modes to print a per-stage breakdown of where the time and memory went
+#
+# Since version 1.1.0, NBF and NPF palettes are picked by a faster median cut quantizer, so their bytes differ from those written by 1.0.5
+# and earlier. To get the old output back, set ugoImage.quantizer = "pillow" before converting
+#
+# Run as a long-lived conversion worker, serving requests over a Unix socket, or stdin/stdout if no socket is given:
+# Python3 ugoImage.py -s (socket_path) (-j processes)
+#
+# Worker requests and responses are JSON objects, one per line:
+#   request:  {"id": any, "input": base64 data or "inputPath": path, "inputFormat": "nbf", "outputFormat": "png",
+#              "width": 256, "height": 192, "outputPath": optional path to write the result to}
+#   response: {"id": any, "ok": true, "output": base64 data (or "outputPath": path)}
+#             {"id": any, "ok": false, "error": message}
+#
 # Issues:
 # =======
 #
@@ -39,9 +72,15 @@
 
 from PIL import Image, ImageOps
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from time import perf_counter
+from threading import Lock, BoundedSemaphore, Condition
+from collections import OrderedDict, Counter, deque
+from functools import partial
 import numpy as np
+import os, sys, stat, glob, csv, json, base64, hashlib, heapq, itertools, mmap, socketserver, asyncio
 
-VERSION = "1.0.5"
+VERSION = "1.1.0"
 
 # Round up a number to the nearest power of two
 # Flipnote's image formats really like power of twos
@@ -80,39 +119,720 @@ def packColor(color, useAlpha=True):
     # Combine them together into one 16-bit integer
     return ((a<<15) | (b<<10) | (g<<5) | (r))
 
-# Convenience method to apply unpackColor over an array
-unpackColors = np.vectorize(unpackColor, otypes=[">u4"])
+# Build a lookup table mapping every possible abgr1555 value to its unpacked rgba8888 value
+# useAlpha = use True to read the alpha bit, else False
+# Returns a 65536-entry array of big-endian 32-bit uints, in the same format as unpackColor
+def _buildUnpackTable(useAlpha=True):
+    values = np.arange(0x10000, dtype=np.uint32)
+    r = (values       & 0x1f)
+    g = (values >> 5  & 0x1f)
+    b = (values >> 10 & 0x1f)
+    a = (values >> 15 & 0x1)
+    r = r << 3 | (r >> 2)
+    g = g << 3 | (g >> 2)
+    b = b << 3 | (b >> 2)
+    a = np.where(a == 0, 0x00, 0xFF) if useAlpha else 0xFF
+    return ((r << 24) | (g << 16) | (b << 8) | a).astype(">u4")
+
+# Only 65536 possible input colors exist, so precompute the output for each of them once
+_unpackTables = {
+    True: _buildUnpackTable(useAlpha=True),
+    False: _buildUnpackTable(useAlpha=False),
+}
 
-# Convenience method to apply packColor over an array of colors
+# Apply unpackColor over an array of abgr1555 colors with a single table lookup
+# values = array of 16-bit uints
+# useAlpha = use True to read the alpha bit, else False
+# Returns an array of big-endian 32-bit uints with the same shape as values
+def unpackColors(values, useAlpha=True):
+    return _unpackTables[bool(useAlpha)][np.asarray(values, dtype=np.uint16)]
+
+# Unpack an array of abgr1555 colors straight to RGBA pixels
+# values = array of 16-bit uints
+# useAlpha = use True to read the alpha bit, else False
+# Returns an array of 8-bit uints with the same shape as values plus a last axis of [r, g, b, a]
+def _unpackPixels(values, useAlpha=True):
+    colors = unpackColors(values, useAlpha=useAlpha)
+    # The unpacked colors are big-endian, so their bytes are already in r, g, b, a order
+    return colors.view(np.uint8).reshape(colors.shape + (4,))
+
+# Apply packColor over an array of colors
+# colors = array of [r, g, b, a (optional)] colors
+# useAlpha = use True to use the alpha value, else False
+# Returns an array of 16-bit uints
 def packColors(colors, useAlpha=True):
-    return np.apply_along_axis(packColor, 1, colors, useAlpha=useAlpha).astype(np.uint16)
+    # Widen the channels so that multiplying them doesn't overflow
+    colors = np.asarray(colors).astype(np.uint32)
+    r = colors[..., 0] * 0x1F // 0xFF
+    g = colors[..., 1] * 0x1F // 0xFF
+    b = colors[..., 2] * 0x1F // 0xFF
+    a = np.where(colors[..., 3] < 0x80, 0, 1) if useAlpha == True else 1
+    # Combine them together into one 16-bit integer
+    return ((a << 15) | (b << 10) | (g << 5) | (r)).astype(np.uint16)
+
+# Split a box of colors in two at the weighted median of its widest channel, for quantizeColors
+# channels = (n, 3) array of 5-bit [r, g, b] values, counts = pixel count of each color
+# Returns the indices of the two halves
+def _splitColorBox(box, channels, counts):
+    boxChannels = channels[box]
+    channel = np.argmax(boxChannels.max(axis=0) - boxChannels.min(axis=0))
+    box = box[np.argsort(boxChannels[:, channel], kind="stable")]
+    # Find the weighted median, making sure both halves get at least one color
+    cumulative = np.cumsum(counts[box])
+    split = int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1
+    split = min(max(split, 1), len(box) - 1)
+    return box[0:split], box[split::]
+
+# Quantize colors down to a limited palette of abgr1555 colors
+# Flipnote can only store 32768 different colors, so the colors are reduced to 15 bits first, and the
+# palette is found by running median cut over the histogram of those instead of over every pixel
+# pixels = array of [r, g, b] colors, the last axis holds the channels
+# paletteSlots = the maximum number of colors to use, e.g. 15 for NPF or 256 for NBF
+# Returns (paletteData, indexData), where paletteData is a 1-D array of abgr1555 colors with the alpha bit set,
+# and indexData is an array of palette indices with the same shape as pixels minus the last axis
+def quantizeColors(pixels, paletteSlots=256):
+    keys = _colorKeys(pixels)
+    paletteData, lookup = _histogramPalette(np.bincount(keys.ravel(), minlength=0x8000), paletteSlots=paletteSlots)
+    return (paletteData, lookup[keys])
+
+# Reduce colors to 15 bits, for quantizeColors
+# pixels = array of [r, g, b] colors, the last axis holds the channels
+# Returns an array of 15-bit keys, using the same bit layout as abgr1555, with the same shape as pixels minus the last axis
+def _colorKeys(pixels):
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    return ((pixels[..., 2] >> 3).astype(np.uint16) << 10) | ((pixels[..., 1] >> 3).astype(np.uint16) << 5) | (pixels[..., 0] >> 3)
+
+# Find the palette for a histogram of 15-bit colors, for quantizeColors
+# histogram = pixel count of each of the 32768 possible keys from _colorKeys
+# Returns (paletteData, lookup), where lookup is a 32768-entry array mapping each key to its palette index
+def _histogramPalette(histogram, paletteSlots=256):
+    colors = np.flatnonzero(histogram)
+    counts = histogram[colors]
+    channels = np.stack((colors & 0x1f, colors >> 5 & 0x1f, colors >> 10 & 0x1f), axis=-1)
+    # If there are few enough colors already, every color gets its own palette slot
+    if len(colors) <= paletteSlots:
+        labels = np.arange(len(colors))
+    else:
+        # Start with every color in one box, then keep splitting the box with the most pixels in it
+        # The heap holds (-population, box number, box), boxes with only one color in them can't be split and are set aside
+        boxNumber = itertools.count()
+        boxes = []
+        heap = [(-counts.sum(), next(boxNumber), np.arange(len(colors)))]
+        while heap and len(heap) + len(boxes) < paletteSlots:
+            population, n, box = heapq.heappop(heap)
+            for half in _splitColorBox(box, channels, counts):
+                if len(half) > 1:
+                    heapq.heappush(heap, (-counts[half].sum(), next(boxNumber), half))
+                else:
+                    boxes.append(half)
+        boxes += [box for population, n, box in heap]
+        labels = np.empty(len(colors), dtype=np.intp)
+        for i, box in enumerate(boxes):
+            labels[box] = i
+    # Each palette color is the pixel-weighted average of the colors in its box
+    totals = np.bincount(labels, weights=counts)
+    palette = np.stack([np.bincount(labels, weights=counts * channels[:, c]) / totals for c in range(3)], axis=-1)
+    palette = np.rint(palette).astype(np.uint16)
+    lookup = np.zeros(0x8000, dtype=np.uint8)
+    lookup[colors] = labels
+    paletteData = (0x8000 | (palette[:, 2] << 10) | (palette[:, 1] << 5) | palette[:, 0]).astype(np.uint16)
+    return (paletteData, lookup)
+
+# Check whether an object supports the buffer protocol, like bytes, bytearray, memoryview and mmap do
+def _isBytesLike(source):
+    try:
+        memoryview(source)
+        return True
+    except TypeError:
+        return False
+
+# Get the raw bytes of an image without copying them where possible
+# source = file path, file object, or any bytes-like object (bytes, bytearray, memoryview, mmap, etc)
+# Returns a bytes-like object; file paths are memory-mapped, file objects are read from their current position
+def _readImageData(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            try:
+                # The map stays valid after the file is closed, and NumPy arrays made from it keep it alive
+                # Loaders copy whatever they keep out of it, see _detachArray, since the file can change after loading
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and things like pipes can't be mapped
+                return file.read()
+    # mmap objects have a read method too, so check for bytes-like objects first
+    if _isBytesLike(source):
+        return source
+    return source.read()
+
+# Copy an array out of a memory-mapped file, so nothing that outlives the load depends on the file staying the same
+# Arrays over any other kind of input data are returned as they are
+def _detachArray(array, data):
+    return np.array(array) if isinstance(data, mmap.mmap) else array
+
+# Random access to the raw bytes of an image, only reading the parts that are asked for
+# Used by the streaming decoders so that memory use doesn't grow with the size of the image
+class _imageDataReader:
+
+    # source = file path, file object, or any bytes-like object
+    # File objects are read from their current position, ones that can't seek are read in full
+    def __init__(self, source):
+        self.data = None
+        self.file = None
+        self.ownsFile = False
+        self.start = 0
+        if isinstance(source, (str, os.PathLike)):
+            self.file = open(source, "rb")
+            self.ownsFile = True
+        elif _isBytesLike(source):
+            self.data = np.frombuffer(source, dtype=np.uint8)
+        else:
+            try:
+                self.start = source.tell()
+                source.seek(self.start)
+                self.file = source
+            except (AttributeError, OSError):
+                self.data = np.frombuffer(source.read(), dtype=np.uint8)
+
+    # Read length bytes from offset, fewer are returned if the data ends first
+    # Returns a 1-D array of 8-bit uints
+    def read(self, offset, length):
+        if self.data is not None:
+            return self.data[offset:offset + length]
+        self.file.seek(self.start + offset)
+        buffer = bytearray(length)
+        byteCount = self.file.readinto(buffer)
+        return np.frombuffer(buffer, dtype=np.uint8)[0:byteCount]
+
+    def close(self):
+        if self.ownsFile:
+            self.file.close()
+
+# Per-stage profiling stats for ugoImage loads and saves
+# Give one to a ugoImage to record the wall time, bytes processed and NumPy array allocations of each stage
+# (header, palette, pixels, clip, pad, quantize, pillow, etc), plus "load" and "save" totals
+# The same object can be shared by any number of ugoImages to aggregate stats over a long-running process
+class ugoImageStats:
+
+    # callback = optional function called as callback(stage, seconds, bytesProcessed, allocations, allocatedBytes) for every stage
+    # maxSamples = number of recent timings to keep per stage for percentiles
+    def __init__(self, callback=None, maxSamples=10000):
+        self.callback = callback
+        self.maxSamples = maxSamples
+        self.stages = OrderedDict()
+        self.lock = Lock()
+
+    # Stats are sent back from batch worker processes, so leave out the parts that can't be pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["callback"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def _getStage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {"calls": 0, "seconds": 0.0, "bytes": 0, "allocations": 0, "allocatedBytes": 0, "samples": deque(maxlen=self.maxSamples)}
+        return self.stages[stage]
+
+    # Record one run of a stage
+    def record(self, stage, seconds, bytesProcessed=0, allocations=0, allocatedBytes=0):
+        with self.lock:
+            entry = self._getStage(stage)
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["bytes"] += bytesProcessed
+            entry["allocations"] += allocations
+            entry["allocatedBytes"] += allocatedBytes
+            entry["samples"].append(seconds)
+        if self.callback:
+            self.callback(stage, seconds, bytesProcessed, allocations, allocatedBytes)
+
+    # Add the stats from another ugoImageStats object to this one
+    def merge(self, other):
+        with self.lock:
+            for stage, otherEntry in other.stages.items():
+                entry = self._getStage(stage)
+                for key in ["calls", "seconds", "bytes", "allocations", "allocatedBytes"]:
+                    entry[key] += otherEntry[key]
+                entry["samples"].extend(otherEntry["samples"])
+
+    # Get percentiles of the recent timings of a stage
+    # Returns a list of times in seconds, one for each percent given
+    def percentiles(self, stage, percents=(50, 90, 99)):
+        with self.lock:
+            samples = list(self.stages[stage]["samples"]) if stage in self.stages else []
+        if not samples:
+            return [0.0 for percent in percents]
+        return [float(value) for value in np.percentile(samples, percents)]
+
+    # Get the stats as a table
+    # Returns a string
+    def format(self):
+        lines = ["{:<10} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>11} {:>7} {:>11}".format("stage", "calls", "total ms", "mean ms", "p50 ms", "p90 ms", "p99 ms", "MB in", "allocs", "MB alloc")]
+        for stage in list(self.stages):
+            entry = self.stages[stage]
+            p50, p90, p99 = self.percentiles(stage)
+            lines.append("{:<10} {:>7} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>11.3f} {:>7} {:>11.3f}".format(
+                stage, entry["calls"], entry["seconds"] * 1000, entry["seconds"] * 1000 / entry["calls"], p50 * 1000, p90 * 1000, p99 * 1000,
+                entry["bytes"] / 1e6, entry["allocations"], entry["allocatedBytes"] / 1e6))
+        return "\n".join(lines)
+
+# Times one stage of a load or save, and reports it to a ugoImageStats object if there is one
+class _stageTimer:
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.bytesProcessed = 0
+        self.allocations = 0
+        self.allocatedBytes = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        if self.stats is not None and exception[0] is None:
+            self.stats.record(self.stage, perf_counter() - self.start, self.bytesProcessed, self.allocations, self.allocatedBytes)
+
+    # Count bytes read by this stage
+    def processed(self, byteCount):
+        self.bytesProcessed += int(byteCount)
+
+    # Count arrays created by this stage, views over existing memory don't count as allocations
+    def allocated(self, *arrays):
+        for array in arrays:
+            if isinstance(array, np.ndarray) and array.base is None:
+                self.allocations += 1
+                self.allocatedBytes += array.nbytes
 
 # ugoImage class
 class ugoImage:
 
-    def __init__(self, imageBuffer=None, imageFormat=None, imageWidth=0, imageHeight=0):
-        if imageBuffer:
-            self.load(imageBuffer, imageWidth, imageHeight, imageFormat)
+    # Indexed images (NBF, NPF and suitable paletted images) are kept as a palette plus an array of indices
+    #   paletteData = 1-D array of abgr1555 colors, exactly as they would be stored in an NBF or NPF
+    #   indexData = 2-D array of palette indices, clipped to the image size
+    #   transparentIndex = palette index used for transparent pixels, or None
+    # The full RGBA image is only created from these when something asks for self.image
+    paletteData = None
+    indexData = None
+    transparentIndex = None
+    # Full color images (NTFT, or images set with fromArray) are kept as a 3-D array of RGBA pixels
+    # The Pillow image is only created from it when something asks for self.image
+    pixelData = None
+    _image = None
+
+    # Color quantizer used when writing NBF and NPF
+    #   "fast" = quantizeColors, median cut over the 15-bit color histogram
+    #   "pillow" = _limitImageColors, Pillow's adaptive palette, the only quantizer before version 1.1.0
+    quantizer = "fast"
+
+    # Optional ugoImageStats object to record per-stage profiling stats to
+    stats = None
+
+    # Number of pixels the writers convert, pad and write at a time, so the padded copy of a large image never exists all at once
+    bandPixels = 65536
+
+    # Intermediate results shared between the outputs of saveMany, None outside of saveMany
+    _shared = None
+
+    def __init__(self, imageBuffer=None, imageFormat=None, imageWidth=0, imageHeight=0, stats=None):
+        if stats is not None:
+            self.stats = stats
+        if imageBuffer is not None:
+            self.load(imageBuffer, imageFormat=imageFormat, imageWidth=imageWidth, imageHeight=imageHeight)
+
+    # Create a ugoImage from an array of pixels, without going through Pillow
+    # pixels = 3-D array of 8-bit [r, g, b, a] or [r, g, b] pixels, with shape (height, width, channels)
+    # Returns a ugoImage object
+    @classmethod
+    def fromArray(cls, pixels):
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        if pixels.ndim != 3 or pixels.shape[2] not in [3, 4]:
+            raise ValueError("pixels must have a shape of (height, width, 3) or (height, width, 4)")
+        if pixels.shape[2] == 3:
+            # Add an opaque alpha channel
+            pixels = np.concatenate((pixels, np.full(pixels.shape[0:2] + (1,), 0xFF, dtype=np.uint8)), axis=-1)
+        ugo = cls()
+        ugo._setPixels(pixels)
+        return ugo
+
+    # Create a ugoImage from an indexed image, without going through Pillow
+    # paletteData = 1-D array of abgr1555 colors
+    # indexData = 2-D array of palette indices, with shape (height, width)
+    # transparentIndex = palette index used for transparent pixels, or None
+    # Returns a ugoImage object
+    @classmethod
+    def fromIndexedArray(cls, paletteData, indexData, transparentIndex=None):
+        paletteData = np.asarray(paletteData, dtype=np.uint16)
+        indexData = np.asarray(indexData, dtype=np.uint8)
+        if paletteData.ndim != 1 or indexData.ndim != 2:
+            raise ValueError("paletteData must be 1-D and indexData must be 2-D")
+        if len(paletteData) > 256 or (indexData.size and indexData.max() >= len(paletteData)):
+            raise ValueError("indexData refers to colors outside of paletteData")
+        ugo = cls()
+        ugo._setIndexed(paletteData, indexData, transparentIndex)
+        return ugo
+
+    # Get the image as an array of RGBA pixels, indexed images are expanded the first time this is used
+    # The array may be shared with this ugoImage, so copy it before modifying it
+    # Returns a 3-D array of 8-bit [r, g, b, a] pixels, with shape (height, width, 4)
+    def toArray(self):
+        if self.pixelData is None:
+            if self.indexData is None:
+                # Pillow images can be modified in place, so don't keep a copy of their pixels around
+                return self._share("pixels", lambda: np.asarray(self._image if self._image.mode == "RGBA" else self._image.convert("RGBA")))
+            self.pixelData = self._expandIndexed(self.paletteData, self.indexData, self.transparentIndex)
+        return self.pixelData
+
+    # Get the image as a palette plus an array of palette indices
+    # Indexed images are returned as they are, anything else is quantized and has its transparency dropped
+    # paletteSlots = the maximum number of colors to use if the image needs to be quantized
+    # Returns (paletteData, indexData, transparentIndex), see the indexed form notes above
+    def toIndexedArray(self, paletteSlots=256):
+        if self.indexData is not None and len(self.paletteData) <= paletteSlots:
+            return (self.paletteData, self.indexData, self.transparentIndex)
+        paletteData, indexData = self._quantizePixels(self.toArray(), paletteSlots=paletteSlots)
+        return (paletteData, indexData, None)
+
+    # The image as a Pillow image, indexed and array images are converted the first time this is used
+    # The writers use the indexed or array forms when there is one, so assign an edited Pillow image back to self.image
+    @property
+    def image(self):
+        if self._image is None and (self.indexData is not None or self.pixelData is not None):
+            self._image = Image.fromarray(self.toArray())
+        return self._image
+
+    # Replacing the image drops the indexed and array forms, since they would no longer match
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.paletteData = None
+        self.indexData = None
+        self.transparentIndex = None
+        self.pixelData = None
 
+    # Set the image from an indexed form, the RGBA image will be created from it when needed
+    def _setIndexed(self, paletteData, indexData, transparentIndex=None):
+        self.image = None
+        self.paletteData = paletteData
+        self.indexData = indexData
+        self.transparentIndex = transparentIndex
+
+    # Set the image from an array of RGBA pixels, the Pillow image will be created from it when needed
+    def _setPixels(self, pixelData):
+        self.image = None
+        self.pixelData = pixelData
+
+    # Start timing a load or save stage
+    # Returns a _stageTimer to use in a with statement
+    def _stage(self, stage):
+        return _stageTimer(self.stats, stage)
+
+    # Get the size of the image without expanding it
+    # Returns (width, height)
+    def getSize(self):
+        if self.indexData is not None:
+            return (self.indexData.shape[1], self.indexData.shape[0])
+        if self.pixelData is not None:
+            return (self.pixelData.shape[1], self.pixelData.shape[0])
+        return self.image.size
+
+    # Load an image
+    # imageBuffer = file path, file object, or bytes-like object (bytes, bytearray, memoryview, mmap, etc)
+    # imageFormat = image format, if imageBuffer is a path this defaults to the file extension
+    # imageWidth, imageHeight = image size, only needed for NTFT, NBF and NPF
     def load(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0):
+        with self._stage("load"):
+            self._load(imageBuffer, imageFormat, imageWidth, imageHeight)
+
+    def _load(self, imageBuffer, imageFormat, imageWidth, imageHeight):
+        if not imageFormat and isinstance(imageBuffer, (str, os.PathLike)):
+            imageFormat = os.path.splitext(imageBuffer)[1][1:]
         # Some prefer uppercase extentions over lowercase... I don't :P
-        imageFormat = imageFormat.lower()
+        imageFormat = (imageFormat or "").lower()
         if not imageFormat or imageFormat not in ["npf", "nbf", "ntft"]:
-            # Copy the image to an internal buffer
-            buffer = BytesIO()
-            buffer.write(imageBuffer.read())
-            self.image = Image.open(buffer)
+            with self._stage("pillow"):
+                if isinstance(imageBuffer, (str, os.PathLike)):
+                    self.image = Image.open(imageBuffer)
+                elif _isBytesLike(imageBuffer):
+                    self.image = Image.open(BytesIO(imageBuffer))
+                else:
+                    # Copy the image to an internal buffer
+                    buffer = BytesIO()
+                    buffer.write(imageBuffer.read())
+                    self.image = Image.open(buffer)
+                # Pillow decodes lazily, so when profiling make it decode now to time it here
+                if self.stats is not None:
+                    self.image.load()
+            # Paletted images that only use colors Flipnote can store can skip quantization when they're written
+            indexed = self._indexPalettedImage(self.image)
+            if indexed:
+                image = self.image
+                self._setIndexed(*indexed)
+                # Keep the original image rather than expanding it again later
+                self._image = image
         elif imageFormat == "npf":
-            self.image = self.parseNpf(imageBuffer, imageWidth, imageHeight)
+            self._setIndexed(*self._parseNpfIndexed(imageBuffer, imageWidth, imageHeight))
         elif imageFormat == "nbf":
-            self.image = self.parseNbf(imageBuffer, imageWidth, imageHeight)
+            self._setIndexed(*self._parseNbfIndexed(imageBuffer, imageWidth, imageHeight))
         elif imageFormat == "ntft":
-            self.image = self.parseNtft(imageBuffer, imageWidth, imageHeight)
+            self._setPixels(self._parseNtftArray(imageBuffer, imageWidth, imageHeight))
+
+    # Load a scaled-down copy of an image, for previews and listings
+    # NTFT, NBF and NPF images are sampled straight from the stored data, so only the pixels the thumbnail needs are ever read or expanded
+    # imageBuffer, imageFormat, imageWidth, imageHeight = same as load
+    # maxSize = (width, height) the thumbnail has to fit in, the aspect ratio is kept and images are never scaled up
+    # samples = number of samples to average across and down each thumbnail pixel, 1 picks the nearest pixel and keeps indexed images indexed
+    def loadThumbnail(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0, maxSize=(64, 48), samples=1):
+        with self._stage("load"):
+            self._loadThumbnail(imageBuffer, imageFormat, imageWidth, imageHeight, maxSize, samples)
+
+    def _loadThumbnail(self, imageBuffer, imageFormat, imageWidth, imageHeight, maxSize, samples):
+        if not imageFormat and isinstance(imageBuffer, (str, os.PathLike)):
+            imageFormat = os.path.splitext(imageBuffer)[1][1:]
+        imageFormat = (imageFormat or "").lower()
+        if imageFormat not in ["npf", "nbf", "ntft"]:
+            self._load(imageBuffer, imageFormat, imageWidth, imageHeight)
+            image = self.image.copy()
+            with self._stage("pillow"):
+                image.thumbnail(self._thumbnailSize(image.size, maxSize), Image.BOX if samples > 1 else Image.NEAREST)
+            self.image = image
+            return
+        with self._stage("read") as stage:
+            data = _readImageData(imageBuffer)
+            stage.processed(len(data))
+        paddedWidth = roundToPower(imageWidth)
+        transparentIndex = None
+        if imageFormat == "ntft":
+            imageData = np.frombuffer(data, dtype=np.uint16, count=len(data) // 2)
+        else:
+            sectionLengths = self._readUgarHeader(data)
+            offset = 8 + sectionLengths.nbytes
+            paletteLength = roundToPower(sectionLengths[0]) if imageFormat == "npf" else sectionLengths[0]
+            paletteData = np.frombuffer(data, dtype=np.uint16, count=paletteLength // 2, offset=offset)
+            imageData = np.frombuffer(data, dtype=np.uint8, count=sectionLengths[1], offset=offset + paletteLength)
+        # View the image data as rows, NPF stores two pixels per byte
+        imageData = imageData.reshape(-1, paddedWidth // 2 if imageFormat == "npf" else paddedWidth)
+        # Like _clipImageData, only use as many rows as there actually are
+        imageHeight = min(imageHeight, imageData.shape[0])
+        thumbWidth, thumbHeight = self._thumbnailSize((imageWidth, imageHeight), maxSize)
+        with self._stage("sample") as stage:
+            # Pick the pixel positions to read, samples x samples of them spread evenly over the area each thumbnail pixel covers
+            rows = ((np.arange(thumbHeight * samples) + 0.5) * imageHeight / (thumbHeight * samples)).astype(np.intp)[:, None]
+            columns = ((np.arange(thumbWidth * samples) + 0.5) * imageWidth / (thumbWidth * samples)).astype(np.intp)[None, :]
+            if imageFormat == "npf":
+                # The first pixel of each byte is in the low nibble
+                sampled = (imageData[rows, columns >> 1] >> ((columns & 1) << 2)) & 0x0f
+                transparentIndex = 0
+            else:
+                sampled = imageData[rows, columns]
+            stage.allocated(sampled)
+        if imageFormat == "ntft":
+            with self._stage("colors") as stage:
+                pixels = _unpackPixels(sampled, useAlpha=True)
+                stage.allocated(pixels.base)
+        elif samples == 1:
+            self._setIndexed(paletteData, sampled, transparentIndex)
+            return
+        else:
+            pixels = self._expandIndexed(paletteData, sampled, transparentIndex)
+        if samples > 1:
+            pixels = self._averageSamples(pixels, samples)
+        self._setPixels(pixels)
+
+    # Decode an image a few rows at a time, without holding the whole image in memory
+    # NTFT, NBF and NPF images are read straight from the right offsets of the file, other formats are decoded by Pillow in full first
+    # imageBuffer, imageFormat, imageWidth, imageHeight = same as load
+    # rowsPerChunk = number of rows to decode at a time
+    # region = (x, y, width, height) to only decode part of the image, or None for all of it
+    # Yields (y, pixels) for each chunk, where y is the row the chunk starts at within the region, and pixels is a
+    # 3-D array of 8-bit [r, g, b, a] pixels with shape (rows, width, 4)
+    def iterRows(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0, rowsPerChunk=16, region=None):
+        imageFormat = self._streamFormat(imageBuffer, imageFormat)
+        if imageFormat not in ["npf", "nbf", "ntft"]:
+            # Decoded into a separate image, so this image is left alone like it is for the Flipnote formats
+            decoded = ugoImage(stats=self.stats)
+            decoded._load(imageBuffer, imageFormat, imageWidth, imageHeight)
+            pixels = decoded.toArray()
+            x, y, width, height = self._checkRegion(region, (pixels.shape[1], pixels.shape[0]))
+            for row in range(0, height, rowsPerChunk):
+                yield (row, pixels[y + row:y + min(row + rowsPerChunk, height), x:x + width])
+            return
+        reader = _imageDataReader(imageBuffer)
+        try:
+            paletteData, transparentIndex, chunks = self._iterRowData(reader, imageFormat, imageWidth, imageHeight, rowsPerChunk, region)
+            if paletteData is not None:
+                # Unpack the palette once, rather than for every chunk
+                palette = _unpackPixels(paletteData, useAlpha=False)
+                if transparentIndex is not None and transparentIndex < len(palette):
+                    palette[transparentIndex] = 0
+            for row, chunk in chunks:
+                yield (row, palette[chunk] if paletteData is not None else _unpackPixels(chunk, useAlpha=True))
+        finally:
+            reader.close()
+
+    # Decode an image a tile at a time, without holding the whole image in memory
+    # Only one row of tiles is decoded at once, see iterRows
+    # tileSize = (width, height) of each tile, tiles at the right and bottom edges may be smaller
+    # Yields (x, y, pixels) for each tile, where (x, y) is the position of the tile within the region
+    def iterTiles(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0, tileSize=(64, 64), region=None):
+        tileWidth, tileHeight = tileSize
+        for y, pixels in self.iterRows(imageBuffer, imageFormat, imageWidth, imageHeight, rowsPerChunk=tileHeight, region=region):
+            for x in range(0, pixels.shape[1], tileWidth):
+                yield (x, y, pixels[:, x:x + tileWidth])
+
+    # Load part of an image, only reading the rows it covers
+    # NBF and NPF regions stay indexed, so the region is the only part of the image that ever gets expanded
+    # region = (x, y, width, height) to load
+    def loadRegion(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0, region=None):
+        with self._stage("load"):
+            imageFormat = self._streamFormat(imageBuffer, imageFormat)
+            if imageFormat not in ["npf", "nbf", "ntft"]:
+                self._load(imageBuffer, imageFormat, imageWidth, imageHeight)
+                x, y, width, height = self._checkRegion(region, self.getSize())
+                self.image = self.image.crop((x, y, x + width, y + height))
+                return
+            reader = _imageDataReader(imageBuffer)
+            try:
+                paletteData, transparentIndex, chunks = self._iterRowData(reader, imageFormat, imageWidth, imageHeight, 256, region)
+                regionData = [chunk for row, chunk in chunks]
+            finally:
+                reader.close()
+            regionData = np.concatenate(regionData) if regionData else np.zeros((0, self._checkRegion(region, (imageWidth, imageHeight))[2]), dtype=np.uint16 if paletteData is None else np.uint8)
+            if paletteData is not None:
+                # The palette is tiny, so copy it rather than keep the file around
+                self._setIndexed(np.array(paletteData), regionData, transparentIndex)
+            else:
+                self._setPixels(_unpackPixels(regionData, useAlpha=True))
+
+    def _streamFormat(self, imageBuffer, imageFormat):
+        if not imageFormat and isinstance(imageBuffer, (str, os.PathLike)):
+            imageFormat = os.path.splitext(imageBuffer)[1][1:]
+        return (imageFormat or "").lower()
+
+    # Check that a region fits inside an image
+    # region = (x, y, width, height), or None for the whole image
+    # Returns (x, y, width, height)
+    def _checkRegion(self, region, imageSize):
+        if region is None:
+            return (0, 0) + tuple(imageSize)
+        x, y, width, height = region
+        if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > imageSize[0] or y + height > imageSize[1]:
+            raise ValueError("region {} is outside of the {}x{} image".format(tuple(region), imageSize[0], imageSize[1]))
+        return (x, y, width, height)
+
+    # Read the raw rows of an NTFT, NBF or NPF image a chunk at a time
+    # reader = _imageDataReader
+    # Returns (paletteData, transparentIndex, chunks), where paletteData is None for NTFT, and chunks is a generator of (y, data) pairs,
+    # where data is a 2-D array of palette indices, or abgr1555 colors for NTFT
+    def _iterRowData(self, reader, imageFormat, imageWidth, imageHeight, rowsPerChunk, region):
+        x, y, width, height = self._checkRegion(region, (imageWidth, imageHeight))
+        paddedWidth = roundToPower(imageWidth)
+        paletteData = None
+        transparentIndex = None
+        if imageFormat == "ntft":
+            # NTFT is just the pixels, two bytes each
+            pixelOffset = 0
+            rowLength = paddedWidth * 2
+        else:
+            with self._stage("header"):
+                sectionCount = reader.read(4, 4).view(np.uint32)[0]
+                sectionLengths = reader.read(8, 4 * sectionCount).view(np.uint32)
+            paletteOffset = 8 + sectionLengths.nbytes
+            paletteLength = roundToPower(sectionLengths[0]) if imageFormat == "npf" else sectionLengths[0]
+            paletteData = reader.read(paletteOffset, paletteLength).view(np.uint16)
+            pixelOffset = paletteOffset + paletteLength
+            rowLength = paddedWidth // 2 if imageFormat == "npf" else paddedWidth
+            transparentIndex = 0 if imageFormat == "npf" else None
+
+        def chunks():
+            for row in range(y, y + height, rowsPerChunk):
+                rowCount = min(rowsPerChunk, y + height - row)
+                with self._stage("read") as stage:
+                    # Each chunk is a single read of whole rows, which are then clipped to the region
+                    data = reader.read(pixelOffset + row * rowLength, rowCount * rowLength)
+                    stage.processed(len(data))
+                # A file that ends early just gives a shorter image, like _clipImageData does
+                rowCount = len(data) // rowLength
+                if rowCount == 0:
+                    return
+                data = data[0:rowCount * rowLength].reshape(rowCount, rowLength)
+                with self._stage("pixels") as stage:
+                    if imageFormat == "ntft":
+                        chunk = data.view(np.uint16)[:, x:x + width]
+                    elif imageFormat == "npf":
+                        # Split the bytes covering the region into pixels, the first pixel of each byte is in the low nibble
+                        data = data[:, x // 2:(x + width + 1) // 2]
+                        chunk = np.stack((data & 0x0f, data >> 4), axis=-1).reshape(rowCount, -1)[:, x % 2:x % 2 + width]
+                    else:
+                        chunk = data[:, x:x + width]
+                    stage.allocated(chunk)
+                yield (row - y, chunk)
+
+        return (paletteData, transparentIndex, chunks())
+
+    # Work out the size of a thumbnail
+    # imageSize = (width, height) of the full image
+    # maxSize = (width, height) the thumbnail has to fit in
+    # Returns (width, height)
+    def _thumbnailSize(self, imageSize, maxSize):
+        width, height = imageSize
+        scale = min(maxSize[0] / width, maxSize[1] / height, 1)
+        return (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+    # Average each samples x samples block of pixels down to one pixel
+    # Colors are weighted by their alpha, so that transparent pixels don't darken the edges of what's around them
+    # pixels = 3-D array of 8-bit [r, g, b, a] pixels, with a height and width that are multiples of samples
+    # Returns a 3-D array of 8-bit [r, g, b, a] pixels
+    def _averageSamples(self, pixels, samples):
+        with self._stage("average") as stage:
+            height, width = pixels.shape[0] // samples, pixels.shape[1] // samples
+            blocks = pixels.reshape(height, samples, width, samples, 4).astype(np.uint32)
+            alpha = blocks[..., 3:4]
+            alphaTotal = alpha.sum(axis=(1, 3))
+            colors = (blocks[..., 0:3] * alpha).sum(axis=(1, 3)) // np.maximum(alphaTotal, 1)
+            result = np.concatenate((colors, alphaTotal // (samples * samples)), axis=-1).astype(np.uint8)
+            stage.allocated(result)
+            return result
 
     def save(self, outputBuffer, imageFormat):
+        with self._stage("save"):
+            self._save(outputBuffer, imageFormat)
+
+    # Save the image in several formats at once, working out the intermediate data they have in common only once
+    # The RGBA pixels, the color histogram and the quantized palette for each palette size are shared between the outputs
+    # targets = list of (outputBuffer, imageFormat) pairs
+    def saveMany(self, targets):
+        self._shared = {}
+        try:
+            for outputBuffer, imageFormat in targets:
+                self.save(outputBuffer, imageFormat)
+        finally:
+            self._shared = None
+
+    # Get an intermediate result, reusing it if it's already been worked out during saveMany
+    # key = name of the result, func = function that works it out
+    def _share(self, key, func):
+        if self._shared is None:
+            return func()
+        if key not in self._shared:
+            self._shared[key] = func()
+        return self._shared[key]
+
+    def _save(self, outputBuffer, imageFormat):
         imageFormat = imageFormat.lower()
         if not imageFormat or imageFormat not in ["npf", "nbf", "ntft"]:
-            self.image.save(outputBuffer, imageFormat)
+            # Formats that support palettes and transparent palette entries can be written straight from the indexed form
+            if self.indexData is not None and imageFormat in ["png", "gif"]:
+                image = self._palettedImage()
+            else:
+                image = self.image
+            with self._stage("pillow"):
+                image.save(outputBuffer, imageFormat)
         elif imageFormat == "npf":
             self.writeNpf(outputBuffer)
         elif imageFormat == "nbf":
@@ -131,14 +851,16 @@ class ugoImage:
         outputBuffer.write(b"UGAR")
         outputBuffer.write(sectionTable.tobytes())
 
-    # Read an UGAR header from buffer
+    # Read an UGAR header from image data
     # https://github.com/Flipnote-Collective/flipnote-studio-docs/wiki/.nbf-image-format#header
-    # Returns a np array of section lengths
-    def _readUgarHeader(self, buffer):
-        # Skip the magic
-        buffer.seek(4)
-        sectionCount = np.fromstring(buffer.read(4), dtype=np.uint32)[0]
-        sectionTable = np.fromstring(buffer.read(4 * sectionCount), dtype=np.uint32)
+    # data = bytes-like object
+    # Returns a np array of section lengths, the first section starts right after it (at 8 + sectionTable.nbytes)
+    def _readUgarHeader(self, data):
+        with self._stage("header") as stage:
+            # Skip the magic
+            sectionCount = np.frombuffer(data, dtype=np.uint32, count=1, offset=4)[0]
+            sectionTable = np.frombuffer(data, dtype=np.uint32, count=sectionCount, offset=8)
+            stage.processed(8 + sectionTable.nbytes)
         return sectionTable
 
     # If the image width isn't a power-of-two, then add padding until it is
@@ -151,12 +873,14 @@ class ugoImage:
         # We use the "edge" padding mode to repeat the edge of each side until the image is the correct size
         # Hatena's encoder did this, and they sometimes made use of this effect in theme images
         if clipWidth != width:
-            # Reshape the image data into a 2D array
-            imageData = np.reshape(imageData, (-1, width))
-            imageData = np.pad(imageData, ((0, 0), (0, clipWidth - width)), "edge")
-            # Flatten back to a 1d array
-            return imageData.flatten()
-        # Else just return the imageData
+            with self._stage("pad") as stage:
+                stage.processed(imageData.nbytes)
+                # Reshape the image data into a 2D array
+                imageData = np.reshape(imageData, (-1, width))
+                imageData = np.pad(imageData, ((0, 0), (0, clipWidth - width)), "edge")
+                # Flatten back to a 1d array
+                imageData = imageData.flatten()
+                stage.allocated(imageData)
         return imageData
 
     # Clip an image out of a power-of-two width image
@@ -165,12 +889,64 @@ class ugoImage:
     # Returns 2-D array of pixels
     def _clipImageData(self, imageData, imageSize):
         width, height = imageSize
-        # Round the width up to the nearest power of two
-        clipWidth = roundToPower(width)
-        # Reshape the image array to make a 2D array with the "real" image width / height
-        imageData = np.reshape(imageData, (-1, clipWidth))
-        # Clip the "requested" image size out of the "real" image
-        return imageData[0:height, 0:width]
+        with self._stage("clip") as stage:
+            stage.processed(imageData.nbytes)
+            # Round the width up to the nearest power of two
+            clipWidth = roundToPower(width)
+            # Reshape the image array to make a 2D array with the "real" image width / height
+            imageData = np.reshape(imageData, (-1, clipWidth))
+            # Clip the "requested" image size out of the "real" image
+            return imageData[0:height, 0:width]
+
+    # Expand an indexed image to full color
+    # paletteData = 1-D array of abgr1555 colors
+    # indexData = 2-D array of palette indices
+    # transparentIndex = palette index used for transparent pixels, or None
+    # Returns a 3-D array of 8-bit [r, g, b, a] pixels
+    def _expandIndexed(self, paletteData, indexData, transparentIndex=None):
+        with self._stage("palette") as stage:
+            stage.processed(paletteData.nbytes)
+            palette = _unpackPixels(paletteData, useAlpha=False)
+            if transparentIndex is not None and transparentIndex < len(palette):
+                palette[transparentIndex] = 0
+            stage.allocated(palette.base)
+        with self._stage("expand") as stage:
+            stage.processed(indexData.nbytes)
+            # Convert every pixel from a palette index to full color in one lookup
+            pixels = palette[indexData]
+            stage.allocated(pixels)
+            return pixels
+
+    # Build a Pillow paletted image from the indexed form
+    # Returns PIL Image with P mode
+    def _palettedImage(self):
+        image = Image.fromarray(np.ascontiguousarray(self.indexData, dtype=np.uint8))
+        # Drop the alpha byte from each color
+        image.putpalette(_unpackPixels(self.paletteData, useAlpha=False)[:, 0:3].tobytes())
+        if self.transparentIndex is not None:
+            image.info["transparency"] = self.transparentIndex
+        return image
+
+    # Get the indexed form of a Pillow paletted image, if every palette color can be stored by Flipnote without any loss
+    # image = PIL Image object
+    # Returns (paletteData, indexData, transparentIndex), or None if the image can't be used as-is
+    def _indexPalettedImage(self, image):
+        if image.mode != "P" or image.palette is None or image.palette.mode != "RGB":
+            return None
+        transparentIndex = image.info.get("transparency")
+        # Per-entry alpha values can't be represented
+        if transparentIndex is not None and not isinstance(transparentIndex, int):
+            return None
+        palette = np.reshape(image.getpalette(), (-1, 3))
+        # Every channel needs to be a 5 bit value expanded to 8 bits, the same way unpackColor does it
+        if len(palette) > 256 or np.any(palette != ((palette >> 3) << 3 | (palette >> 5))):
+            return None
+        palette = palette >> 3
+        paletteData = (0x8000 | (palette[:, 2] << 10) | (palette[:, 1] << 5) | palette[:, 0]).astype(np.uint16)
+        # The encoders store the transparent slot as 0
+        if transparentIndex is not None and transparentIndex < len(paletteData):
+            paletteData[transparentIndex] = 0
+        return (paletteData, np.asarray(image, dtype=np.uint8), transparentIndex)
 
     # Limit the colors of an image
     # image = PIL Image object
@@ -182,96 +958,932 @@ class ugoImage:
         image = ImageOps.posterize(image, 5)
         return image.convert("P", palette=Image.ADAPTIVE, colors=paletteSlots)
 
-    # Reads an npf image from buffer, and returns an array of RGBA pixels
+    # Quantize an array of pixels with the quantizer selected by self.quantizer, ignoring their alpha
+    # pixels = 3-D array of 8-bit [r, g, b, a] pixels
+    # paletteSlots = the maximum number of colors to use
+    # Returns (paletteData, indexData), where paletteData is a 1-D array of abgr1555 colors and indexData is a 2-D array of palette indices
+    def _quantizePixels(self, pixels, paletteSlots):
+        return self._share(("quantize", self.quantizer, paletteSlots), lambda: self._quantize(pixels, paletteSlots))
+
+    def _quantize(self, pixels, paletteSlots):
+        with self._stage("quantize") as stage:
+            stage.processed(pixels.nbytes)
+            if self.quantizer == "pillow":
+                image = self._limitImageColors(Image.fromarray(pixels), paletteSlots=paletteSlots)
+                palette = np.reshape(image.getpalette(), (-1, 3))[0:paletteSlots]
+                paletteData, indexData = (packColors(palette, useAlpha=False), np.asarray(image, dtype=np.uint8))
+            else:
+                paletteData, lookup = self._histogramPalette(pixels, paletteSlots)
+                indexData = lookup[_colorKeys(pixels[..., 0:3])]
+            stage.allocated(paletteData, indexData)
+        return (paletteData, indexData)
+
+    # Quantize an array of pixels for one of the writers, which only need the palette indices a band of rows at a time
+    # With the "fast" quantizer the palette comes from a histogram built a band at a time, and each band is mapped to palette indices
+    # only when it's written, so the palette indices for the whole image never need to exist at once
+    # Returns (paletteData, getRows), where getRows(start, end) returns a 2-D array of palette indices for those rows
+    def _quantizeRows(self, pixels, paletteSlots):
+        if self.quantizer == "pillow":
+            paletteData, indexData = self._quantizePixels(pixels, paletteSlots)
+            return (paletteData, lambda start, end: indexData[start:end])
+        with self._stage("quantize") as stage:
+            stage.processed(pixels.nbytes)
+            paletteData, lookup = self._histogramPalette(pixels, paletteSlots)
+        return (paletteData, lambda start, end: lookup[_colorKeys(pixels[start:end, :, 0:3])])
+
+    # Find the fast quantizer's palette for an array of pixels, see _histogramPalette
+    # Returns (paletteData, lookup)
+    def _histogramPalette(self, pixels, paletteSlots):
+        return self._share(("palette", paletteSlots), lambda: _histogramPalette(self._colorHistogram(pixels), paletteSlots=paletteSlots))
+
+    # Count the 15-bit colors of an array of pixels a band of rows at a time
+    # Returns the pixel count of each of the 32768 possible keys from _colorKeys
+    def _colorHistogram(self, pixels):
+        def countColors():
+            histogram = np.zeros(0x8000, dtype=np.intp)
+            bandRows = max(1, self.bandPixels // max(1, pixels.shape[1]))
+            for start in range(0, pixels.shape[0], bandRows):
+                histogram += np.bincount(_colorKeys(pixels[start:start + bandRows, :, 0:3]).ravel(), minlength=0x8000)
+            return histogram
+        return self._share("histogram", countColors)
+
+    # Write 2-D image data a band of rows at a time, padding each band out to the power-of-two width as it goes
+    # size = (width, height) of the image
+    # getRows = function(start, end) returning a 2-D array of those rows
+    # packPairs = True to combine each pair of pixels into a single byte, with the first pixel in the low nibble, for NPF
+    def _writeRows(self, outputBuffer, size, getRows, packPairs=False):
+        width, height = size
+        # Keep the bands an even number of rows, so NPF pixel pairs never straddle two bands
+        bandRows = max(2, self.bandPixels // roundToPower(width) // 2 * 2)
+        for start in range(0, height, bandRows):
+            rows = getRows(start, min(start + bandRows, height))
+            imageData = self._padImageData(rows.flatten(), (width, rows.shape[0]))
+            if packPairs:
+                with self._stage("pack") as stage:
+                    stage.processed(imageData.nbytes)
+                    imageData = imageData.astype(np.uint8)
+                    # Only the last band can have an odd number of pixels, its last pixel is paired with a transparent one
+                    if imageData.size % 2:
+                        imageData = np.append(imageData, np.uint8(0))
+                    imageData = imageData[0::2] | (imageData[1::2] << 4)
+                    stage.allocated(imageData)
+            with self._stage("write") as stage:
+                stage.processed(imageData.nbytes)
+                outputBuffer.write(imageData.tobytes())
+
+    # Reads an npf image from buffer, and returns a PIL Image with RGBA mode
+    # buffer = file path, file object, or bytes-like object
     def parseNpf(self, buffer, imageWidth, imageHeight):
+        return Image.fromarray(self._expandIndexed(*self._parseNpfIndexed(buffer, imageWidth, imageHeight)))
+
+    # Reads an npf image from buffer without expanding it
+    # Returns (paletteData, indexData, transparentIndex)
+    def _parseNpfIndexed(self, buffer, imageWidth, imageHeight):
+        with self._stage("read") as stage:
+            data = _readImageData(buffer)
+            stage.processed(len(data))
         # Read the header
-        sectionLengths = self._readUgarHeader(buffer)
-        # Read the palette data (section number 1)
-        paletteData = np.frombuffer(buffer.read(roundToPower(sectionLengths[0])), dtype=np.uint16)
-        # Read the image data (section number 2)
-        imageData = np.frombuffer(buffer.read(sectionLengths[1]), dtype=np.uint8)
-        # NPF image data uses 1 byte per 2 pixels, so we need to split that byte into two
-        imageData = np.stack((np.bitwise_and(imageData, 0x0f), np.bitwise_and(imageData >> 4, 0x0f)), axis=-1).flatten()
-        # Unpack palette colors
-        palette = unpackColors(paletteData, useAlpha=False)
-        # Convert each pixel from a palette index to full color
-        pixels = np.fromiter((palette[i] if i > 0 else 0 for i in imageData), dtype=">u4")
-        # Clip the image data and create a Pillow image from it
-        return Image.fromarray(self._clipImageData(pixels, (imageWidth, imageHeight)), mode="RGBA")
+        sectionLengths = self._readUgarHeader(data)
+        offset = 8 + sectionLengths.nbytes
+        paletteLength = roundToPower(sectionLengths[0])
+        # Read the palette data (section number 1), as a view over the input data
+        paletteData = np.frombuffer(data, dtype=np.uint16, count=paletteLength // 2, offset=offset)
+        with self._stage("pixels") as stage:
+            # Read the image data (section number 2)
+            imageData = np.frombuffer(data, dtype=np.uint8, count=sectionLengths[1], offset=offset + paletteLength)
+            stage.processed(imageData.nbytes)
+            # NPF image data uses 1 byte per 2 pixels, so we need to split that byte into two
+            imageData = np.stack((np.bitwise_and(imageData, 0x0f), np.bitwise_and(imageData >> 4, 0x0f)), axis=-1).flatten()
+            stage.allocated(imageData)
+        # Clip the image data while it's still palette indices, palette index 0 is always transparent
+        # The palette is copied if it's a view over a mapped file, the image data was already split into a new array
+        return (_detachArray(paletteData, data), self._clipImageData(imageData, (imageWidth, imageHeight)), 0)
 
     # Write the image as an npf to buffer
+    # The palette is worked out first, then the pixels are written a band of rows at a time, see _writeRows
     def writeNpf(self, outputBuffer):
-        alphamap = self.image.split()[-1]
-        # Convert the image to a paletted format with 15 slots
-        image = self._limitImageColors(self.image, paletteSlots=15)
-        # Get the image palette
-        palette = np.reshape(image.getpalette(), (-1, 3))[0:15]
-        paletteData = packColors(palette, useAlpha=False)
-        paletteData = np.insert(paletteData, 0, 0)
-        # Get the image data and pad it
-        imageData = np.array(image.getdata(), dtype=np.uint8)
-        imageData = self._padImageData(imageData, image.size)
-        alphamap = self._padImageData(alphamap, image.size)
-        # Reshape image data so each item = 2 pixels
-        imageData = np.reshape(imageData, (-1, 2))
-        alphamap = np.reshape(alphamap, (-1, 2))
-        # Combine those groups of two pixels together into a single byte
-        imageData = np.array([(pix[0]+1 if a[0] > 128 else 0) | ((pix[1]+1 if a[1] > 128 else 0) << 4) for a, pix in zip(alphamap, imageData)], dtype=np.uint8)
-        # Write to buffer
-        self._writeUgarHeader(outputBuffer, paletteData.nbytes, imageData.nbytes)
-        outputBuffer.write(paletteData.tobytes())
-        outputBuffer.write(imageData.tobytes())
-
-    # Reads an nbf image from buffer, and returns an array of RGBA pixels
+        size = self.getSize()
+        indexData = self.indexData
+        # Indexed images that already fit in an NPF palette don't need to be quantized again
+        if indexData is not None and self.transparentIndex == 0 and len(self.paletteData) <= 16:
+            paletteData = np.pad(self.paletteData, (0, 16 - len(self.paletteData)))
+            getRows = lambda start, end: indexData[start:end]
+        elif indexData is not None and self.transparentIndex is None and len(self.paletteData) <= 15:
+            # Palette index 0 is reserved for transparency, so shift everything along by one
+            paletteData = np.pad(np.insert(self.paletteData, 0, 0), (0, 15 - len(self.paletteData)))
+            getRows = lambda start, end: indexData[start:end] + 1
+        else:
+            pixels = self.toArray()
+            # Convert the image to a paletted format with 15 slots
+            paletteData, getIndices = self._quantizeRows(pixels, paletteSlots=15)
+            # Palette index 0 is reserved for transparency, and the palette always has 16 slots
+            paletteData = np.insert(paletteData, 0, 0)
+            paletteData = np.pad(paletteData, (0, 16 - len(paletteData)))
+            # Palette index 0 is reserved for transparency, so offset the other indices by one and clear any pixels that are transparent
+            getRows = lambda start, end: np.where(pixels[start:end, :, 3] > 128, getIndices(start, end) + 1, 0)
+        # The section lengths are known up front, NPF uses 1 byte per 2 pixels, rounded up for images with an odd pixel count
+        with self._stage("write") as stage:
+            stage.processed(paletteData.nbytes)
+            self._writeUgarHeader(outputBuffer, paletteData.nbytes, (roundToPower(size[0]) * size[1] + 1) // 2)
+            outputBuffer.write(paletteData.tobytes())
+        self._writeRows(outputBuffer, size, getRows, packPairs=True)
+
+    # Reads an nbf image from buffer, and returns a PIL Image with RGBA mode
+    # buffer = file path, file object, or bytes-like object
     def parseNbf(self, buffer, imageWidth, imageHeight):
+        return Image.fromarray(self._expandIndexed(*self._parseNbfIndexed(buffer, imageWidth, imageHeight)))
+
+    # Reads an nbf image from buffer without expanding it
+    # Returns (paletteData, indexData, transparentIndex)
+    def _parseNbfIndexed(self, buffer, imageWidth, imageHeight):
+        with self._stage("read") as stage:
+            data = _readImageData(buffer)
+            stage.processed(len(data))
         # Read the header
-        sectionLengths = self._readUgarHeader(buffer)
-        # Read the palette data (section number 1)
-        paletteData = np.frombuffer(buffer.read(sectionLengths[0]), dtype=np.uint16)
+        sectionLengths = self._readUgarHeader(data)
+        offset = 8 + sectionLengths.nbytes
+        # Read the palette data (section number 1), as a view over the input data
+        paletteData = np.frombuffer(data, dtype=np.uint16, count=sectionLengths[0] // 2, offset=offset)
         # Read the image data (section number 2)
-        imageData = np.frombuffer(buffer.read(sectionLengths[1]), dtype=np.uint8)
-        # Convert the palette to rgb888
-        palette = unpackColors(paletteData, useAlpha=False)
-        # Convert each pixel from a palette index to full color
-        pixels = np.fromiter((palette[pixel] for pixel in imageData), dtype=">u4")
-        # Clip the image data and create a Pillow image from it
-        return Image.fromarray(self._clipImageData(pixels, (imageWidth, imageHeight)), mode="RGBA")
+        imageData = np.frombuffer(data, dtype=np.uint8, count=sectionLengths[1], offset=offset + sectionLengths[0])
+        # Clip the image data while it's still palette indices, NBF has no transparency
+        # Both are copied if they're views over a mapped file, so the image stays valid if the file is rewritten while it's loaded
+        return (_detachArray(paletteData, data), _detachArray(self._clipImageData(imageData, (imageWidth, imageHeight)), data), None)
 
     # Write the image as an nbf to buffer
+    # The palette is worked out first, then the pixels are written a band of rows at a time, see _writeRows
     def writeNbf(self, outputBuffer):
-        image = self._limitImageColors(self.image, paletteSlots=256)
-        # Get the image palette
-        palette = np.reshape(image.getpalette(), (-1, 3))
-        # Pack the palette colors
-        paletteData = packColors(palette, useAlpha=False)
-        # Get the image data and add padding
-        imageData = np.array(image.getdata(), dtype=np.uint8)
-        imageData = self._padImageData(imageData, image.size)
-        # Write to file
-        self._writeUgarHeader(outputBuffer, paletteData.nbytes, imageData.nbytes)
-        outputBuffer.write(paletteData.tobytes())
-        outputBuffer.write(imageData.tobytes())
-
-    # Reads an ntft image from buffer, and returns an array of RGBA pixels
+        size = self.getSize()
+        indexData = self.indexData
+        # Indexed images without transparency can be written as they are, without being quantized again
+        if indexData is not None and self.transparentIndex is None and len(self.paletteData) <= 256:
+            paletteData = self.paletteData
+            getRows = lambda start, end: indexData[start:end]
+        else:
+            paletteData, getRows = self._quantizeRows(self.toArray(), paletteSlots=256)
+        # The section lengths are known up front, NBF uses 1 byte per pixel
+        with self._stage("write") as stage:
+            stage.processed(paletteData.nbytes)
+            self._writeUgarHeader(outputBuffer, paletteData.nbytes, roundToPower(size[0]) * size[1])
+            outputBuffer.write(paletteData.tobytes())
+        self._writeRows(outputBuffer, size, getRows)
+
+    # Reads an ntft image from buffer, and returns a PIL Image with RGBA mode
+    # buffer = file path, file object, or bytes-like object
     def parseNtft(self, buffer, imageWidth, imageHeight):
-        # Read the image data to an array
-        imageData = np.fromfile(buffer, dtype=np.uint16)
-        # Convert the image data from rgba5551 to rgba8888
-        pixels = unpackColors(imageData, useAlpha=True)
-        # Clip the image data and create a Pillow image from it
-        return Image.fromarray(self._clipImageData(pixels, (imageWidth, imageHeight)), mode="RGBA")
+        return Image.fromarray(self._parseNtftArray(buffer, imageWidth, imageHeight))
+
+    # Reads an ntft image from buffer, and returns a 3-D array of 8-bit [r, g, b, a] pixels
+    def _parseNtftArray(self, buffer, imageWidth, imageHeight):
+        with self._stage("read") as stage:
+            data = _readImageData(buffer)
+            stage.processed(len(data))
+        # View the image data as an array, ignoring any odd trailing byte
+        imageData = np.frombuffer(data, dtype=np.uint16, count=len(data) // 2)
+        # Clip the image data, then convert it from rgba5551 to rgba8888
+        imageData = self._clipImageData(imageData, (imageWidth, imageHeight))
+        with self._stage("colors") as stage:
+            stage.processed(imageData.nbytes)
+            pixels = _unpackPixels(imageData, useAlpha=True)
+            stage.allocated(pixels.base)
+            return pixels
 
     # Write the image as an btft to buffer
+    # The pixels are converted and written a band of rows at a time, see _writeRows
     def writeNtft(self, outputBuffer):
-        imageData = self.image.getdata()
-        # Convert the pixel data to rgb
-        imageData = packColors(imageData, useAlpha=True)
-        imageData = self._padImageData(imageData, self.image.size)
-        outputBuffer.write(imageData.tobytes())
+        pixels = self.toArray()
 
-if __name__ == "__main__":
+        def getRows(start, end):
+            with self._stage("colors") as stage:
+                stage.processed(pixels[start:end].nbytes)
+                # Convert the pixel data to abgr1555, one color per pixel
+                imageData = packColors(pixels[start:end], useAlpha=True)
+                stage.allocated(imageData)
+                return imageData
+
+        self._writeRows(outputBuffer, self.getSize(), getRows)
+
+# In-memory cache of decoded images, so that loading the same image data again skips decoding it
+# Entries are keyed by a hash of the input data plus the format and image size, and the least recently used
+# entries are evicted once the decoded data takes up more than maxBytes
+class ugoImageCache:
+
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    # Load an image through the cache, takes the same arguments as ugoImage.load
+    # Returns a ugoImage object, which can be modified freely without affecting the cached copy
+    def load(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0):
+        if not imageFormat and isinstance(imageBuffer, (str, os.PathLike)):
+            imageFormat = os.path.splitext(imageBuffer)[1][1:]
+        data = _readImageData(imageBuffer)
+        key = (hashlib.blake2b(data, digest_size=20).digest(), (imageFormat or "").lower(), imageWidth, imageHeight)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            entry = self._makeEntry(ugoImage(data, imageFormat=imageFormat, imageWidth=imageWidth, imageHeight=imageHeight))
+            self._store(key, entry)
+        return self._restoreEntry(entry)
+
+    # Get the cache counters
+    # Returns a dict of hits, misses, evictions, entries and bytes
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.currentBytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.currentBytes = 0
+
+    # Snapshot a decoded image for the cache
+    # Arrays are copied so the entry doesn't keep any memory-mapped input alive, and made read-only since they are shared
+    # Returns (paletteData, indexData, transparentIndex, pixelData, image, size in bytes)
+    def _makeEntry(self, ugo):
+        paletteData = indexData = pixelData = image = None
+        size = 0
+        if ugo.indexData is not None:
+            paletteData = np.array(ugo.paletteData)
+            indexData = np.array(ugo.indexData)
+            paletteData.flags.writeable = False
+            indexData.flags.writeable = False
+            size += paletteData.nbytes + indexData.nbytes
+        elif ugo.pixelData is not None:
+            pixelData = np.array(ugo.pixelData)
+            pixelData.flags.writeable = False
+            size += pixelData.nbytes
+        # Only keep the Pillow image if it was loaded by Pillow, rather than made from one of the other forms
+        if ugo._image is not None:
+            image = ugo._image.copy()
+            size += image.width * image.height * len(image.getbands())
+        return (paletteData, indexData, ugo.transparentIndex, pixelData, image, size)
+
+    # Build a new ugoImage from a cache entry
+    def _restoreEntry(self, entry):
+        paletteData, indexData, transparentIndex, pixelData, image, size = entry
+        ugo = ugoImage()
+        if indexData is not None:
+            ugo._setIndexed(paletteData, indexData, transparentIndex)
+            ugo._image = image.copy() if image is not None else None
+        elif pixelData is not None:
+            ugo._setPixels(pixelData.copy())
+        else:
+            ugo.image = image.copy()
+        return ugo
 
-    import sys, os
+    # Add an entry, evicting the least recently used ones until everything fits
+    def _store(self, key, entry):
+        size = entry[-1]
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.currentBytes += size
+            while self.currentBytes > self.maxBytes:
+                oldKey, oldEntry = self.entries.popitem(last=False)
+                self.currentBytes -= oldEntry[-1]
+                self.evictions += 1
+
+# On-disk cache of conversion results, so a conversion can be skipped if its input and settings haven't changed
+# Results are stored in directory, named after a hash of the input data, the formats, the image size and the ugoImage version
+# The cache can grow past maxBytes while it's being written to, prune brings it back down by removing the least recently used results
+class ugoConversionCache:
+
+    def __init__(self, directory, maxBytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    # Hash the input of a conversion, so keys for several conversions of the same input only need to read it once
+    # inputData = path or bytes-like object containing the image to convert
+    # Returns a hash object to pass to key
+    def inputDigest(self, inputData):
+        return hashlib.blake2b(_readImageData(inputData), digest_size=20)
+
+    # Get the cache key for a conversion
+    # inputData = path or bytes-like object containing the image to convert, or a hash object from inputDigest
+    # Returns a hex string
+    # thumbnail = (maxWidth, maxHeight, samples) if the conversion makes a thumbnail, else None
+    def key(self, inputData, inputFormat, outputFormat, imageWidth=0, imageHeight=0, quantizer=None, thumbnail=None):
+        digest = inputData.copy() if hasattr(inputData, "hexdigest") else self.inputDigest(inputData)
+        settings = [VERSION, inputFormat.lower(), outputFormat.lower(), imageWidth, imageHeight, quantizer or ugoImage.quantizer]
+        if thumbnail:
+            settings += ["thumbnail"] + list(thumbnail)
+        digest.update("|".join(str(setting) for setting in settings).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0:2], key)
+
+    # Returns the cached output as bytes, or None
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as cached:
+                outputData = cached.read()
+        except FileNotFoundError:
+            return None
+        # Mark the result as recently used, so prune keeps it
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return outputData
+
+    def put(self, key, outputData):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that other processes never see a half-written result
+        tempPath = path + ".{}.tmp".format(os.getpid())
+        with open(tempPath, "wb") as outfile:
+            outfile.write(outputData)
+        os.replace(tempPath, path)
+
+    # Remove the least recently used results until the cache fits in maxBytes
+    # Results still being written by other processes are left alone
+    # Returns the number of results removed
+    def prune(self):
+        entries = []
+        for dirPath, dirNames, fileNames in os.walk(self.directory):
+            for fileName in fileNames:
+                if fileName.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirPath, fileName)
+                try:
+                    fileStat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((fileStat.st_mtime_ns, fileStat.st_size, path))
+        totalBytes = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            totalBytes -= size
+        return removed
+
+# Check an NTFT, NBF or NPF file without decoding it, by reading only its size and UGAR header
+# source = file path, or bytes-like object
+# imageFormat = "ntft", "nbf" or "npf", if source is a path this defaults to the file extension
+# imageWidth, imageHeight = expected image size, optional, the section lengths are checked against them if given
+# Returns a dict with these keys:
+#   format = image format
+#   valid = True if no problems were found
+#   errors = list of problems found
+#   fileSize = size of the file in bytes
+#   sectionLengths = list of UGAR section lengths, or None for NTFT
+#   paletteSize = number of palette colors, or None for NTFT
+#   paddedWidth = power-of-two width the pixel data is stored at, taken from imageWidth if given, else inferred from imageHeight
+def probe(source, imageFormat=None, imageWidth=0, imageHeight=0):
+    if isinstance(source, (str, os.PathLike)):
+        if not imageFormat:
+            imageFormat = os.path.splitext(source)[1][1:]
+        fileSize = os.path.getsize(source)
+        with open(source, "rb") as file:
+            header = file.read(8)
+            # Only read as much of the section table as a valid file could have
+            if len(header) == 8:
+                header += file.read(4 * min(int(np.frombuffer(header, dtype=np.uint32, count=1, offset=4)[0]), 16))
+    else:
+        fileSize = len(source)
+        header = bytes(source[0:8 + 4 * 16])
+    imageFormat = (imageFormat or "").lower()
+    result = {"format": imageFormat, "valid": True, "errors": [], "fileSize": fileSize, "sectionLengths": None, "paletteSize": None, "paddedWidth": None}
+    errors = result["errors"]
+    paddedWidth = roundToPower(imageWidth) if imageWidth > 0 else 0
+
+    if imageFormat == "ntft":
+        # NTFT is just the pixel data, 2 bytes per pixel
+        if fileSize % 2 != 0:
+            errors.append("file size {} is not a whole number of pixels".format(fileSize))
+        if imageHeight > 0 and not paddedWidth and fileSize // 2 % imageHeight == 0:
+            paddedWidth = fileSize // 2 // imageHeight
+        if paddedWidth and imageHeight > 0 and fileSize != paddedWidth * imageHeight * 2:
+            errors.append("file size {} doesn't match the expected size {}".format(fileSize, paddedWidth * imageHeight * 2))
+
+    elif imageFormat in ["nbf", "npf"]:
+        if header[0:4] != b"UGAR" or len(header) < 8:
+            errors.append("missing UGAR header")
+        else:
+            sectionCount = int(np.frombuffer(header, dtype=np.uint32, count=1, offset=4)[0])
+            sectionLengths = [int(length) for length in np.frombuffer(header, dtype=np.uint32, count=(len(header) - 8) // 4, offset=8)][0:sectionCount]
+            result["sectionLengths"] = sectionLengths
+            if sectionCount != 2 or len(sectionLengths) != 2:
+                errors.append("expected 2 sections, found {}".format(sectionCount))
+            else:
+                paletteLength, imageLength = sectionLengths
+                # parseNpf reads the palette section rounded up to a power of two
+                if imageFormat == "npf":
+                    paletteLength = roundToPower(paletteLength)
+                result["paletteSize"] = sectionLengths[0] // 2
+                if sectionLengths[0] % 2 != 0:
+                    errors.append("palette length {} is not a whole number of colors".format(sectionLengths[0]))
+                if result["paletteSize"] > (16 if imageFormat == "npf" else 256):
+                    errors.append("palette has {} colors, too many for {}".format(result["paletteSize"], imageFormat))
+                expectedSize = 8 + 4 * sectionCount + paletteLength + imageLength
+                if fileSize != expectedSize:
+                    errors.append("file size {} doesn't match the size given by the section table {}".format(fileSize, expectedSize))
+                # NPF stores 2 pixels per byte, with the last byte half empty if the pixel count is odd, NBF stores 1
+                pixelCount = imageLength * 2 if imageFormat == "npf" else imageLength
+                if imageHeight > 0 and not paddedWidth and pixelCount % imageHeight == 0:
+                    paddedWidth = pixelCount // imageHeight
+                expectedLength = (paddedWidth * imageHeight + 1) // 2 if imageFormat == "npf" else paddedWidth * imageHeight
+                if paddedWidth and imageHeight > 0 and imageLength != expectedLength:
+                    errors.append("pixel data has {} pixels, expected {}".format(pixelCount, paddedWidth * imageHeight))
+
+    else:
+        errors.append("unknown format " + repr(imageFormat))
+
+    result["paddedWidth"] = paddedWidth or None
+    result["valid"] = not errors
+    return result
+
+# Probe many files at once, using a pool of threads since probing is mostly waiting on the disk
+# paths = iterable of file paths, it's only read as far ahead as the threads need, so it can be a generator over millions of files
+# imageWidth, imageHeight = expected image size, optional
+# threads = number of threads to use
+# Yields (path, probe result) for each path, in order
+def probeFiles(paths, imageWidth=0, imageHeight=0, threads=32):
+    def probePath(path):
+        try:
+            return (path, probe(path, imageWidth=imageWidth, imageHeight=imageHeight))
+        except OSError as error:
+            return (path, {"format": None, "valid": False, "errors": [str(error)], "fileSize": None, "sectionLengths": None, "paletteSize": None, "paddedWidth": None})
+
+    # Only keep a few probes per thread in flight, rather than submitting every path up front
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque(executor.submit(probePath, path) for path in itertools.islice(paths, threads * 4))
+        while pending:
+            result = pending.popleft().result()
+            for path in itertools.islice(paths, 1):
+                pending.append(executor.submit(probePath, path))
+            yield result
+
+# Find every NTFT, NBF and NPF file in a directory tree or glob pattern
+# Yields paths as they're found, sorted within each directory, without listing the whole tree first
+def findFlipnoteImages(source):
+    if os.path.isdir(source):
+        for dirPath, dirNames, fileNames in os.walk(source):
+            dirNames.sort()
+            for fileName in sorted(fileNames):
+                if os.path.splitext(fileName)[1][1:].lower() in ["npf", "nbf", "ntft"]:
+                    yield os.path.join(dirPath, fileName)
+    elif glob.has_magic(source):
+        for path in glob.iglob(source, recursive=True):
+            if os.path.isfile(path):
+                yield path
+    else:
+        yield source
+
+# Convert an image file from one format to another, using the file extensions to pick the formats
+# inputPath = path to the image to convert
+# outputPath = path to write the converted image to, missing directories will be created
+# imageWidth, imageHeight = image size, only needed if the input is an NTFT, NBF or NPF
+# conversionCache = optional ugoConversionCache, the conversion is skipped if the cache already has the result
+# stats = optional ugoImageStats object to record per-stage profiling stats to
+# thumbnail = (maxWidth, maxHeight, samples) to write a thumbnail instead of the full image, see ugoImage.loadThumbnail
+# Returns True if the result came from conversionCache, else False
+def convertFile(inputPath, outputPath, imageWidth=0, imageHeight=0, conversionCache=None, stats=None, thumbnail=None):
+    inputFormat = os.path.splitext(inputPath)[1][1:]
+    outputFormat = os.path.splitext(outputPath)[1][1:]
+    if inputFormat.lower() in ["npf", "nbf", "ntft"] and (imageWidth <= 0 or imageHeight <= 0):
+        raise ValueError("width and height must be specified for " + inputPath)
+    outputData = None
+    if conversionCache:
+        inputData = _readImageData(inputPath)
+        cacheKey = conversionCache.key(inputData, inputFormat, outputFormat, imageWidth, imageHeight, thumbnail=thumbnail)
+        outputData = conversionCache.get(cacheKey)
+    cached = outputData is not None
+    if not cached:
+        image = ugoImage(stats=stats)
+        if thumbnail:
+            maxWidth, maxHeight, samples = thumbnail
+            image.loadThumbnail(inputData if conversionCache else inputPath, imageFormat=inputFormat, imageWidth=imageWidth, imageHeight=imageHeight, maxSize=(maxWidth, maxHeight), samples=samples)
+        else:
+            image.load(inputData if conversionCache else inputPath, imageFormat=inputFormat, imageWidth=imageWidth, imageHeight=imageHeight)
+        outputBuffer = BytesIO()
+        image.save(outputBuffer, imageFormat=outputFormat)
+        outputData = outputBuffer.getvalue()
+        if conversionCache:
+            conversionCache.put(cacheKey, outputData)
+    outputDir = os.path.dirname(outputPath)
+    if outputDir:
+        os.makedirs(outputDir, exist_ok=True)
+    with open(outputPath, "wb") as outfile:
+        outfile.write(outputData)
+    return cached
+
+# Convert image data held in memory from one format to another
+# inputData = bytes-like object containing the image to convert, NTFT, NBF and NPF data is read without being copied
+# inputFormat, outputFormat = format names, e.g. "nbf" or "png"
+# imageWidth, imageHeight = image size, only needed if the input is an NTFT, NBF or NPF
+# Returns the converted image as bytes
+def convertBytes(inputData, inputFormat, outputFormat, imageWidth=0, imageHeight=0):
+    if inputFormat.lower() in ["npf", "nbf", "ntft"] and (imageWidth <= 0 or imageHeight <= 0):
+        raise ValueError("width and height must be specified for " + inputFormat + " images")
+    image = ugoImage()
+    image.load(inputData, imageFormat=inputFormat, imageWidth=imageWidth, imageHeight=imageHeight)
+    outputBuffer = BytesIO()
+    image.save(outputBuffer, imageFormat=outputFormat)
+    return outputBuffer.getvalue()
+
+# Run a single batch job inside a worker process, catching any errors so they don't end the batch
+# job = (inputPath, outputPath, imageWidth, imageHeight)
+# cacheDir = optional directory for a ugoConversionCache
+# profile = if True, record per-stage profiling stats for the job
+# thumbnail = (maxWidth, maxHeight, samples) to write a thumbnail instead of the full image
+# Returns (inputPath, error message or None, number of input bytes, True if the result came from the cache, ugoImageStats or None)
+def _convertJob(job, cacheDir=None, profile=False, thumbnail=None):
+    inputPath, outputPath, imageWidth, imageHeight = job
+    stats = ugoImageStats() if profile else None
+    try:
+        cached = convertFile(inputPath, outputPath, imageWidth, imageHeight, conversionCache=ugoConversionCache(cacheDir) if cacheDir else None, stats=stats, thumbnail=thumbnail)
+        return (inputPath, None, os.path.getsize(inputPath), cached, stats)
+    except Exception as error:
+        return (inputPath, "{}: {}".format(type(error).__name__, error), 0, False, stats)
+
+# Build a list of batch jobs from a directory, glob pattern or manifest file
+# source = directory path, glob pattern or manifest file path
+# outputDir = directory to write the converted images to, the input directory structure is mirrored inside it
+# outputFormat = format to convert to, manifest entries can override this
+# imageWidth, imageHeight = image size to use for NTFT, NBF and NPF inputs, manifest entries can override this
+# Inputs with the same name but different extensions keep their extension in the output name, e.g. x.nbf.png and x.npf.png
+# Raises ValueError if two jobs would still write the same output file
+# Returns a list of (inputPath, outputPath, imageWidth, imageHeight) jobs
+def findBatchJobs(source, outputDir, outputFormat=None, imageWidth=0, imageHeight=0):
+    entries = []
+    # Earlier outputs shouldn't be picked up as inputs when outputDir is inside the source directory
+    outputRoot = os.path.realpath(outputDir)
+    isOutput = lambda path: os.path.commonpath([os.path.realpath(path), outputRoot]) == outputRoot
+    if os.path.isdir(source):
+        # Pick up every file in the directory tree that is either a Flipnote image or something Pillow can open
+        # Formats Pillow can only save are left out (MPO files are opened by its JPEG plugin), and so is .ppm, which is a Flipnote animation
+        # here rather than a Netpbm image
+        openable = lambda imageFormat: imageFormat in Image.OPEN or imageFormat == "MPO"
+        extensions = set(["npf", "nbf", "ntft"] + [ext[1:] for ext, imageFormat in Image.registered_extensions().items() if openable(imageFormat)])
+        extensions.discard("ppm")
+        for dirPath, dirNames, fileNames in os.walk(source):
+            dirNames[:] = sorted(dirName for dirName in dirNames if not isOutput(os.path.join(dirPath, dirName)))
+            for fileName in sorted(fileNames):
+                if os.path.splitext(fileName)[1][1:].lower() in extensions:
+                    entries.append((os.path.join(dirPath, fileName), outputFormat, imageWidth, imageHeight))
+        root = source
+    else:
+        if glob.has_magic(source):
+            entries = [(path, outputFormat, imageWidth, imageHeight) for path in sorted(glob.glob(source, recursive=True)) if os.path.isfile(path) and not isOutput(path)]
+        else:
+            manifestDir = os.path.dirname(os.path.abspath(source))
+            with open(source, newline="") as manifest:
+                for row in csv.reader(manifest):
+                    row = [column.strip() for column in row]
+                    # Skip blank lines and comments
+                    if not row or not row[0] or row[0].startswith("#"):
+                        continue
+                    path = os.path.join(manifestDir, row[0])
+                    rowFormat = row[1] if len(row) > 1 and row[1] else outputFormat
+                    rowWidth = int(row[2]) if len(row) > 2 and row[2] else imageWidth
+                    rowHeight = int(row[3]) if len(row) > 3 and row[3] else imageHeight
+                    entries.append((path, rowFormat, rowWidth, rowHeight))
+        # Mirror the tree below the deepest directory that all the inputs share
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(entry[0])) for entry in entries]) if entries else ""
+    outputs = []
+    for path, jobFormat, width, height in entries:
+        if not jobFormat:
+            raise ValueError("no output format given for " + path)
+        relativePath = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+        outputs.append((os.path.splitext(relativePath)[0], relativePath, "." + jobFormat.lstrip(".")))
+    # Count the outputs case-insensitively, since x.NBF and x.nbf would collide on some filesystems
+    stemCounts = Counter((stem + extension).lower() for stem, relativePath, extension in outputs)
+    jobs = []
+    seen = set()
+    for (path, jobFormat, width, height), (stem, relativePath, extension) in zip(entries, outputs):
+        outputName = (relativePath if stemCounts[(stem + extension).lower()] > 1 else stem) + extension
+        if outputName.lower() in seen:
+            raise ValueError("more than one job would write to " + os.path.join(outputDir, outputName))
+        seen.add(outputName.lower())
+        jobs.append((path, os.path.join(outputDir, outputName), width, height))
+    return jobs
+
+# Convert many images in parallel, spreading the jobs over a pool of worker processes
+# jobs = list of (inputPath, outputPath, imageWidth, imageHeight) jobs, as returned by findBatchJobs
+# processes = number of worker processes to use, defaults to the number of CPU cores
+# cacheDir = optional directory for a ugoConversionCache, jobs whose results are already cached are skipped, and the cache is pruned
+# once every job has finished
+# profile = if True, each result includes the per-stage profiling stats for its job
+# thumbnail = (maxWidth, maxHeight, samples) to write thumbnails instead of the full images, see ugoImage.loadThumbnail
+# Yields (inputPath, error message or None, number of input bytes, True if the result came from the cache, ugoImageStats or None) for each job, in order, as they complete
+def batchConvert(jobs, processes=None, cacheDir=None, profile=False, thumbnail=None):
+    processes = processes or os.cpu_count() or 1
+    # Hand the jobs to the workers in chunks to keep the inter-process overhead down for small images
+    chunkSize = max(1, min(64, len(jobs) // (processes * 4)))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for result in executor.map(partial(_convertJob, cacheDir=cacheDir, profile=profile, thumbnail=thumbnail), jobs, chunksize=chunkSize):
+            yield result
+    if cacheDir:
+        ugoConversionCache(cacheDir).prune()
+
+# Write a preview of every image in a directory, glob pattern or manifest file, mirroring the input tree under outputDir
+# source, outputDir, imageWidth, imageHeight = same as findBatchJobs
+# maxSize, samples = same as ugoImage.loadThumbnail
+# outputFormat = format to write the previews in
+# processes, cacheDir = same as batchConvert
+# Yields the same results as batchConvert
+def batchThumbnails(source, outputDir, imageWidth=0, imageHeight=0, maxSize=(64, 48), samples=1, outputFormat="png", processes=None, cacheDir=None):
+    jobs = findBatchJobs(source, outputDir, outputFormat=outputFormat, imageWidth=imageWidth, imageHeight=imageHeight)
+    return batchConvert(jobs, processes=processes, cacheDir=cacheDir, thumbnail=(maxSize[0], maxSize[1], samples))
+
+# Handle a single conversion request inside a worker process, catching any errors so they can be sent back to the client
+# request = dict decoded from a request line, see the usage notes at the top of this file
+# Returns a response dict
+def _workerRequest(request):
+    response = {"id": request.get("id")}
+    try:
+        inputPath = request.get("inputPath")
+        inputFormat = request.get("inputFormat") or (os.path.splitext(inputPath)[1][1:] if inputPath else None)
+        outputFormat = request.get("outputFormat")
+        if not inputFormat or not outputFormat:
+            raise ValueError("request needs an inputFormat and outputFormat")
+        if inputPath:
+            with open(inputPath, "rb") as infile:
+                inputData = infile.read()
+        elif "input" in request:
+            inputData = base64.b64decode(request["input"])
+        else:
+            raise ValueError("request needs either input or inputPath")
+        outputData = convertBytes(inputData, inputFormat, outputFormat, int(request.get("width", 0)), int(request.get("height", 0)))
+        outputPath = request.get("outputPath")
+        if outputPath:
+            with open(outputPath, "wb") as outfile:
+                outfile.write(outputData)
+            response["outputPath"] = outputPath
+        else:
+            response["output"] = base64.b64encode(outputData).decode("ascii")
+        response["ok"] = True
+    except Exception as error:
+        response["ok"] = False
+        response["error"] = "{}: {}".format(type(error).__name__, error)
+    return response
+
+# Long-lived conversion worker, keeps a warm pool of processes around so each request skips interpreter startup and imports
+# Requests and responses are JSON objects, one per line
+class ugoImageWorker:
+
+    # processes = number of worker processes to use, defaults to the number of CPU cores
+    # maxInFlight = maximum number of requests serveStream converts at once, defaults to 4 times the number of processes
+    def __init__(self, processes=None, maxInFlight=None):
+        processes = processes or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        self.maxInFlight = maxInFlight or processes * 4
+
+    # Decode a request line and hand it to the process pool
+    # line = bytes or str containing one JSON request
+    # Returns a Future that resolves to a response dict, including when the request or the pool fails
+    def submit(self, line):
+        response = Future()
+        requestId = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as error:
+            # Don't bother the pool with requests that can't be handled
+            response.set_result({"id": None, "ok": False, "error": "invalid request: " + str(error)})
+            return response
+        requestId = request.get("id")
+
+        def finish(future):
+            try:
+                response.set_result(future.result())
+            except Exception as error:
+                # The pool itself failed, for example a worker process died, so the request still needs an answer
+                response.set_result({"id": requestId, "ok": False, "error": "{}: {}".format(type(error).__name__, error)})
+
+        try:
+            self.executor.submit(_workerRequest, request).add_done_callback(finish)
+        except Exception as error:
+            response.set_result({"id": requestId, "ok": False, "error": "{}: {}".format(type(error).__name__, error)})
+        return response
+
+    # Serve requests read from one stream, writing responses to another
+    # Requests are converted concurrently, so responses are written as they finish rather than in request order
+    # At most maxInFlight requests are converting at once, after that reading the input waits for one of them to finish,
+    # so a long-running worker only ever holds the requests it's working on
+    def serveStream(self, inputStream, outputStream):
+        writeLock = Lock()
+        inFlightChanged = Condition()
+        inFlight = set()
+        slots = BoundedSemaphore(self.maxInFlight)
+
+        def writeResponse(future):
+            try:
+                with writeLock:
+                    outputStream.write(json.dumps(future.result()).encode("utf-8") + b"\n")
+                    outputStream.flush()
+            finally:
+                with inFlightChanged:
+                    inFlight.discard(future)
+                    inFlightChanged.notify_all()
+                slots.release()
+
+        for line in inputStream:
+            if line.strip():
+                slots.acquire()
+                future = self.submit(line)
+                # Added before the callback, which runs straight away if the request was already answered
+                with inFlightChanged:
+                    inFlight.add(future)
+                future.add_done_callback(writeResponse)
+        # Wait for any conversions that are still running once the input has ended, and for their responses to be written,
+        # which happens after the futures themselves are done
+        with inFlightChanged:
+            inFlightChanged.wait_for(lambda: not inFlight)
+
+    # Serve requests over a Unix socket, one thread per connected client
+    # Each client gets its responses back in the same order it sent the requests
+    def serveSocket(self, socketPath):
+        worker = self
+
+        class requestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        response = worker.submit(line).result()
+                        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                        self.wfile.flush()
+
+        # Remove a socket left behind by a previous run, but never anything else that happens to be at that path
+        try:
+            if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                raise FileExistsError("{} already exists and isn't a socket".format(socketPath))
+            os.remove(socketPath)
+        except FileNotFoundError:
+            pass
+        server = socketserver.ThreadingUnixStreamServer(socketPath, requestHandler)
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socketPath)
+
+    def close(self):
+        self.executor.shutdown()
+
+# Load an image inside an executor, for ugoImageAsync
+# Returns a ugoImage object
+def _loadJob(imageBuffer, imageFormat, imageWidth, imageHeight):
+    return ugoImage(imageBuffer, imageFormat=imageFormat, imageWidth=imageWidth, imageHeight=imageHeight)
+
+# Encode an image inside an executor, for ugoImageAsync
+# Returns the encoded image as bytes
+def _saveJob(image, imageFormat):
+    outputBuffer = BytesIO()
+    image.save(outputBuffer, imageFormat)
+    return outputBuffer.getvalue()
+
+# Raised by ugoImageAsync when it already has as many requests as it's allowed to hold
+class ugoImageBusyError(RuntimeError):
+    pass
+
+# asyncio front end for ugoImage, so that decoding and encoding don't block the event loop
+# The work is run on a thread or process pool, and at most maxConcurrent jobs run at once
+# Requests beyond that wait their turn, until maxPending requests are waiting or running, after which new requests
+# raise ugoImageBusyError straight away, so a burst of requests can't queue up an unbounded amount of image data
+class ugoImageAsync:
+
+    # executor = "thread", "process", or any concurrent.futures.Executor to run the jobs on
+    # maxConcurrent = maximum number of jobs to run at once, defaults to the number of CPU cores
+    # maxPending = maximum number of requests to hold at once, including the running ones, defaults to 4 times maxConcurrent
+    def __init__(self, executor="thread", maxConcurrent=None, maxPending=None):
+        self.maxConcurrent = maxConcurrent or os.cpu_count() or 1
+        self.maxPending = maxPending or self.maxConcurrent * 4
+        self.ownsExecutor = not hasattr(executor, "submit")
+        if executor == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.maxConcurrent)
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.maxConcurrent)
+        elif self.ownsExecutor:
+            raise ValueError("executor must be \"thread\", \"process\" or an Executor")
+        else:
+            self.executor = executor
+        # Arguments have to be pickled to reach a process pool
+        self.usesProcesses = isinstance(self.executor, ProcessPoolExecutor)
+        self.pending = 0
+        self.running = 0
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        self.close()
+
+    # Load an image without blocking the event loop, takes the same arguments as ugoImage.load
+    # Returns a ugoImage object
+    async def loadAsync(self, imageBuffer, imageFormat=None, imageWidth=0, imageHeight=0):
+        if not imageFormat and isinstance(imageBuffer, (str, os.PathLike)):
+            imageFormat = os.path.splitext(imageBuffer)[1][1:]
+        return await self._run(_loadJob, await self._prepareInput(imageBuffer), imageFormat, imageWidth, imageHeight)
+
+    # Encode an image without blocking the event loop
+    # image = ugoImage object
+    # outputBuffer = file path or file object to write to, or None to only return the encoded data
+    # Returns the encoded image as bytes
+    async def saveAsync(self, image, outputBuffer, imageFormat):
+        outputData = await self._run(_saveJob, image, imageFormat)
+        if outputBuffer is not None:
+            await self._writeOutput(outputBuffer, outputData)
+        return outputData
+
+    # Convert an image from one format to another without blocking the event loop
+    # inputData = file path, file object, or bytes-like object containing the image to convert
+    # inputFormat, outputFormat = format names, e.g. "nbf" or "png"
+    # imageWidth, imageHeight = image size, only needed if the input is an NTFT, NBF or NPF
+    # Returns the converted image as bytes
+    async def convertAsync(self, inputData, inputFormat, outputFormat, imageWidth=0, imageHeight=0):
+        return await self._run(convertBytes, await self._prepareInput(inputData), inputFormat, outputFormat, imageWidth, imageHeight)
+
+    # Get the current load
+    # Returns a dict of running, pending, maxConcurrent and maxPending
+    def stats(self):
+        return {"running": self.running, "pending": self.pending, "maxConcurrent": self.maxConcurrent, "maxPending": self.maxPending}
+
+    def close(self):
+        if self.ownsExecutor:
+            self.executor.shutdown()
+
+    # File objects and memory maps can't be sent to another process, so read them into bytes first
+    async def _prepareInput(self, imageBuffer):
+        if not self.usesProcesses or isinstance(imageBuffer, (str, os.PathLike, bytes)):
+            return imageBuffer
+        if _isBytesLike(imageBuffer):
+            return bytes(imageBuffer)
+        # Reading a file object can block, so use the event loop's default executor rather than taking up a conversion slot
+        return await asyncio.get_running_loop().run_in_executor(None, imageBuffer.read)
+
+    async def _writeOutput(self, outputBuffer, outputData):
+        loop = asyncio.get_running_loop()
+        if isinstance(outputBuffer, (str, os.PathLike)):
+            def writeFile():
+                with open(outputBuffer, "wb") as outfile:
+                    outfile.write(outputData)
+            await loop.run_in_executor(None, writeFile)
+        else:
+            await loop.run_in_executor(None, outputBuffer.write, outputData)
+
+    # Run a job on the executor once there's a free slot
+    async def _run(self, func, *args):
+        if self.pending >= self.maxPending:
+            raise ugoImageBusyError("too many pending requests ({})".format(self.pending))
+        if self.semaphore is None:
+            # Made here rather than in __init__ so that it belongs to the running event loop
+            self.semaphore = asyncio.Semaphore(self.maxConcurrent)
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        acquired = submitted = False
+        try:
+            await self.semaphore.acquire()
+            acquired = True
+            self.running += 1
+            job = self.executor.submit(func, *args)
+            submitted = True
+        finally:
+            # Once the job is submitted its done callback gives the slot back, before that it's up to us
+            if not submitted:
+                if acquired:
+                    self.running -= 1
+                    self.semaphore.release()
+                self.pending -= 1
+
+        # The slot is only given back once the job has really finished, even if the caller stops waiting for it,
+        # since a cancelled await can't stop a job that's already running
+        def release(job):
+            self.running -= 1
+            self.pending -= 1
+            self.semaphore.release()
+
+        job.add_done_callback(lambda job: loop.call_soon_threadsafe(release, job))
+        return await asyncio.wrap_future(job)
+
+if __name__ == "__main__":
 
     def representsInt(s):
         try:
@@ -283,8 +1895,6 @@ if __name__ == "__main__":
     args = sys.argv[1::]
     argIndex = 0
 
-    image = ugoImage()
-
     if "-v" in args:
         print(VERSION)
         sys.exit()
@@ -311,6 +1921,33 @@ if __name__ == "__main__":
             "Convert a standard image format like PNG to NTFT, NBF, or NPF:",
             "Python3 ugoImage.py -i input_path -o output_path",
             "",
+            "Give more than one -o to write several formats at once, sharing the work they have in common:",
+            "Python3 ugoImage.py -i input_path -o output.ntft -o output.nbf -o output.npf -o preview.png",
+            "",
+            "Convert a directory, glob pattern or manifest file of images in parallel, mirroring the input tree under output_dir:",
+            "Python3 ugoImage.py -b input_source output_dir output_format (image_width image_height) (-j processes)",
+            "",
+            "Each line of a manifest file is input_path,output_format,image_width,image_height, where the width and height",
+            "are only needed for NTFT, NBF and NPF inputs. Relative paths are relative to the manifest file.",
+            "",
+            "Check NTFT, NBF and NPF files without decoding them, optionally against an expected image size:",
+            "Python3 ugoImage.py -p input_source (image_width image_height) (-j threads)",
+            "",
+            "Add -c cache_dir to either of the conversion modes above to keep converted images in cache_dir, and skip any conversions whose input",
+            "and settings haven't changed since they were last cached. Once the conversions are done, the least recently used images are",
+            "removed until the cache fits in 1 GB",
+            "",
+            "Add -t max_width max_height (samples) to either of the conversion modes above to write thumbnails that fit in max_width x max_height instead,",
+            "NTFT, NBF and NPF thumbnails are sampled straight from the stored data, averaging samples x samples pixels for each thumbnail pixel",
+            "",
+            "Add --profile to the single file or batch conversion modes to print a per-stage breakdown of where the time and memory went",
+            "",
+            "Since version 1.1.0, NBF and NPF palettes are picked by a faster median cut quantizer, so their bytes differ from those written by 1.0.5",
+            "and earlier. To get the old output back, set ugoImage.quantizer = \"pillow\" before converting",
+            "",
+            "Run as a long-lived conversion worker, serving JSON-lines requests over a Unix socket, or stdin/stdout if no socket is given:",
+            "Python3 ugoImage.py -s (socket_path) (-j processes)",
+            "",
             "Issues:",
             "=======",
             "",
@@ -320,6 +1957,134 @@ if __name__ == "__main__":
         ]))
         sys.exit()
 
+    # Number of worker processes for batch and worker modes
+    processes = None
+
+    if "-j" in args:
+        jIndex = args.index("-j")
+        if jIndex + 1 >= len(args) or not representsInt(args[jIndex + 1]):
+            print("Error: -j must be followed by the number of processes to use")
+            sys.exit(1)
+        processes = int(args[jIndex + 1])
+        args = args[0:jIndex] + args[jIndex + 2::]
+
+    # Directory for the conversion cache, used by the single file and batch modes
+    cacheDir = None
+
+    if "-c" in args:
+        cIndex = args.index("-c")
+        if cIndex + 1 >= len(args):
+            print("Error: -c must be followed by a cache directory")
+            sys.exit(1)
+        cacheDir = args[cIndex + 1]
+        args = args[0:cIndex] + args[cIndex + 2::]
+
+    # Thumbnail size for the single file and batch modes, as (max_width, max_height, samples)
+    thumbnail = None
+
+    if "-t" in args:
+        tIndex = args.index("-t")
+        thumbArgs = args[tIndex + 1:tIndex + 4]
+        if len(thumbArgs) < 2 or not representsInt(thumbArgs[0]) or not representsInt(thumbArgs[1]):
+            print("Error: -t must be followed by the maximum thumbnail width and height")
+            sys.exit(1)
+        samples = int(thumbArgs[2]) if len(thumbArgs) > 2 and representsInt(thumbArgs[2]) else 1
+        thumbnail = (int(thumbArgs[0]), int(thumbArgs[1]), samples)
+        args = args[0:tIndex] + args[tIndex + (4 if len(thumbArgs) > 2 and representsInt(thumbArgs[2]) else 3)::]
+
+    # Per-stage profiling stats for the single file and batch modes
+    stats = None
+
+    if "--profile" in args:
+        args.remove("--profile")
+        stats = ugoImageStats()
+
+    if "-s" in args:
+        argIndex = args.index("-s")
+        socketPath = args[argIndex + 1] if argIndex + 1 < len(args) else None
+        worker = ugoImageWorker(processes=processes)
+
+        try:
+            if socketPath:
+                worker.serveSocket(socketPath)
+            else:
+                worker.serveStream(sys.stdin.buffer, sys.stdout.buffer)
+        except KeyboardInterrupt:
+            pass
+        except FileExistsError as error:
+            print("Error: " + str(error))
+            sys.exit(1)
+        finally:
+            worker.close()
+
+        sys.exit()
+
+    if "-p" in args:
+        argIndex = args.index("-p")
+        probeArgs = args[argIndex + 1::]
+
+        if not probeArgs:
+            print("Error: probe mode needs an input source")
+            sys.exit(1)
+
+        width = int(probeArgs[1]) if len(probeArgs) > 1 and representsInt(probeArgs[1]) else 0
+        height = int(probeArgs[2]) if len(probeArgs) > 2 and representsInt(probeArgs[2]) else 0
+        invalid = 0
+        checked = 0
+        startTime = perf_counter()
+
+        for path, result in probeFiles(findFlipnoteImages(probeArgs[0]), imageWidth=width, imageHeight=height, threads=processes or 32):
+            checked += 1
+            if result["valid"]:
+                print("{}: OK {} palette={} width={}".format(path, result["format"], result["paletteSize"], result["paddedWidth"]))
+            else:
+                invalid += 1
+                print("{}: INVALID {}".format(path, "; ".join(result["errors"])))
+
+        elapsed = max(perf_counter() - startTime, 1e-9)
+        print("Checked {} files ({} invalid) in {:.2f}s: {:.1f} files/s".format(checked, invalid, elapsed, checked / elapsed))
+        sys.exit(1 if invalid else 0)
+
+    if "-b" in args:
+        argIndex = args.index("-b")
+        batchArgs = args[argIndex + 1::]
+
+        if len(batchArgs) < 2:
+            print("Error: batch mode needs an input source and an output directory")
+            sys.exit(1)
+
+        source, outputDir = batchArgs[0:2]
+        outputFormat = batchArgs[2] if len(batchArgs) > 2 else None
+        width = int(batchArgs[3]) if len(batchArgs) > 3 and representsInt(batchArgs[3]) else 0
+        height = int(batchArgs[4]) if len(batchArgs) > 4 and representsInt(batchArgs[4]) else 0
+
+        try:
+            jobs = findBatchJobs(source, outputDir, outputFormat=outputFormat, imageWidth=width, imageHeight=height)
+        except (OSError, ValueError) as error:
+            print("Error: " + str(error))
+            sys.exit(1)
+
+        failures = 0
+        cachedCount = 0
+        totalBytes = 0
+        startTime = perf_counter()
+
+        for inputPath, error, byteCount, cached, jobStats in batchConvert(jobs, processes=processes, cacheDir=cacheDir, profile=stats is not None, thumbnail=thumbnail):
+            if error:
+                failures += 1
+                print("Error converting " + inputPath + ": " + error)
+            cachedCount += cached
+            totalBytes += byteCount
+            if jobStats:
+                stats.merge(jobStats)
+
+        elapsed = max(perf_counter() - startTime, 1e-9)
+        converted = len(jobs) - failures
+        print("Converted {} of {} files ({} failed, {} from cache) in {:.2f}s: {:.1f} files/s, {:.2f} MB/s".format(converted, len(jobs), failures, cachedCount, elapsed, converted / elapsed, totalBytes / elapsed / 1e6))
+        if stats:
+            print(stats.format())
+        sys.exit(1 if failures else 0)
+
     if "-i" not in args:
         print("No input specified")
         sys.exit()
@@ -328,47 +2093,91 @@ if __name__ == "__main__":
         print("No output specified")
         sys.exit()
 
+    conversionCache = ugoConversionCache(cacheDir) if cacheDir else None
+
     while argIndex < len(args):
 
         arg = args[argIndex]
 
         # Input path
+        # The image is only loaded once an output actually needs it, so fully cached conversions skip decoding
         if arg == "-i":
 
-            path = args[argIndex + 1]
-            filename, extension = os.path.splitext(path)
-            extension = extension.split(".")[1]
+            inputPath = os.path.abspath(args[argIndex + 1])
+            filename, inputExtension = os.path.splitext(args[argIndex + 1])
+            inputExtension = inputExtension.split(".")[1]
+            image = None
+            inputDigest = None
+            width = 0
+            height = 0
 
-            if extension.lower() in ["nbf", "ntft", "npf"]:
+            if inputExtension.lower() in ["nbf", "ntft", "npf"]:
 
                 if not representsInt(args[argIndex + 2]) or not representsInt(args[argIndex + 3]):
-                    print("Error: width and height must be specified for " + filename + "." + extension)
+                    print("Error: width and height must be specified for " + filename + "." + inputExtension)
                     sys.exit()
 
                 else:
                     width = int(args[argIndex + 2])
                     height = int(args[argIndex + 3])
 
-                    with open(os.path.abspath(path), "rb") as infile:
-                        image.load(infile, imageFormat=extension, imageWidth=width, imageHeight=height)
-
                 argIndex += 4
 
             else:
-                with open(os.path.abspath(path), "rb") as infile:
-                    image.load(infile, imageFormat=extension)
-
                 argIndex += 2
 
-        # Output path
+        # Output paths
+        # Every -o in a row is written in one go, so the outputs can share the work that they have in common
         elif arg == "-o":
-            path = args[argIndex + 1]
-            filename, extension = os.path.splitext(path)
-            extension = extension.split(".")[1]
+            outputs = []
+
+            while argIndex < len(args) and args[argIndex] == "-o":
+                path = args[argIndex + 1]
+                filename, extension = os.path.splitext(path)
+                extension = extension.split(".")[1]
+                outputData = None
+                cacheKey = None
+
+                if conversionCache:
+                    # The input is only hashed once, however many outputs it has
+                    if inputDigest is None:
+                        inputDigest = conversionCache.inputDigest(inputPath)
+                    cacheKey = conversionCache.key(inputDigest, inputExtension, extension, width, height, thumbnail=thumbnail)
+                    outputData = conversionCache.get(cacheKey)
+
+                outputs.append((path, extension, outputData, cacheKey))
+                argIndex += 2
+
+            buffers = {}
+            targets = []
+
+            for path, extension, outputData, cacheKey in outputs:
+                if outputData is None:
+                    buffers[path] = BytesIO()
+                    targets.append((buffers[path], extension))
+
+            if targets:
+                if image is None:
+                    image = ugoImage(stats=stats)
+                    if thumbnail:
+                        image.loadThumbnail(inputPath, imageFormat=inputExtension, imageWidth=width, imageHeight=height, maxSize=thumbnail[0:2], samples=thumbnail[2])
+                    else:
+                        image.load(inputPath, imageFormat=inputExtension, imageWidth=width, imageHeight=height)
+                image.saveMany(targets)
+
+            for path, extension, outputData, cacheKey in outputs:
+                if outputData is None:
+                    outputData = buffers[path].getvalue()
+                    if conversionCache:
+                        conversionCache.put(cacheKey, outputData)
+
+                with open(path, "wb") as outfile:
+                    outfile.write(outputData)
 
-            with open(path, "wb") as outfile:
-                image.save(outfile, imageFormat=extension)
+    if conversionCache:
+        conversionCache.prune()
 
-            argIndex += 2
+    if stats:
+        print(stats.format())
 
 # James is really cool, btw
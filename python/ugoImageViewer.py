@@ -13,6 +13,13 @@
 #
 # python3 ugoImageViewer.py input_path input_width input_width view_scale(optional)
 #
+# Browse every NTFT, NBF and NPF in a directory, which all need to be the same size:
+# python3 ugoImageViewer.py -g input_dir input_width input_height view_scale(optional)
+#
+# In the gallery, use the left and right arrow keys (or page up and page down) to move between images, home and end to jump
+# to the first and last ones, and + and - to change the view scale. Neighbouring images are decoded in the background, so
+# paging through them doesn't have to wait.
+#
 # Issues:
 # =======
 #
@@ -29,11 +36,18 @@
 #       Installation: https://www.python.org/downloads/
 #   - Pygame
 #       Installation: http://www.pygame.org/download.shtml
+#   - The Pillow Image Library (https://python-pillow.org/), for ugoImage.py
+#       Installation: http://pillow.readthedocs.io/en/3.0.x/installation.html
 #   - NumPy (http://www.numpy.org/)
 #       Installation: https://www.scipy.org/install.html
 
 from pygame import Surface, pixelcopy, transform
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
+from ugoImage import unpackColors
 import numpy as np
+import os
 
 VERSION = "1.0.0"
 
@@ -68,14 +82,28 @@ class baseImageSurface:
         b = b << 3 | (b >> 2)
         return ((0x00 if useAlpha and a == 0 else 0xFF) << 24 | (r << 16) | (g << 8) | (b))
 
+    # Lookup tables mapping every abgr1555 value to its unpacked color, shared between all surfaces
+    unpack_tables = {}
+
+    # Get the lookup table for unpack_color, building it the first time it's needed
+    # It's made from ugoImage's table, which is in [r, g, b, a] order, by rotating the alpha byte to the top
+    # useAlpha = use True to read the alpha bit, else False
+    # Returns a 65536-entry array of 32-bit uints
+    def get_unpack_table(self, useAlpha=True):
+        useAlpha = bool(useAlpha)
+        if useAlpha not in baseImageSurface.unpack_tables:
+            rgba = unpackColors(np.arange(0x10000, dtype=np.uint16), useAlpha=useAlpha).astype(np.uint32)
+            baseImageSurface.unpack_tables[useAlpha] = (rgba >> 8) | (rgba << 24)
+        return baseImageSurface.unpack_tables[useAlpha]
+
     # Convenience method to apply unpack_color over an array
     def unpack_colors(self, colorArray, useAlpha=True):
-        unpack = np.vectorize(self.unpack_color, otypes=[np.uint32])
-        return unpack(colorArray, useAlpha=useAlpha)
+        return self.get_unpack_table(useAlpha)[np.asarray(colorArray, dtype=np.uint16)]
 
+    # Unpack a palette to an array of (r, g, b) values, like pygame's set_palette takes
     def unpack_palette(self, palette):
         palette = self.unpack_colors(palette)
-        return np.array([(((color >> 16) & 0xFF), ((color >> 8) & 0xFF), ((color) & 0xFF)) for color in palette], dtype=np.uint8)
+        return np.stack((palette >> 16, palette >> 8, palette), axis=-1).astype(np.uint8)
 
     # Read an UGAR header from buffer
     # https://github.com/Flipnote-Collective/flipnote-studio-docs/wiki/.nbf-image-format#header
@@ -83,22 +111,33 @@ class baseImageSurface:
     def read_ugar_header(self, buffer):
         # Skip the magic
         buffer.seek(4)
-        sectionCount = np.fromstring(buffer.read(4), dtype=np.uint32)[0]
-        sectionTable = np.fromstring(buffer.read(4 * sectionCount), dtype=np.uint32)
+        sectionCount = np.frombuffer(buffer.read(4), dtype=np.uint32)[0]
+        sectionTable = np.frombuffer(buffer.read(4 * sectionCount), dtype=np.uint32)
         return sectionTable
 
+    # Get the image scaled up, scaling it the first time each scale is asked for
+    # Returns a surface, which still has the padding added by get_size
+    def get_scaled(self, scale=1):
+        if scale == 1:
+            return self.surface
+        scaled = self.scaled.get(scale)
+        if scaled is None:
+            width, height = self.surface.get_size()
+            scaled = self.scaled[scale] = transform.scale(self.surface, (width * scale, height * scale))
+        return scaled
+
     # Draw the image to a surface, as pos (x, y), optionally upscaling
+    # The padded surface is scaled by the same amount in both directions and the padding is cropped off, so images whose width
+    # isn't a power of two come out at their real aspect ratio, and blitting again doesn't scale an already scaled surface
     def blit_to(self, surface, pos, scale=1):
         width, height = self.size
-        width *= scale
-        height *= scale
-        self.surface = transform.scale(self.surface, (width, height))
-        surface.blit(self.surface, pos, area=(0, 0, width, height))
+        surface.blit(self.get_scaled(scale), pos, area=(0, 0, width * scale, height * scale))
 
 class ntftSurface(baseImageSurface):
     def __init__(self, imageBuffer, size):
         width, height = self.get_size(size)
         self.size = size
+        self.scaled = {}
         self.surface = Surface((width, height), depth=32)
         # Unpack the pixel colors
         pixels = self.unpack_colors(np.fromfile(imageBuffer, dtype=np.uint16))
@@ -109,14 +148,15 @@ class nbfSurface(baseImageSurface):
     def __init__(self, imageBuffer, size):
         width, height = self.get_size(size)
         self.size = size
+        self.scaled = {}
         self.surface = Surface((width, height), depth=8)
         # Read the header
         paletteLength, imageDataLength = self.read_ugar_header(imageBuffer)
         # Read the image palette and unpack
-        palette = self.unpack_palette(np.fromstring(imageBuffer.read(paletteLength), dtype=np.uint16))
+        palette = self.unpack_palette(np.frombuffer(imageBuffer.read(paletteLength), dtype=np.uint16))
         self.surface.set_palette(palette)
         # Read the pixels
-        pixels = np.fromstring(imageBuffer.read(imageDataLength), dtype=np.uint8)
+        pixels = np.frombuffer(imageBuffer.read(imageDataLength), dtype=np.uint8)
         pixels = np.swapaxes(np.reshape(pixels, (-1, width)), 0, 1)
         pixelcopy.array_to_surface(self.surface, pixels)
 
@@ -124,25 +164,134 @@ class npfSurface(baseImageSurface):
     def __init__(self, imageBuffer, size):
         width, height = self.get_size(size)
         self.size = size
+        self.scaled = {}
         self.surface = Surface((width, height), depth=8)
         # Read the header
         paletteLength, imageDataLength = self.read_ugar_header(imageBuffer)
         # Read the image palette and unpack
-        palette = self.unpack_palette(np.fromstring(imageBuffer.read(self.round_to_power(paletteLength)), dtype=np.uint16))
+        palette = self.unpack_palette(np.frombuffer(imageBuffer.read(self.round_to_power(paletteLength)), dtype=np.uint16))
         self.surface.set_palette(palette)
         # All pixels with the index of 0 are transparent
         self.surface.set_colorkey(0)
         # Read the pixel data bytes
-        pixelData = np.fromstring(imageBuffer.read(imageDataLength), dtype=np.uint8)
+        pixelData = np.frombuffer(imageBuffer.read(imageDataLength), dtype=np.uint8)
         # Split each byte into 2 pixels
         pixels = np.stack((np.bitwise_and(pixelData, 0x0f), np.bitwise_and(pixelData >> 4, 0x0f)), axis=-1).flatten()
         pixels = np.swapaxes(np.reshape(pixels, (-1, width)), 0, 1)
         pixelcopy.array_to_surface(self.surface, pixels)
 
+# Surface class for each file extension
+SURFACE_TYPES = {
+    ".ntft": ntftSurface,
+    ".nbf": nbfSurface,
+    ".npf": npfSurface,
+}
+
+# Decode an image file, picking the surface class from its extension
+# Returns a baseImageSurface subclass instance
+def load_surface(path, size):
+    with open(path, "rb") as imageBuffer:
+        return SURFACE_TYPES[os.path.splitext(path)[1].lower()](imageBuffer, size)
+
+# Find every image in a directory that the viewer can open
+# Returns a sorted list of paths
+def find_images(directory):
+    return sorted(entry.path for entry in os.scandir(directory) if entry.is_file() and os.path.splitext(entry.name)[1].lower() in SURFACE_TYPES)
+
+# Browses a list of images, decoding the ones around the current image on background threads
+# Decoded images are kept in an LRU of cacheSize surfaces, each of which keeps its own scaled copies
+class ugoGallery:
+    def __init__(self, paths, size, scale=1, prefetch=4, cacheSize=32, threads=4):
+        self.paths = list(paths)
+        self.size = size
+        self.scale = scale
+        self.index = 0
+        self.prefetch = prefetch
+        self.cacheSize = max(cacheSize, prefetch * 2 + 1)
+        self.surfaces = OrderedDict()
+        self.pending = {}
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Decode an image and scale it to the view scale, inside a worker thread
+    # Returns the surface, or the exception that stopped it from loading
+    def _load(self, path, scale):
+        try:
+            surface = load_surface(path, self.size)
+            surface.get_scaled(scale)
+            return surface
+        except Exception as error:
+            return error
+
+    # Add a loaded image to the LRU, evicting the least recently used images once it's full
+    def _store(self, path, surface):
+        with self.lock:
+            self.pending.pop(path, None)
+            self.surfaces[path] = surface
+            self.surfaces.move_to_end(path)
+            while len(self.surfaces) > self.cacheSize:
+                self.surfaces.popitem(last=False)
+
+    # Start decoding an image in the background, unless it's already loaded or being loaded
+    def _request(self, path):
+        with self.lock:
+            if path in self.surfaces or path in self.pending:
+                return
+            future = self.pending[path] = self.executor.submit(self._load, path, self.scale)
+        future.add_done_callback(lambda future: self._finish(path, future))
+
+    # Store an image once its background decode is done
+    # Decodes that were cancelled when the gallery closed are just forgotten, since they have no result
+    def _finish(self, path, future):
+        if future.cancelled():
+            with self.lock:
+                self.pending.pop(path, None)
+            return
+        self._store(path, future.result())
+
+    # Queue up the images around the current one, the ones next to it first, and further ahead than behind
+    def _prefetch(self):
+        for offset in range(1, self.prefetch + 1):
+            for index in [self.index + offset, self.index - offset // 2] if offset % 2 == 0 else [self.index + offset]:
+                if 0 <= index < len(self.paths):
+                    self._request(self.paths[index])
+
+    # Get an image, waiting for it if it hasn't been decoded yet
+    # Returns the surface, or the exception that stopped it from loading
+    def get(self, index):
+        path = self.paths[index]
+        self._request(path)
+        with self.lock:
+            surface = self.surfaces.get(path)
+            if surface is not None:
+                self.surfaces.move_to_end(path)
+                return surface
+            future = self.pending.get(path)
+        # The done callback may not have stored it yet, but the future already has the result
+        return future.result() if future is not None else self.get(index)
+
+    # Move to an image, and start decoding the ones around it
+    # Returns the surface, or the exception that stopped it from loading
+    def go_to(self, index):
+        self.index = min(max(index, 0), len(self.paths) - 1)
+        surface = self.get(self.index)
+        self._prefetch()
+        return surface
+
+    # Change the view scale, the images that are already loaded get scaled as they're shown
+    def set_scale(self, scale):
+        self.scale = max(1, scale)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
 if __name__ == "__main__":
-    from pygame import display, event, time
+    from pygame import display, event, time, QUIT, KEYDOWN, K_LEFT, K_RIGHT, K_PAGEUP, K_PAGEDOWN, K_SPACE, K_HOME, K_END, K_PLUS, K_EQUALS, K_MINUS, K_KP_PLUS, K_KP_MINUS
     from sys import argv
-    import os
+    import sys
 
     def printhelp():
         print("\n".join([
@@ -160,6 +309,12 @@ if __name__ == "__main__":
             "",
             "python3 ugoImageViewer.py input_path input_width input_width view_scale(optional)",
             "",
+            "Browse every NTFT, NBF and NPF in a directory, which all need to be the same size:",
+            "python3 ugoImageViewer.py -g input_dir input_width input_height view_scale(optional)",
+            "",
+            "In the gallery, use the left and right arrow keys (or page up and page down) to move between images, home and end to jump",
+            "to the first and last ones, and + and - to change the view scale",
+            "",
             "Issues:",
             "=======",
             "",
@@ -179,7 +334,53 @@ if __name__ == "__main__":
         printhelp()
         sys.exit()
 
-    if len(args) > 2:
+    if "-g" in args and len(args) > 3:
+        gIndex = args.index("-g")
+        directory = args[gIndex + 1]
+        size = (int(args[gIndex + 2]), int(args[gIndex + 3]))
+        scale = int(args[gIndex + 4]) if len(args) > gIndex + 4 else 1
+        gallery = ugoGallery(find_images(directory), size, scale=scale)
+        if not len(gallery):
+            print("No NTFT, NBF or NPF images found in " + directory)
+            sys.exit(1)
+
+        def show(index):
+            image = gallery.go_to(index)
+            screen = display.get_surface()
+            if screen is None or screen.get_size() != (size[0] * gallery.scale, size[1] * gallery.scale):
+                screen = display.set_mode((size[0] * gallery.scale, size[1] * gallery.scale))
+            # Fill the background so transparent NPF pixels don't show the previous image
+            screen.fill((128, 128, 128))
+            name = os.path.basename(gallery.paths[gallery.index])
+            if isinstance(image, Exception):
+                display.set_caption("{} ({}/{}) - could not open: {}".format(name, gallery.index + 1, len(gallery), image))
+            else:
+                image.blit_to(screen, (0, 0), scale=gallery.scale)
+                display.set_caption("{} ({}/{})".format(name, gallery.index + 1, len(gallery)))
+            display.flip()
+
+        show(0)
+        done = False
+        while not done:
+            # Wait for the next key press, rather than polling
+            e = event.wait()
+            if e.type == QUIT:
+                done = True
+            elif e.type == KEYDOWN:
+                if e.key in (K_RIGHT, K_PAGEDOWN, K_SPACE):
+                    show(gallery.index + 1)
+                elif e.key in (K_LEFT, K_PAGEUP):
+                    show(gallery.index - 1)
+                elif e.key == K_HOME:
+                    show(0)
+                elif e.key == K_END:
+                    show(len(gallery) - 1)
+                elif e.key in (K_PLUS, K_EQUALS, K_KP_PLUS, K_MINUS, K_KP_MINUS):
+                    gallery.set_scale(gallery.scale + (-1 if e.key in (K_MINUS, K_KP_MINUS) else 1))
+                    show(gallery.index)
+        gallery.close()
+
+    elif len(args) > 2:
         path = args[0]
         filename, extension = os.path.splitext(path)
         size = (int(args[1]), int(args[2]))
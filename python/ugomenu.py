@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+# ========================
+# ugomenu.py version 1.0.0
+# ========================
+#
+# Build Flipnote Studio .ugo menus, with the same output as php/class.ugomenu.php
+# Originally written for Sudomemo (github.com/Sudomemo | www.sudomemo.net)
+#
+# Encoded labels and embedded files are kept in a cache shared between menus, and a menu only rebuilds the sections that
+# changed since its last getUGO call, so menus that are served over and over are cheap to build again
+#
+# Usage:
+# ======
+#
+# from ugomenu import ugomenu
+#
+# demoMenu = ugomenu()
+# demoMenu.setType("0")
+# demoMenu.setMeta("uppertitle", "demo page")
+# demoMenu.addDropdown(label="select me!", url="http://www.example.com/path/to/page.htm", selected="1")
+# demoMenu.addButton(label="tap me!", url="http://www.example.com/path/to/page.htm")
+# demoMenu.addItem(label="tap me!", url="http://www.example.com/path/to/page.htm", icon="104")
+# demoMenu.addItem(url="http://www.example.com/path/to/page.htm", file="/local/path/to/flipnote.ppm")
+# data = demoMenu.getUGO()
+#
+# The methods take the same values as the PHP class, see the class.ugomenu.php section of the README
+#
+# Issues:
+# =======
+#
+# If you find any bugs in this script, please report them here:
+# https://github.com/Sudomemo/sudomemo-utils/issues
+#
+# Format documentation can be found on the Flipnote-Collective wiki:
+#   - ugo: https://github.com/Flipnote-Collective/flipnote-studio-docs/wiki/.ugo-menu-format
+#
+# Requirements:
+#   - Python 3
+#       Installation: https://www.python.org/downloads/
+
+from collections import OrderedDict
+from threading import Lock
+import os, struct, base64
+
+VERSION = "1.0.0"
+
+TYPES = {
+    "0": "0",
+    "1": "1",
+    "2": "2",
+    "3": "3",
+    "4": "4",
+    "index": "0",
+    "small_list": "1",
+    "grid": "2",
+    "list": "4",
+}
+
+# Number of bytes each kind of embedded file takes up in the embed section
+# .ppm embeds are just the TMB, any other extension is counted as an ntft, but only .ntft files actually get written, like the PHP class
+PPM_EMBED_LENGTH = 1696
+NTFT_EMBED_LENGTH = 2048
+
+# Convert a value to a string the same way PHP's join and string conversion do
+def _phpString(value):
+    if value is None or value is False:
+        return ""
+    if value is True:
+        return "1"
+    return str(value)
+
+# File extension, the same way PHP's pathinfo gets it
+def _extension(path):
+    name = os.path.basename(os.fspath(path).rstrip("/"))
+    return name.rsplit(".", 1)[1] if "." in name else ""
+
+# Encoded labels and embedded file data, shared between menus
+# Labels are keyed by their text, and embedded files by their path, modification time and size, so a file that gets
+# replaced is read again
+# Entries are evicted once labels take up more than maxLabels entries, or embeds more than maxEmbedBytes
+class ugomenuCache:
+
+    def __init__(self, maxLabels=65536, maxEmbedBytes=64 * 1024 * 1024):
+        self.maxLabels = maxLabels
+        self.maxEmbedBytes = maxEmbedBytes
+        self.labels = {}
+        self.embeds = OrderedDict()
+        self.embedBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    # Encode a label as base64 UTF-16LE
+    # Returns str
+    def label(self, text):
+        if type(text) is not str:
+            text = _phpString(text)
+        # Looking up labels is cheaper than encoding them by only a little, so the lookup itself doesn't take the lock, and the
+        # oldest labels are evicted first rather than the least recently used ones
+        # The hit counter still needs the lock, since += isn't atomic across threads
+        label = self.labels.get(text)
+        if label is not None:
+            with self.lock:
+                self.hits += 1
+            return label
+        label = base64.b64encode(text.encode("utf-16-le")).decode("ascii")
+        with self.lock:
+            self.misses += 1
+            self.labels[text] = label
+            while len(self.labels) > self.maxLabels:
+                del self.labels[next(iter(self.labels))]
+        return label
+
+    # Get the key for an embedded file, which changes whenever the file does
+    # Raises FileNotFoundError if the file doesn't exist
+    def embedKey(self, path, length):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise FileNotFoundError("Error generating Ugomenu: could not open file {}".format(path))
+        return (os.fspath(path), stat.st_mtime_ns, stat.st_size, length)
+
+    # Read the start of an embedded file
+    # key = key from embedKey
+    # Returns bytes, which can be shorter than the key's length if the file is
+    def embed(self, key):
+        with self.lock:
+            data = self.embeds.get(key)
+            if data is not None:
+                self.embeds.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        path, mtime, size, length = key
+        with open(path, "rb") as file:
+            data = file.read(length)
+        with self.lock:
+            if key not in self.embeds:
+                self.embeds[key] = data
+                self.embedBytes += len(data)
+            while self.embedBytes > self.maxEmbedBytes:
+                oldKey, oldData = self.embeds.popitem(last=False)
+                self.embedBytes -= len(oldData)
+        return data
+
+    # Get the cache counters
+    # Returns a dict of hits, misses, labels, embeds and embedBytes
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "labels": len(self.labels), "embeds": len(self.embeds), "embedBytes": self.embedBytes}
+
+    def clear(self):
+        with self.lock:
+            self.labels.clear()
+            self.embeds.clear()
+            self.embedBytes = 0
+
+# Cache used by menus that aren't given one
+sharedCache = ugomenuCache()
+
+class ugomenu:
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else sharedCache
+        self.meta = {}
+        self.menu = {}
+        self.embeds = []
+        # Encoded lines of the dropdown, button and item entries, which never change once they have been added
+        self._lines = {"dropdown": [], "button": [], "item": []}
+        # Menu data section, padded, and its unpadded length, kept until the menu changes
+        self._menuSection = None
+        # Embed section, along with the embed keys it was built from
+        self._embedSection = None
+        self._embedKeys = None
+
+    def writeLabel(self, text):
+        return self.cache.label(text)
+
+    def setType(self, value):
+        self.meta["type"] = TYPES.get(_phpString(value))
+        self._menuSection = None
+
+    # set uppertitle, upperlink, uppersubbottom, etc
+    def setMeta(self, value, text):
+        self.meta[value.lower()] = text
+        self._menuSection = None
+
+    # add a dropdown item, e.g. recent, most popular, featured, etc
+    def addDropdown(self, url=None, label=None, selected=None):
+        item = {
+            "url": url if url is not None else "",
+            "label": label if label is not None else "",
+            "selected": selected if selected is not None else "0",
+        }
+        self.menu.setdefault("dropdown", []).append(item)
+        self._addLine("dropdown", ["2", item["url"], self.cache.label(item["label"]), item["selected"]])
+
+    # add a corner button, e.g. 'post flipnote', 'add comment', etc
+    def addButton(self, url=None, label=None):
+        item = {
+            "url": url if url is not None else "",
+            "label": label if label is not None else "",
+        }
+        self.menu.setdefault("button", []).append(item)
+        self._addLine("button", ["3", item["url"], self.cache.label(item["label"])])
+
+    # menu item, depending on the layout type, this might be a letter, a thumbnail, or a link button
+    def addItem(self, url=None, label=None, icon=None, counter=None, lock=None, unknown=None, file=None):
+        if file is not None:
+            self.addFile(file)
+            icon = len(self.embeds) - 1
+        item = {
+            "url": url if url is not None else "",
+            "label": label if label is not None else "",
+            "icon": icon if icon is not None else "104",
+            "counter": counter if counter is not None else "",
+            "lock": lock if lock is not None else "",
+            "unknown": unknown if unknown is not None else "0",
+        }
+        self.menu.setdefault("item", []).append(item)
+        self._addLine("item", ["4", item["url"], item["icon"], self.cache.label(item["label"]), item["counter"], item["lock"], item["unknown"]])
+
+    # embedded file
+    def addFile(self, path):
+        self.embeds.append({
+            "ext": _extension(path),
+            "path": path
+        })
+
+    # Build the menu
+    # Returns bytes, ready to send to the DSi client
+    # Raises FileNotFoundError if one of the embedded files doesn't exist
+    def getUGO(self):
+        if self._menuSection is None:
+            self._menuSection = self._buildMenuSection()
+        menuData, menuDataLength = self._menuSection
+
+        sectionTable = [menuDataLength]
+        embedData = b""
+        if self.embeds:
+            # Embedded files are checked every time, so changes to them show up without rebuilding the menu
+            embedKeys = []
+            embedLength = 0
+            # Grid menus often embed the same file more than once, so each file only gets checked once
+            checked = {}
+            for item in self.embeds:
+                embedLength += PPM_EMBED_LENGTH if item["ext"] == "ppm" else NTFT_EMBED_LENGTH
+                # Files with any other extension still have to exist, but nothing is read from them
+                readLength = {"ppm": PPM_EMBED_LENGTH, "ntft": NTFT_EMBED_LENGTH}.get(item["ext"], 0)
+                key = checked.get((item["path"], readLength))
+                if key is None:
+                    key = checked[(item["path"], readLength)] = self.cache.embedKey(item["path"], readLength)
+                embedKeys.append(key)
+            sectionTable.append(embedLength)
+            if embedKeys != self._embedKeys:
+                self._embedSection = b"".join(self.cache.embed(key) for key in embedKeys)
+                self._embedKeys = embedKeys
+            embedData = self._embedSection
+
+        # write the magic ('UGAR'), number of sections and the length of each section
+        header = struct.pack("<4s{}I".format(len(sectionTable) + 1), b"UGAR", len(sectionTable), *sectionTable)
+        return b"".join([header, menuData, embedData])
+
+    def _addLine(self, section, fields):
+        self._lines[section].append("\t".join([field if type(field) is str else _phpString(field) for field in fields]))
+        self._menuSection = None
+
+    # Build the menu data section
+    # Returns (padded section data, section length)
+    def _buildMenuSection(self):
+        meta = self.meta
+        # TYPE 0 -- LAYOUT TYPE
+        menuData = ["\t".join(["0", _phpString(meta["type"]) if meta.get("type") is not None else "4"])]
+        # TYPE 1 -- TOP SCREEN LAYOUT
+        if meta.get("upperlink") is not None:
+            menuData.append("\t".join(["1", "1", _phpString(meta["upperlink"])]))
+        else:
+            menuData.append("\t".join(["1", "0"] + [
+                self.writeLabel(meta[key]) if meta.get(key) is not None else ""
+                for key in ["uppertitle", "uppersubleft", "uppersubright", "uppersubtop", "uppersubbottom"]
+            ]))
+        # TYPE 2 -- DROPDOWN ITEMS, TYPE 3 -- BUTTONS, TYPE 4 -- ITEMS
+        menuData += self._lines["dropdown"] + self._lines["button"] + self._lines["item"]
+        menuData = "\n".join(menuData)
+        # The PHP class stores the length in characters, but pads the data itself by bytes, so the same has to be done here
+        # for menus with non-ASCII text to come out the same
+        menuDataLength = len(menuData)
+        menuData = menuData.encode("utf-8")
+        paddedLength = -(-menuDataLength // 4) * 4
+        if len(menuData) < paddedLength:
+            menuData += bytes(paddedLength - len(menuData))
+        return (menuData, menuDataLength)